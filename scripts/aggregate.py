@@ -0,0 +1,456 @@
+"""
+Aggregates computed from the decoded batches while the decode runs.
+
+Token balances, daily event counts and per-address volumes were computed by
+re-reading the full per-event outputs after every run. An `Aggregation` is fed
+each decoded batch instead (`update(event, df)`) and keeps running totals in
+memory: per-holder inflow/outflow (`NetFlow`), per-block or per-day counts and
+sums (`PeriodTotals`) and distinct counterparties (`Counterparties`). Other
+aggregates plug in as objects with a `name`, a `config`, a picklable `state`
+and `update`/`result` methods.
+
+Amount sums are exact: values are converted to 256-bit limbs and added with the
+helpers in compact.py, whatever `uint_format` the amounts were written in.
+Everything is keyed by contract address first, so multi-contract runs keep one
+balance per token.
+
+With a `path` the state is saved by `commit()` together with the shards it
+covers, so incremental runs load it and only add the logs of new shards. A shard
+already recorded in the state (saved just before a crash, with the shard's
+outputs left uncommitted) is decoded again but not counted twice.
+Rewriting the whole state for every shard made commits grow with the history,
+so aggregates that can report their changes (`delta()` / `apply_delta()`, as the
+built-ins do) are saved as one small record per shard appended to
+`{path}.delta`. The log is folded into a new snapshot at `path` once it outgrows
+the snapshot; loading replays the records of the current snapshot generation.
+"""
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from compact import LIMBS, frame_limbs, group_sum, limbs_to_ints
+from decoder import fixed_to_hex, hex_to_fixed
+
+_SECONDS_PER_DAY = 86400
+_DELTA_SUFFIX = '.delta'
+# Odd multiplier of the pair hash (2**64 / golden ratio)
+_PAIR_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _address_text(values):
+    """
+    Addresses in any output format (checksum or lower text, binary, S20) -> lower-case 0x-prefixed hex
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        return fixed_to_hex(values)
+    return pd.Series(values, dtype=object).map(
+        lambda v: '0x' + bytes(v).hex() if isinstance(v, (bytes, bytearray)) else str(v).lower()).to_numpy(dtype=object)
+
+
+def _days(df):
+    """
+    Days since the Unix epoch of each row, from block_timestamp_unix or else block_timestamp
+    """
+    if 'block_timestamp_unix' in df.columns:
+        return pd.to_numeric(df['block_timestamp_unix']).to_numpy(np.int64) // _SECONDS_PER_DAY
+    seconds = pd.to_datetime(df['block_timestamp'], utc=True).astype('int64').to_numpy() // 10**9
+    return seconds // _SECONDS_PER_DAY
+
+
+def _pair_keys(contracts, addresses, counterparties):
+    """
+    (contract, address, counterparty) rows of lower-case hex addresses -> their 64-bit hashes, and the
+    (contract, address) half of each row as a 40-byte key
+    """
+    fixed = np.zeros((len(contracts), 64), dtype=np.uint8)
+    for i, column in enumerate((contracts, addresses, counterparties)):
+        fixed[:, 20 * i:20 * (i + 1)] = hex_to_fixed(column, 20).view(np.uint8).reshape(-1, 20)
+    hashes = np.zeros(len(fixed), dtype=np.uint64)
+    for word in fixed.view('<u8').T:
+        hashes = (hashes ^ word) * _PAIR_MIX
+        hashes ^= hashes >> np.uint64(29)
+    return hashes, np.ascontiguousarray(fixed[:, :40]).view('S40').ravel()
+
+
+def _in_sorted(sorted_values, values):
+    """
+    Mask of `values` present in a sorted array (np.isin without sorting the array again)
+    """
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(sorted_values, values).clip(max=len(sorted_values) - 1)
+    return sorted_values[positions] == values
+
+
+def _group(*columns):
+    """
+    Group codes of rows keyed by several columns, and the key tuple of each code
+    """
+    codes, uniques = pd.MultiIndex.from_arrays(columns).factorize()
+    return codes, list(uniques)
+
+
+class Totals:
+    """
+    Exact running totals per key: a row count and limb sums of any number of columns
+    """
+
+    def __init__(self, columns=(), signed=False):
+        self.columns = list(columns)
+        self.signed = signed
+        self.positions = {}
+        self.keys = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = {col: np.zeros((0, LIMBS), dtype=np.uint64) for col in self.columns}
+        self._changed = np.zeros(0, dtype=bool)  # Rows added to since the last delta()
+        self._delta_keys = 0  # Keys already reported by delta()
+
+    def _rows(self, keys):
+        rows = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            row = self.positions.get(key)
+            if row is None:
+                row = self.positions[key] = len(self.keys)
+                self.keys.append(key)
+            rows[i] = row
+        if len(self.keys) > len(self.counts):
+            # Capacity doubles, so keys are appended in amortized O(1)
+            capacity = max(len(self.keys), 2 * len(self.counts))
+            self._changed = np.concatenate([self._changed, np.zeros(capacity - len(self.counts), dtype=bool)])
+            self.counts = np.concatenate([self.counts, np.zeros(capacity - len(self.counts), dtype=np.int64)])
+            for col in self.columns:
+                grown = np.zeros((capacity, LIMBS), dtype=np.uint64)
+                grown[:len(self.sums[col])] = self.sums[col]
+                self.sums[col] = grown
+        return rows
+
+    def add(self, keys, counts, sums=None):
+        """
+        Adds the totals of one batch: its distinct keys, their row counts and {column: (keys, 4) limb sums}
+        """
+        rows = self._rows(keys)
+        self._changed[rows] = True
+        self.counts[rows] += counts
+        for col, limbs in (sums or {}).items():
+            # Row positions are distinct, so grouping on them adds each batch total to its running total
+            _, totals = group_sum(np.concatenate([self.sums[col][rows], limbs]), np.concatenate([rows, rows]), self.signed)
+            self.sums[col][rows] = totals
+
+    def add_rows(self, keys, limbs=None):
+        """
+        Adds rows grouped by `keys` (codes, key tuples from `_group`) with their {column: limbs}
+        """
+        codes, uniques = keys
+        counts = np.bincount(codes, minlength=len(uniques))
+        sums = {}
+        for col, values in (limbs or {}).items():
+            groups, sums[col] = group_sum(values, codes, self.signed)
+            if len(groups):
+                # group_sum orders groups by first appearance; reorder them by code
+                sums[col] = sums[col][np.argsort(groups)]
+        self.add(uniques, counts, sums)
+
+    def delta(self):
+        """
+        Changes since the previous call: the keys added and the current totals of every row added to
+        """
+        rows = np.flatnonzero(self._changed)
+        delta = {'start': self._delta_keys, 'keys': self.keys[self._delta_keys:], 'rows': rows,
+                 'counts': self.counts[rows], 'sums': {col: self.sums[col][rows] for col in self.columns}}
+        self._changed[rows] = False
+        self._delta_keys = len(self.keys)
+        return delta
+
+    def apply_delta(self, delta):
+        """
+        Replays a `delta()`; totals are absolute, so a delta the state already holds changes nothing
+        """
+        self._rows(delta['keys'][len(self.keys) - delta['start']:])
+        self.counts[delta['rows']] = delta['counts']
+        for col in self.columns:
+            self.sums[col][delta['rows']] = delta['sums'][col]
+        self._delta_keys = len(self.keys)
+
+    def frame(self, key_names):
+        """
+        Totals as a DataFrame: key columns, `count`, then each sum as Python ints
+        """
+        size = len(self.keys)
+        df = pd.DataFrame(self.keys, columns=key_names) if size else pd.DataFrame(columns=key_names)
+        df['count'] = self.counts[:size]
+        for col in self.columns:
+            df[col] = limbs_to_ints(self.sums[col][:size], self.signed)
+        return df
+
+
+class NetFlow:
+    """
+    Per-holder inflow, outflow and net flow (the balance, when the run covers the token's whole history)
+    of a transfer event, per contract.
+    Args:
+        event (str): Event name.
+        sender, recipient, value (str): Argument names (e.g. 'src', 'dst', 'wad' for WETH).
+    """
+
+    def __init__(self, event='Transfer', sender='from', recipient='to', value='value', name='netflow'):
+        self.name = name
+        self.event = event
+        self.sender, self.recipient, self.value = sender, recipient, value
+        self.config = (event, sender, recipient, value)
+        self.state = {'in': Totals([value]), 'out': Totals([value])}
+
+    def update(self, event, df):
+        if event != self.event:
+            return
+        contracts = _address_text(df['address'])
+        limbs = {self.value: frame_limbs(df, self.value)}
+        self.state['in'].add_rows(_group(contracts, _address_text(df[self.recipient])), limbs)
+        self.state['out'].add_rows(_group(contracts, _address_text(df[self.sender])), limbs)
+
+    def delta(self):
+        return {side: totals.delta() for side, totals in self.state.items()}
+
+    def apply_delta(self, delta):
+        for side, totals_delta in delta.items():
+            self.state[side].apply_delta(totals_delta)
+
+    def result(self):
+        keys = ['contract', 'holder']
+        inflow = self.state['in'].frame(keys).rename(columns={'count': 'transfers_in', self.value: 'inflow'})
+        outflow = self.state['out'].frame(keys).rename(columns={'count': 'transfers_out', self.value: 'outflow'})
+        df = inflow.merge(outflow, on=keys, how='outer')
+        for col in ('transfers_in', 'transfers_out'):
+            df[col] = df[col].fillna(0).astype(np.int64)
+        for col in ('inflow', 'outflow'):
+            df[col] = df[col].map(lambda v: 0 if pd.isna(v) else int(v)).astype(object)
+        df['net'] = df['inflow'] - df['outflow']
+        return df.sort_values(keys, ignore_index=True)
+
+
+class PeriodTotals:
+    """
+    Event counts per contract and block or day, with exact sums of chosen argument columns.
+    Sums are signed (int256 two's complement), so they also fit signed amounts such as swap deltas.
+    Args:
+        period (str): 'block' or 'day' (UTC).
+        sums (dict): event name -> argument columns to sum, e.g. {'Transfer': ['value']}.
+    """
+
+    def __init__(self, period='day', sums=None, name=None):
+        if period not in ('block', 'day'):
+            raise ValueError(f"Unknown period {period}, expected 'block' or 'day'")
+        self.name = name or f"per_{period}"
+        self.period = period
+        self.sums = {event: list(cols) for event, cols in (sums or {}).items()}
+        self.config = (period, sorted(self.sums.items()))
+        self.state = {}
+
+    def _totals(self, event):
+        totals = self.state.get(event)
+        if totals is None:
+            totals = self.state[event] = Totals(self.sums.get(event, []), signed=True)
+        return totals
+
+    def update(self, event, df):
+        totals = self._totals(event)
+        periods = pd.to_numeric(df['blockNumber']).to_numpy(np.int64) if self.period == 'block' else _days(df)
+        limbs = {col: frame_limbs(df, col, signed=True) for col in totals.columns}
+        totals.add_rows(_group(_address_text(df['address']), periods), limbs)
+
+    def delta(self):
+        return {event: totals.delta() for event, totals in self.state.items()}
+
+    def apply_delta(self, delta):
+        for event, totals_delta in delta.items():
+            self._totals(event).apply_delta(totals_delta)
+
+    def result(self):
+        frames = []
+        for event, totals in self.state.items():
+            df = totals.frame(['contract', self.period])
+            df.insert(1, 'event', event)
+            frames.append(df)
+        if not frames:
+            return pd.DataFrame(columns=['contract', 'event', self.period, 'count'])
+        df = pd.concat(frames, ignore_index=True).sort_values(['contract', 'event', self.period], ignore_index=True)
+        if self.period == 'day':
+            df['day'] = pd.to_datetime(df['day'].astype(np.int64), unit='D').dt.strftime('%Y-%m-%d')
+        return df
+
+
+class Counterparties:
+    """
+    Number of distinct addresses each address has sent to or received from in an event, per contract.
+    Seen (contract, address, counterparty) pairs are kept as a sorted array of their 64-bit hashes, so two
+    pairs sharing a hash (odds about n**2 / 2**65 for n pairs) would be counted once.
+    """
+
+    def __init__(self, event='Transfer', sender='from', recipient='to', name='counterparties'):
+        self.name = name
+        self.event = event
+        self.sender, self.recipient = sender, recipient
+        self.config = (event, sender, recipient)
+        # 'added' flags the pairs added since the last delta()
+        self.state = {'pairs': np.empty(0, dtype=np.uint64), 'added': np.empty(0, dtype=bool), 'counts': Totals()}
+
+    def _add_pairs(self, hashes, added):
+        """
+        Inserts new, distinct pair hashes into the sorted set
+        """
+        positions = np.searchsorted(self.state['pairs'], hashes)
+        self.state['pairs'] = np.insert(self.state['pairs'], positions, hashes)
+        self.state['added'] = np.insert(self.state['added'], positions, added)
+
+    def update(self, event, df):
+        if event != self.event or len(df) == 0:
+            return
+        contracts = _address_text(df['address'])
+        senders, recipients = _address_text(df[self.sender]), _address_text(df[self.recipient])
+        # Both directions; pairs repeated within the batch are counted once
+        contracts = np.concatenate([contracts, contracts])
+        addresses, counterparties = np.concatenate([senders, recipients]), np.concatenate([recipients, senders])
+        hashes, owners = _pair_keys(contracts, addresses, counterparties)
+        hashes, first = np.unique(hashes, return_index=True)
+        new = ~_in_sorted(self.state['pairs'], hashes)
+        if not new.any():
+            return
+        self._add_pairs(hashes[new], True)
+        owners, counts = np.unique(owners[first[new]], return_counts=True)
+        raw = owners.view(np.uint8).reshape(-1, 40)
+        contract_keys = fixed_to_hex(np.ascontiguousarray(raw[:, :20]).view('S20').ravel())
+        address_keys = fixed_to_hex(np.ascontiguousarray(raw[:, 20:]).view('S20').ravel())
+        self.state['counts'].add(list(zip(contract_keys, address_keys)), counts)
+
+    def delta(self):
+        added = self.state['added']
+        pairs = self.state['pairs'][added]
+        added[:] = False
+        return {'pairs': pairs, 'counts': self.state['counts'].delta()}
+
+    def apply_delta(self, delta):
+        pairs = np.unique(delta['pairs'])
+        self._add_pairs(pairs[~_in_sorted(self.state['pairs'], pairs)], False)
+        self.state['counts'].apply_delta(delta['counts'])
+
+    def result(self):
+        df = self.state['counts'].frame(['contract', 'address']).rename(columns={'count': 'counterparties'})
+        return df.sort_values(['contract', 'address'], ignore_index=True)
+
+
+class Aggregation:
+    """
+    A set of aggregates updated from every decoded batch, with their state optionally persisted at `path`.
+    Args:
+        aggregators (list): NetFlow, PeriodTotals, Counterparties or any object with the same interface.
+        path (str): State file kept across runs, or None for this run only.
+    """
+
+    def __init__(self, aggregators, path=None):
+        self.aggregators = list(aggregators)
+        self.path = path
+        self.shards = {}
+        self.generation = 0
+        # Aggregates without delta()/apply_delta() have their whole state saved by every commit
+        self.incremental = all(hasattr(agg, 'delta') and hasattr(agg, 'apply_delta') for agg in self.aggregators)
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                saved = pickle.load(f)
+            self.shards = saved['shards']
+            self.generation = saved.get('generation', 0)
+            for agg in self.aggregators:
+                config, state = saved['states'].get(agg.name, (None, None))
+                if state is None:
+                    continue
+                if config != agg.config:
+                    raise ValueError(f"Aggregate {agg.name} is configured differently from its state in {path}; "
+                                     f"remove the file to recompute it from the full history")
+                agg.state = state
+            self._replay()
+
+    def _replay(self):
+        """
+        Applies the shard records appended since the snapshot; a record cut short by a crash is dropped
+        """
+        delta_path = f"{self.path}{_DELTA_SUFFIX}"
+        if not os.path.exists(delta_path):
+            return
+        aggregators = {agg.name: agg for agg in self.aggregators}
+        with open(delta_path, 'r+b') as f:
+            end = 0
+            while True:
+                size = int.from_bytes(f.read(8), 'little')
+                data = f.read(size)
+                if size == 0 or len(data) < size:
+                    break
+                end = f.tell()
+                record = pickle.loads(data)
+                # Records of an older generation are already folded into the snapshot
+                if record['generation'] != self.generation:
+                    continue
+                self.shards.update(record['shards'])
+                for name, delta in record['deltas'].items():
+                    if name in aggregators:
+                        aggregators[name].apply_delta(delta)
+            f.truncate(end)
+
+    def applied(self, shard, fingerprint):
+        """
+        Whether a shard is already counted in the saved state
+        """
+        return self.shards.get(shard) == fingerprint
+
+    def update(self, event, df):
+        if len(df):
+            for agg in self.aggregators:
+                agg.update(event, df)
+
+    def _write_snapshot(self):
+        """
+        Writes the whole state (atomically) as a new generation, which retires the delta records
+        """
+        self.generation += 1
+        saved = {'generation': self.generation, 'shards': self.shards,
+                 'states': {agg.name: (agg.config, agg.state) for agg in self.aggregators}}
+        with open(f"{self.path}.tmp", 'wb') as f:
+            pickle.dump(saved, f, protocol=5)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.path}.tmp", self.path)
+        if os.path.exists(f"{self.path}{_DELTA_SUFFIX}"):
+            os.remove(f"{self.path}{_DELTA_SUFFIX}")
+
+    def commit(self, shard=None, fingerprint=None):
+        """
+        Saves the state, recording `shard` as counted in it: the changes since the previous commit are appended
+        to the delta log, which is folded into a new snapshot once it is larger than the snapshot
+        """
+        if shard is not None:
+            self.shards[shard] = fingerprint
+        if self.path is None:
+            return
+        deltas = {agg.name: agg.delta() for agg in self.aggregators} if self.incremental else None
+        delta_path = f"{self.path}{_DELTA_SUFFIX}"
+        log_size = os.path.getsize(delta_path) if os.path.exists(delta_path) else 0
+        if deltas is None or not os.path.exists(self.path) or log_size > os.path.getsize(self.path):
+            self._write_snapshot()
+            return
+        record = pickle.dumps({'generation': self.generation, 'shards': {shard: fingerprint} if shard is not None else {},
+                               'deltas': deltas}, protocol=5)
+        with open(delta_path, 'ab') as f:
+            f.write(len(record).to_bytes(8, 'little') + record)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def results(self):
+        return {agg.name: agg.result() for agg in self.aggregators}
+
+    def write_results(self, output_dir, prefix):
+        """
+        Writes each aggregate to `{output_dir}/{prefix}_agg_{name}.csv`
+        """
+        for name, df in self.results().items():
+            df.to_csv(f"{output_dir}/{prefix}_agg_{name}.csv", index=False)
@@ -0,0 +1,402 @@
+# benchmark.py
+# Purpose: Measures the throughput of every pipeline stage on synthetic BigQuery-shaped logs, fully offline.
+# Note:
+# - Logs are encoded with eth_abi from the ABI below (ERC20 Transfer/Approval, a Uniswap V3 Swap, a router swap with dynamic arguments) plus logs of unknown topics, and written as JSON shards.
+# - Each stage runs in a fresh process on inputs prepared beforehand, so its rows/sec excludes loading them and its peak RSS is its own; stages using workers are repeated for each count in 'worker_counts'.
+# - Decoded outputs are checked against the web3 path (utils.df_log_to_receipt) before the timings, and a run exits with an error if they differ.
+# - Results are saved as JSON; with 'baseline_results' set, stages slower than the baseline by more than 'regression_tolerance' are reported.
+
+import os
+import sys
+import json
+import time
+import random
+from multiprocessing import get_context
+
+import pandas as pd
+import pyarrow.csv as pa_csv
+from eth_abi import encode
+from eth_utils import event_abi_to_log_topic
+from web3 import Web3
+
+from utils import df_log_to_receipt, flatten_attribute_dict
+from decoder import ContractRouter, EventDecoderRegistry, TOPIC_COLUMNS
+from decode_pool import DecodePool
+from ingest import iter_shard_frames, iter_shard_tables
+from block_index import BlockIndex
+from schema import OutputSchema
+from sinks import CsvSink, ParquetSink
+from pipeline import iter_batches, iter_json_records
+from metrics import peak_rss_mb, reset_peak_rss
+
+# Configuration: scale of the synthetic export and of the runs
+bench_dir = "benchmark"  # Shards, prepared stage inputs, outputs and results
+n_logs = 200000  # Synthetic logs, split evenly across the shards
+n_shards = 4
+payload_variety = 2000  # Distinct encoded payloads per event, reused across logs with their own hashes and blocks
+unknown_share = 0.05  # Share of logs whose topic0 is not in the ABI
+worker_counts = [1, 2, 4]  # Process counts for the stages that use workers
+batch_rows = 100000  # Logs per ingest batch
+web3_rows = 2000  # Logs decoded through web3, for the correctness check and the web3 baseline
+stages = []  # Stage names to run, empty for all
+baseline_results = ""  # Results JSON of an earlier run to compare with, empty for none
+regression_tolerance = 0.2  # Slowdown vs the baseline reported as a regression
+seed = 0
+
+ADDRESS_ZERO = '0x' + '00' * 20
+BENCH_ABI = [
+    {"type": "event", "name": "Transfer", "anonymous": False, "inputs": [
+        {"indexed": True, "name": "from", "type": "address"},
+        {"indexed": True, "name": "to", "type": "address"},
+        {"indexed": False, "name": "value", "type": "uint256"}]},
+    {"type": "event", "name": "Approval", "anonymous": False, "inputs": [
+        {"indexed": True, "name": "owner", "type": "address"},
+        {"indexed": True, "name": "spender", "type": "address"},
+        {"indexed": False, "name": "value", "type": "uint256"}]},
+    {"type": "event", "name": "Swap", "anonymous": False, "inputs": [
+        {"indexed": True, "name": "sender", "type": "address"},
+        {"indexed": True, "name": "recipient", "type": "address"},
+        {"indexed": False, "name": "amount0", "type": "int256"},
+        {"indexed": False, "name": "amount1", "type": "int256"},
+        {"indexed": False, "name": "sqrtPriceX96", "type": "uint160"},
+        {"indexed": False, "name": "liquidity", "type": "uint128"},
+        {"indexed": False, "name": "tick", "type": "int24"}]},
+    {"type": "event", "name": "RouterSwap", "anonymous": False, "inputs": [
+        {"indexed": True, "name": "sender", "type": "address"},
+        {"indexed": True, "name": "tokenIn", "type": "address"},
+        {"indexed": False, "name": "amountIn", "type": "uint256"},
+        {"indexed": False, "name": "amountOut", "type": "uint256"},
+        {"indexed": False, "name": "path", "type": "address[]"},
+        {"indexed": False, "name": "data", "type": "bytes"},
+        {"indexed": False, "name": "memo", "type": "string"}]},
+]
+# Share of the known logs per event
+EVENT_MIX = {'Transfer': 0.55, 'Approval': 0.1, 'Swap': 0.25, 'RouterSwap': 0.1}
+
+
+def _hex(rng, nbytes):
+    return '0x' + f'{rng.getrandbits(8 * nbytes):0{2 * nbytes}x}'
+
+
+def _address_topic(address):
+    return '0x' + encode(['address'], [address]).hex()
+
+
+def _payload(event, rng, holders):
+    """
+    (indexed topics after topic0, data) of one random log of `event`
+    """
+    a, b = rng.choice(holders), rng.choice(holders)
+    if event in ('Transfer', 'Approval'):
+        value = rng.getrandbits(rng.choice([16, 64, 96, 128]))
+        return [_address_topic(a), _address_topic(b)], encode(['uint256'], [value])
+    if event == 'Swap':
+        values = [rng.randint(-2**100, 2**100), rng.randint(-2**100, 2**100), rng.getrandbits(160),
+                  rng.getrandbits(128), rng.randint(-887272, 887272)]
+        return [_address_topic(a), _address_topic(b)], encode(['int256', 'int256', 'uint160', 'uint128', 'int24'], values)
+    path = [rng.choice(holders) for _ in range(rng.randint(2, 4))]
+    values = [rng.getrandbits(96), rng.getrandbits(96), path, rng.randbytes(rng.randint(0, 96)), 'route'[:rng.randint(0, 5)]]
+    return [_address_topic(a), _address_topic(b)], encode(['uint256', 'uint256', 'address[]', 'bytes', 'string'], values)
+
+
+def synthetic_logs(n, seed=0, unknown=unknown_share, variety=payload_variety, contract=None):
+    """
+    Yields BigQuery-shaped log records (the fields of `bigquery-public-data.crypto_ethereum.logs` plus msg_sender):
+    about 3 logs per transaction and 100 per block, 12 seconds apart.
+    Args:
+        n (int): Number of logs.
+        unknown (float): Share of logs with a topic0 the ABI does not know.
+        variety (int): Distinct encoded payloads per event; logs reuse them with their own hashes and positions.
+        contract (str): Emitting contract address, random by default.
+    """
+    rng = random.Random(seed)
+    holders = [_hex(rng, 20) for _ in range(1000)] + [ADDRESS_ZERO]
+    contract = contract or _hex(rng, 20)
+    topic0s = {e['name']: '0x' + event_abi_to_log_topic(e).hex() for e in BENCH_ABI}
+    payloads = {event: [_payload(event, rng, holders) for _ in range(variety)] for event in EVENT_MIX}
+    events, weights = list(EVENT_MIX), list(EVENT_MIX.values())
+    block, tx_hash, sender, tx_index, log_index = 17000000, None, None, -1, 0
+    for i in range(n):
+        if i % 100 == 0:
+            block, tx_index, log_index = block + 1, -1, 0
+        if i % 3 == 0:
+            tx_hash, sender, tx_index = _hex(rng, 32), rng.choice(holders), tx_index + 1
+        if rng.random() < unknown:
+            topics, data = [_hex(rng, 32)], bytes(32)
+        else:
+            event = rng.choices(events, weights)[0]
+            indexed, data = rng.choice(payloads[event])
+            topics = [topic0s[event]] + indexed
+        yield {
+            'log_index': log_index,
+            'transaction_hash': tx_hash,
+            'transaction_index': tx_index,
+            'address': contract,
+            'data': '0x' + data.hex(),
+            'topics': topics,
+            'block_timestamp': time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(1682899200 + 12 * (block - 17000000))),
+            'block_number': block,
+            'block_hash': f'0x{block:064x}',
+            'msg_sender': sender,
+        }
+        log_index += 1
+
+
+def write_shards(records, folder, shards):
+    """
+    Writes records round-robin into `shards` newline-delimited JSON files, like a BigQuery export; returns their paths
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = [os.path.join(folder, f'logs_{i:06d}.json') for i in range(shards)]
+    files = [open(path, 'w') for path in paths]
+    try:
+        for i, record in enumerate(records):
+            files[i % shards].write(json.dumps(record) + '\n')
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def prepare(work_dir):
+    """
+    Generates the shards and the inputs of the later stages: classified raw logs, decoded and enriched events
+    """
+    shard_paths = write_shards(synthetic_logs(n_logs, seed), os.path.join(work_dir, 'shards'), n_shards)
+    raw = pd.concat(iter_shard_frames(shard_paths, 1, batch_rows, index=False), ignore_index=True)
+    raw['event'] = ContractRouter(abi=BENCH_ABI).classify(raw)
+    raw.to_pickle(os.path.join(work_dir, 'raw.pkl'))
+    registry = EventDecoderRegistry(BENCH_ABI)
+    decoded = {evt: registry.decode_frame(group) for evt, group in raw[raw['event'] != 'Unknown'].groupby('event')}
+    pd.to_pickle(decoded, os.path.join(work_dir, 'decoded.pkl'))
+    block_index = BlockIndex()
+    block_index.update(raw)
+    pd.to_pickle({evt: block_index.enrich(df) for evt, df in decoded.items()}, os.path.join(work_dir, 'enriched.pkl'))
+
+
+def _web3_record(row, contract):
+    """
+    A log decoded the way the original parse scripts did, through web3's process_receipt
+    """
+    row = dict(row, topics=str([t for t in (row.get(c) for c in TOPIC_COLUMNS) if isinstance(t, str)]))
+    record = flatten_attribute_dict(df_log_to_receipt(row, contract, row['event']))
+    for key in ('transactionHash', 'address', 'blockHash'):
+        record[key] = record[key].hex()
+    return record
+
+
+def _as_text(df):
+    """
+    Cell values as text, so decoded NumPy scalars compare equal to the Python values web3 returns
+    """
+    return df.apply(lambda col: col.map(lambda v: repr(v) if isinstance(v, (bytes, bytearray)) else str(v)))
+
+
+def check_correctness(work_dir, rows=web3_rows):
+    """
+    Compares the decoder and the decode pool with the web3 path on the first `rows` logs of every event.
+    Returns the list of mismatches (empty when everything agrees).
+    """
+    raw = pd.read_pickle(os.path.join(work_dir, 'raw.pkl'))
+    contract = Web3().eth.contract(abi=BENCH_ABI)
+    registry = EventDecoderRegistry(BENCH_ABI)
+    mismatches = []
+    with DecodePool(BENCH_ABI, workers=1, inline_rows=0) as pool:
+        for evt, group in raw[raw['event'] != 'Unknown'].groupby('event'):
+            sample = group.head(rows).reset_index(drop=True)
+            expected = pd.DataFrame([_web3_record(row, contract) for row in sample.to_dict('records')])
+            for label, decoded in (('decoder', registry.decode_frame(sample)), ('decode_pool', pool.decode_frame(sample))):
+                if list(decoded.columns) != list(expected.columns):
+                    mismatches.append(f"{evt} ({label}): columns {list(decoded.columns)} != {list(expected.columns)}")
+                elif not _as_text(decoded).equals(_as_text(expected)):
+                    mismatches.append(f"{evt} ({label}): values differ from web3")
+    return mismatches
+
+
+def _shards(work_dir):
+    folder = os.path.join(work_dir, 'shards')
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder))
+
+
+def _raw(work_dir):
+    return pd.read_pickle(os.path.join(work_dir, 'raw.pkl'))
+
+
+def _decoded(work_dir):
+    return pd.read_pickle(os.path.join(work_dir, 'decoded.pkl'))
+
+
+def _enriched(work_dir):
+    return pd.read_pickle(os.path.join(work_dir, 'enriched.pkl'))
+
+
+def _known_groups(raw):
+    return [(evt, group) for evt, group in raw[raw['event'] != 'Unknown'].groupby('event')]
+
+
+def _run_ingest_lines(paths, workers, work_dir):
+    # pipeline.py without ingest workers: json.loads line by line into DataFrame batches
+    return sum(len(df) for df in iter_batches(iter_json_records(paths), batch_rows))
+
+
+def _run_ingest_frames(paths, workers, work_dir):
+    return sum(len(df) for df in iter_shard_frames(paths, workers, batch_rows, index=False))
+
+
+def _run_ingest_csv(paths, workers, work_dir):
+    # The preprocess_jsonlogs_RamEz.py loop: Arrow batches from the parser processes streamed into one CSV
+    rows = 0
+    options = pa_csv.WriteOptions(include_header=False, quoting_style='needed')
+    with open(os.path.join(work_dir, 'logs_raw.csv'), 'wb') as f:
+        for _, table in iter_shard_tables(paths, workers, batch_rows, index=False):
+            pa_csv.write_csv(table, f, options)
+            rows += table.num_rows
+    return rows
+
+
+def _run_event_mapping(raw, workers, work_dir):
+    return len(ContractRouter(abi=BENCH_ABI).classify(raw))
+
+
+def _run_decode(raw, workers, work_dir):
+    with DecodePool(BENCH_ABI, workers) as pool:
+        return sum(len(pool.decode_frame(group)) for _, group in _known_groups(raw))
+
+
+def _run_decode_web3(raw, workers, work_dir):
+    contract = Web3().eth.contract(abi=BENCH_ABI)
+    records = raw[raw['event'] != 'Unknown'].head(web3_rows).to_dict('records')
+    return len([_web3_record(row, contract) for row in records])
+
+
+def _run_timestamps(inputs, workers, work_dir):
+    raw, decoded = inputs
+    block_index = BlockIndex()
+    block_index.update(raw)
+    return sum(len(block_index.enrich(df)) for df in decoded.values())
+
+
+def _run_schema(formats):
+    def run(enriched, workers, work_dir):
+        output_schema = OutputSchema(**formats)
+        registry = EventDecoderRegistry(BENCH_ABI)
+        return sum(len(output_schema.apply(registry.by_name[evt].abi, df)) for evt, df in enriched.items())
+    return run
+
+
+def _run_write(sink_class):
+    def run(enriched, workers, work_dir):
+        out_dir = os.path.join(work_dir, 'out')
+        os.makedirs(out_dir, exist_ok=True)
+        sink = CsvSink(out_dir, 'bench') if sink_class is CsvSink else sink_class(out_dir, 'bench', BENCH_ABI)
+        for evt, df in enriched.items():
+            sink.write(evt, df)
+        sink.close()
+        return sum(len(df) for df in enriched.values())
+    return run
+
+
+# Stage name -> (input loader, runner(inputs, workers, work_dir) returning the rows processed, uses workers)
+STAGES = {
+    'ingest_lines': (_shards, _run_ingest_lines, False),
+    'ingest_frames': (_shards, _run_ingest_frames, True),
+    'ingest_csv': (_shards, _run_ingest_csv, True),
+    'event_mapping': (_raw, _run_event_mapping, False),
+    'decode': (_raw, _run_decode, True),
+    'decode_web3': (_raw, _run_decode_web3, False),
+    'timestamps': (lambda work_dir: (_raw(work_dir), _decoded(work_dir)), _run_timestamps, False),
+    'schema_hex': (_enriched, _run_schema({}), False),
+    'schema_fixed': (_enriched, _run_schema({'uint_format': 'fixed', 'address_format': 'fixed', 'hash_format': 'fixed'}), False),
+    'write_csv': (_enriched, _run_write(CsvSink), False),
+    'write_parquet': (_enriched, _run_write(ParquetSink), False),
+}
+
+
+def _stage_process(name, workers, work_dir, conn):
+    load, run, _ = STAGES[name]
+    inputs = load(work_dir)
+    # A spawned process inherits the parent's ru_maxrss on Linux, so the peak is read from VmHWM, reset here
+    # to count the stage from its loaded inputs on
+    reset_peak_rss()
+    start = time.perf_counter()
+    rows = run(inputs, workers, work_dir)
+    seconds = time.perf_counter() - start
+    # The children figure is the largest worker process that has exited (forked workers do not inherit it)
+    conn.send({'rows': rows, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb(),
+               'worker_peak_rss_mb': peak_rss_mb(children=True)})
+    conn.close()
+
+
+def run_stage(name, work_dir, workers=None):
+    """
+    Runs one stage in a fresh process and returns its measurements
+    """
+    ctx = get_context('spawn')
+    receiver, sender = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_stage_process, args=(name, workers, work_dir, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError(f"Stage {name} failed (exit code {process.exitcode})")
+    result.update(stage=name, workers=workers, rows_per_sec=result['rows'] / max(result['seconds'], 1e-9))
+    return result
+
+
+def compare_with_baseline(results, baseline, tolerance=regression_tolerance):
+    """
+    Messages for the stages whose rows/sec dropped by more than `tolerance` against the baseline results
+    """
+    previous = {(r['stage'], r['workers']): r['rows_per_sec'] for r in baseline}
+    regressions = []
+    for r in results:
+        before = previous.get((r['stage'], r['workers']))
+        if before and r['rows_per_sec'] < (1 - tolerance) * before:
+            regressions.append(f"{r['stage']} (workers={r['workers']}): {r['rows_per_sec']:,.0f} rows/s, "
+                               f"was {before:,.0f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    os.makedirs(bench_dir, exist_ok=True)
+    print(f"Generating {n_logs} synthetic logs in {n_shards} shards...")
+    prepare(bench_dir)
+
+    mismatches = check_correctness(bench_dir)
+    print('Correctness vs web3: ' + ('OK' if not mismatches else 'FAILED'))
+    for message in mismatches:
+        print(f'  {message}')
+
+    results = []
+    for name in stages or STAGES:
+        for workers in (worker_counts if STAGES[name][2] else [None]):
+            result = run_stage(name, bench_dir, workers)
+            results.append(result)
+            print(f"{name:>14} workers={str(workers):>4}: {result['rows_per_sec']:>12,.0f} rows/s  "
+                  f"{result['seconds']:8.2f}s  peak RSS {result['peak_rss_mb']:7.0f} MB")
+
+    report = pd.DataFrame(results)[['stage', 'workers', 'rows', 'seconds', 'rows_per_sec', 'peak_rss_mb', 'worker_peak_rss_mb']]
+    # Scaling: throughput relative to the smallest worker count of the same stage
+    scaled = report.dropna(subset=['workers'])
+    if len(scaled):
+        first = scaled.groupby('stage')['rows_per_sec'].transform('first')
+        report.loc[scaled.index, 'speedup'] = scaled['rows_per_sec'] / first
+    print(report.to_string(index=False))
+
+    results_path = os.path.join(bench_dir, f"results_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(results_path, 'w') as f:
+        json.dump({'n_logs': n_logs, 'cpu_count': os.cpu_count(), 'correct': not mismatches, 'results': results}, f, indent=2)
+    print(f'Results saved to {results_path}')
+
+    if baseline_results:
+        with open(baseline_results) as f:
+            regressions = compare_with_baseline(results, json.load(f)['results'])
+        print('Regressions vs baseline: ' + ('none' if not regressions else ''))
+        for message in regressions:
+            print(f'  {message}')
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,258 @@
+"""
+Block metadata index for enriching decoded events.
+
+Replaces the per-event merge on `transactionHash` the parse scripts used to add
+`block_timestamp`, `msg_sender` and `block_timestamp_unix`. The index keeps
+block_number -> unix timestamp as sorted NumPy arrays saved in an `.npz` file,
+so every lookup is a vectorized `searchsorted` and gather.
+
+transaction hash -> msg_sender (fixed-width 32/20-byte keys) grows with every
+transaction and is partitioned by block range like `dedup.LogDeduplicator`: a
+transaction keeps its block, so a lookup only opens the buckets of the blocks it
+asks about. Each update appends a sorted segment to its buckets instead of
+rewriting the table; lookups search the segments newest first, memory-mapped,
+and a bucket's segments are merged into one once there are more than
+`max_segments` of them. The segment files live in a `{path}_senders` folder
+next to the `.npz`.
+"""
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from decoder import fixed_to_hex, hex_to_fixed
+
+_EPOCH = pd.Timestamp(0, tz='UTC')
+_SENDER_DTYPE = np.dtype([('tx', 'S32'), ('sender', 'S20')])
+_SEGMENT_FILE = re.compile(r'(-?\d+)_(\d+)\.npy')
+
+
+def _merge_sorted(keys, values, new_keys, new_values):
+    """
+    Sorted union of two key/value arrays; for a key in both, the new value wins.
+    Only the new keys are sorted: they are placed into the existing arrays with `searchsorted`,
+    so an update costs a copy of the history rather than a sort of it.
+    """
+    new_keys, first = np.unique(new_keys, return_index=True)
+    new_values = new_values[first]
+    if len(keys) == 0:
+        return new_keys, new_values
+    positions = np.searchsorted(keys, new_keys)
+    present = keys[positions.clip(max=len(keys) - 1)] == new_keys
+    if present.any():
+        values = values.copy()
+        values[positions[present]] = new_values[present]
+    absent = ~present
+    return np.insert(keys, positions[absent], new_keys[absent]), np.insert(values, positions[absent], new_values[absent])
+
+
+def _lookup(keys, values, queries):
+    """
+    Values for `queries` from sorted `keys`, plus a mask of the queries that were found
+    """
+    if len(keys) == 0:
+        return np.zeros(len(queries), dtype=values.dtype), np.zeros(len(queries), dtype=bool)
+    positions = np.searchsorted(keys, queries).clip(max=len(keys) - 1)
+    found = keys[positions] == queries
+    return values[positions], found
+
+
+def _merge_segments(segments):
+    """
+    One sorted segment from several (oldest first); for a hash in more than one, the newest sender wins
+    """
+    entries = np.concatenate([np.asarray(segment) for segment in segments])
+    entries = entries[np.argsort(entries['tx'], kind='stable')]
+    last = np.r_[entries['tx'][1:] != entries['tx'][:-1], True]
+    return entries[last]
+
+
+class _SenderBucket:
+    """
+    Sorted segments of the transactions of one block range, oldest first: the saved ones memory-mapped from
+    their files, the ones added since in memory
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.segments = [np.load(path, mmap_mode='r') for path in files]
+        self.saved = len(files)  # segments[:saved] are the files
+        self.stale = []  # Files replaced by a merged segment, removed once it is saved
+        # Sequence number of the next segment file: newer segments always sort after older ones
+        self.sequence = int(_SEGMENT_FILE.fullmatch(os.path.basename(files[-1]))[2]) + 1 if files else 0
+
+    def add(self, entries, max_segments):
+        self.segments.append(entries[np.argsort(entries['tx'], kind='stable')])
+        if len(self.segments) > max_segments:
+            self.segments = [_merge_segments(self.segments)]
+            self.stale += self.files
+            self.files = []
+            self.saved = 0
+
+    def lookup(self, keys):
+        senders = np.zeros(len(keys), dtype='S20')
+        found = np.zeros(len(keys), dtype=bool)
+        for segment in reversed(self.segments):
+            rest = np.flatnonzero(~found)
+            if len(rest) == 0:
+                break
+            values, hit = _lookup(segment['tx'], segment['sender'], keys[rest])
+            senders[rest[hit]] = values[hit]
+            found[rest[hit]] = True
+        return senders, found
+
+
+def unix_seconds(timestamps):
+    """
+    BigQuery `block_timestamp` text (or datetimes) -> int64 seconds since the epoch
+    """
+    times = pd.to_datetime(pd.Series(timestamps), utc=True)
+    return ((times - _EPOCH) // pd.Timedelta(seconds=1)).to_numpy(np.int64)
+
+
+class BlockIndex:
+    """
+    block_number -> unix timestamp and transaction hash -> msg_sender lookups.
+    Loaded from `path` (and its `_senders` folder) when the file exists; `save()` writes it back.
+    Args:
+        path (str): `.npz` file of the index, or None for this run only.
+        block_bucket (int): Blocks per partition of the msg_sender table.
+        max_segments (int): Segments a partition may hold before they are merged into one.
+    """
+
+    def __init__(self, path=None, block_bucket=100000, max_segments=8):
+        self.path = path
+        self.block_bucket = block_bucket
+        self.max_segments = max_segments
+        self.blocks = np.empty(0, dtype=np.int64)
+        self.timestamps = np.empty(0, dtype=np.int64)
+        self._buckets = {}
+        self._files = {}  # bucket -> saved segment files, oldest first
+        if path is not None and os.path.exists(path):
+            # A transaction table saved inside the .npz by earlier versions has no blocks to partition it by:
+            # it is left out and rebuilt by the next updates
+            with np.load(path) as data:
+                self.blocks, self.timestamps = data['blocks'], data['timestamps']
+        folder = self._senders_dir(path)
+        if folder is not None and os.path.isdir(folder):
+            segments = sorted((int(m[1]), int(m[2]), name) for name in os.listdir(folder) if (m := _SEGMENT_FILE.fullmatch(name)))
+            for bucket, _, name in segments:
+                self._files.setdefault(bucket, []).append(os.path.join(folder, name))
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @staticmethod
+    def _senders_dir(path):
+        return None if path is None else f"{os.path.splitext(path)[0]}_senders"
+
+    def _bucket(self, bucket):
+        bucket_data = self._buckets.get(bucket)
+        if bucket_data is None:
+            bucket_data = self._buckets[bucket] = _SenderBucket(self._files.pop(bucket, []))
+        return bucket_data
+
+    @property
+    def has_senders(self):
+        """
+        Whether any transaction -> msg_sender entry has been recorded
+        """
+        return bool(self._files) or any(b.segments for b in self._buckets.values())
+
+    def update(self, logs):
+        """
+        Adds the blocks and transactions of raw logs (block_number, block_timestamp, transaction_hash
+        and, when exported, msg_sender columns)
+        """
+        blocks = logs[['block_number', 'block_timestamp']].drop_duplicates('block_number')
+        numbers = pd.to_numeric(blocks['block_number']).to_numpy(np.int64)
+        self.blocks, self.timestamps = _merge_sorted(self.blocks, self.timestamps, numbers, unix_seconds(blocks['block_timestamp']))
+        if 'msg_sender' in logs.columns:
+            txs = logs[['transaction_hash', 'msg_sender', 'block_number']].dropna().drop_duplicates('transaction_hash')
+            txs = txs[txs['msg_sender'].str.startswith('0x')]
+            entries = np.empty(len(txs), dtype=_SENDER_DTYPE)
+            entries['tx'] = hex_to_fixed(txs['transaction_hash'], 32)
+            entries['sender'] = hex_to_fixed(txs['msg_sender'], 20)
+            buckets = pd.to_numeric(txs['block_number']).to_numpy(np.int64) // self.block_bucket
+            order = np.argsort(buckets, kind='stable')
+            buckets, entries = buckets[order], entries[order]
+            bounds = np.flatnonzero(np.diff(buckets)) + 1
+            for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(buckets)]):
+                if end > start:
+                    self._bucket(int(buckets[start])).add(entries[start:end], self.max_segments)
+        return self
+
+    def timestamps_for(self, block_numbers):
+        """
+        Unix timestamps of `block_numbers` and a mask of the blocks present in the index
+        """
+        return _lookup(self.blocks, self.timestamps, pd.to_numeric(pd.Series(block_numbers)).to_numpy(np.int64))
+
+    def senders_for(self, tx_hashes, block_numbers):
+        """
+        msg_sender (lower-case hex) of each transaction hash, None where unknown; only the partitions of
+        `block_numbers` are read
+        """
+        keys = hex_to_fixed(tx_hashes, 32)
+        buckets = pd.to_numeric(pd.Series(block_numbers)).to_numpy(np.int64) // self.block_bucket
+        senders = np.zeros(len(keys), dtype='S20')
+        found = np.zeros(len(keys), dtype=bool)
+        for bucket in np.unique(buckets):
+            if int(bucket) not in self._buckets and int(bucket) not in self._files:
+                continue
+            rows = np.flatnonzero(buckets == bucket)
+            senders[rows], found[rows] = self._bucket(int(bucket)).lookup(keys[rows])
+        result = fixed_to_hex(senders)
+        result[~found] = None
+        return result
+
+    def enrich(self, decoded):
+        """
+        Adds block_timestamp, msg_sender (when the export has it) and block_timestamp_unix to decoded events,
+        dropping events whose block is not in the index like the former inner merge did
+        """
+        timestamps, found = self.timestamps_for(decoded['blockNumber'])
+        if not found.all():
+            decoded, timestamps = decoded[found].reset_index(drop=True), timestamps[found]
+        decoded['block_timestamp'] = pd.to_datetime(timestamps, unit='s', utc=True)
+        if self.has_senders:
+            decoded['msg_sender'] = self.senders_for(decoded['transactionHash'], decoded['blockNumber'])
+        decoded['block_timestamp_unix'] = timestamps
+        return decoded
+
+    def save(self, path=None):
+        """
+        Writes the segments added since the last save as new files of their partitions, removes the files
+        merged away, then writes the block table to a temporary file and renames it over `path`.
+        Saving to another path than the index was loaded from copies every partition there.
+        """
+        path = path or self.path
+        folder = self._senders_dir(path)
+        if folder != self._senders_dir(self.path):
+            for bucket in list(self._files):
+                self._bucket(bucket)
+            for bucket_data in self._buckets.values():
+                bucket_data.segments = [_merge_segments(bucket_data.segments)] if bucket_data.segments else []
+                bucket_data.files, bucket_data.saved, bucket_data.stale, bucket_data.sequence = [], 0, [], 0
+        os.makedirs(folder, exist_ok=True)
+        for bucket, bucket_data in self._buckets.items():
+            for segment in bucket_data.segments[bucket_data.saved:]:
+                segment_path = os.path.join(folder, f"{bucket}_{bucket_data.sequence:06d}.npy")
+                with open(f"{segment_path}.tmp", 'wb') as f:
+                    np.save(f, segment)
+                os.replace(f"{segment_path}.tmp", segment_path)
+                bucket_data.files.append(segment_path)
+                bucket_data.sequence += 1
+            bucket_data.saved = len(bucket_data.segments)
+            # The merged segment holds every entry of the stale files and is newer than them, so a crash before
+            # they are removed leaves lookups unchanged
+            for stale_path in bucket_data.stale:
+                os.remove(stale_path)
+            bucket_data.stale = []
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, blocks=self.blocks, timestamps=self.timestamps)
+        os.replace(tmp_path, path)
+        self.path = path
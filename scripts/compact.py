@@ -0,0 +1,310 @@
+"""
+Compact fixed-width column types for decoded tables.
+
+Decoded uint256 amounts are Python ints in object columns, and hashes and
+addresses are 66/42-character strings, which costs tens of bytes of object
+overhead per cell and makes every sum or comparison run element by element.
+These helpers keep them as fixed-width NumPy columns instead:
+- uint256/int256 as `S32` (the 32-byte big-endian ABI word, so byte order is numeric order
+  for unsigned values) or as four uint64 limbs
+- hashes as `S32` and addresses as `S20` (`decoder.hex_to_fixed`)
+
+Limb arrays have shape (rows, 4) and dtype uint64, least significant limb first;
+signed values are two's complement. Sums, comparisons and scaling by token
+decimals below work on the limbs directly, never on Python ints.
+"""
+
+import numpy as np
+import pandas as pd
+
+LIMBS = 4
+_MASK32 = np.uint64(0xFFFFFFFF)
+_SHIFT32 = np.uint64(32)
+_SIGN_BIT = np.uint64(1 << 63)
+# Largest power of ten below 2**32, the widest divisor/multiplier the 32-bit word loops take
+_POW10_STEP = 9
+
+
+def limb_columns(name):
+    """
+    Column names of a value stored as limbs, least significant first
+    """
+    return [f"{name}_limb{i}" for i in range(LIMBS)]
+
+
+def ints_to_fixed(values, signed=False):
+    """
+    Integer column (int64/uint64 array, or Python ints or decimal strings) -> S32 big-endian words
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        low = values.astype(np.int64).view(np.uint64) if values.dtype.kind == 'i' else values.astype(np.uint64)
+        limbs = np.zeros((len(values), LIMBS), dtype=np.uint64)
+        limbs[:, 0] = low
+        if values.dtype.kind == 'i':
+            # Sign-extend negative int64 values into the high limbs
+            limbs[values < 0, 1:] = np.iinfo(np.uint64).max
+        return limbs_to_fixed(limbs)
+    modulus = 2 ** 256
+    blob = b''.join((int(v) % modulus if signed else int(v)).to_bytes(32, 'big') for v in values)
+    return np.frombuffer(blob, dtype='S32').copy()
+
+
+def fixed_to_limbs(fixed):
+    """
+    S32 big-endian words -> (rows, 4) uint64 limbs
+    """
+    words = np.frombuffer(np.ascontiguousarray(fixed, dtype='S32').tobytes(), dtype='>u8').reshape(-1, LIMBS)
+    return np.ascontiguousarray(words[:, ::-1], dtype=np.uint64)
+
+
+def limbs_to_fixed(limbs):
+    """
+    (rows, 4) uint64 limbs -> S32 big-endian words
+    """
+    words = np.ascontiguousarray(np.asarray(limbs)[:, ::-1], dtype='>u8')
+    return words.view('S32').ravel()
+
+
+def limbs_to_ints(limbs, signed=False):
+    """
+    (rows, 4) limbs -> object array of Python ints, for display or export only
+    """
+    objects = np.asarray(limbs).astype(object)
+    values = (objects[:, 3] << 192) | (objects[:, 2] << 128) | (objects[:, 1] << 64) | objects[:, 0]
+    if signed:
+        values = np.where(values >= 2 ** 255, values - 2 ** 256, values)
+    return values
+
+
+def as_limbs(values, signed=False):
+    """
+    Limbs of an S32 column, an existing limb array, a single int (broadcast later) or an integer column
+    """
+    if isinstance(values, pd.DataFrame):
+        # Column by column: limb columns read back from CSV can mix int64 and uint64, which to_numpy() turns into floats
+        return np.column_stack([values[col].to_numpy().astype(np.uint64) for col in values.columns])
+    if isinstance(values, (int, np.integer)):
+        return fixed_to_limbs(ints_to_fixed([int(values)], signed=True))
+    values = np.asarray(values)
+    if values.ndim == 2:
+        return np.ascontiguousarray(values, dtype=np.uint64)
+    if values.dtype.kind == 'S':
+        return fixed_to_limbs(values)
+    return fixed_to_limbs(ints_to_fixed(values, signed))
+
+
+def frame_limbs(df, name, signed=False):
+    """
+    Limbs of the value `name` in a decoded table, stored either as limb columns or as one column
+    (S32, or the integers or decimal text of the other uint formats)
+    """
+    if name in df.columns:
+        return as_limbs(df[name].to_numpy(), signed)
+    return as_limbs(df[limb_columns(name)])
+
+
+def _to_words(limbs):
+    """
+    (rows, 4) limbs -> (rows, 8) uint64 array of 32-bit words, least significant first
+    """
+    return np.stack([limbs & _MASK32, limbs >> _SHIFT32], axis=2).reshape(len(limbs), 2 * LIMBS)
+
+
+def _from_words(words):
+    """
+    Propagates carries through (rows, 8) 32-bit word sums (each below 2**63).
+    Returns the (rows, 4) limbs modulo 2**256 and the carry out of the top word.
+    """
+    out = np.empty(words.shape, dtype=np.uint64)
+    carry = np.zeros(len(words), dtype=np.uint64)
+    for i in range(words.shape[1]):
+        total = words[:, i] + carry
+        out[:, i] = total & _MASK32
+        carry = total >> _SHIFT32
+    return out[:, 0::2] | (out[:, 1::2] << _SHIFT32), carry
+
+
+def _check_overflow(carry, signed):
+    if not signed and carry.any():
+        raise OverflowError("Sum does not fit in 256 bits")
+
+
+def sum_limbs(values, signed=False, chunk_rows=2**31):
+    """
+    Exact total of a column as (4,) limbs.
+    Unsigned sums raise OverflowError past 2**256; signed sums wrap like two's complement, exact as long as
+    the true total fits in int256.
+    """
+    limbs = as_limbs(values, signed)
+    total = np.zeros((1, LIMBS), dtype=np.uint64)
+    # Word sums stay below 2**63 for fewer than 2**31 rows per chunk
+    for start in range(0, len(limbs), chunk_rows):
+        words = _to_words(limbs[start:start + chunk_rows]).sum(axis=0, dtype=np.uint64) + _to_words(total)[0]
+        total, carry = _from_words(words[None, :])
+        _check_overflow(carry, signed)
+    return total[0]
+
+
+def group_sum(values, keys, signed=False):
+    """
+    Exact per-key totals of a column.
+    Args:
+        values: S32 column, limb array or integer column.
+        keys (array-like): Group key of each row (addresses, block numbers, days, ...).
+    Returns:
+        tuple: (unique keys in order of first appearance, (groups, 4) limb totals)
+    """
+    limbs = as_limbs(values, signed)
+    codes, uniques = pd.factorize(np.asarray(keys))
+    if len(limbs) == 0:
+        return uniques, np.zeros((0, LIMBS), dtype=np.uint64)
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(sorted_codes)) + 1]
+    # Word sums stay below 2**63 for groups of fewer than 2**31 rows
+    words = np.add.reduceat(_to_words(limbs[order]), starts, axis=0, dtype=np.uint64)
+    totals, carry = _from_words(words)
+    _check_overflow(carry, signed)
+    result = np.zeros((len(uniques), LIMBS), dtype=np.uint64)
+    result[sorted_codes[starts]] = totals
+    return uniques, result
+
+
+def compare(a, b, signed=False):
+    """
+    Element-wise comparison of two columns (or a column and a single int): int8 array of -1, 0 or 1
+    """
+    a, b = as_limbs(a, signed), as_limbs(b, signed)
+    if signed:
+        a, b = a.copy(), b.copy()
+        a[:, 3] ^= _SIGN_BIT
+        b[:, 3] ^= _SIGN_BIT
+    result = np.zeros(max(len(a), len(b)), dtype=np.int8)
+    # More significant limbs overwrite the verdict of less significant ones
+    for i in range(LIMBS):
+        diff = (a[:, i] > b[:, i]).astype(np.int8) - (a[:, i] < b[:, i]).astype(np.int8)
+        result = np.where(diff != 0, diff, result)
+    return result
+
+
+def sort_order(values, signed=False):
+    """
+    Indices that sort a column by numeric value
+    """
+    limbs = as_limbs(values, signed)
+    if signed:
+        limbs = limbs.copy()
+        limbs[:, 3] ^= _SIGN_BIT
+    # lexsort sorts by the last key first: the most significant limb
+    return np.lexsort(limbs.T)
+
+
+def _negate(limbs):
+    """
+    Two's complement negation: invert and add one
+    """
+    words = _to_words(~limbs)
+    words[:, 0] += np.uint64(1)
+    return _from_words(words)[0]
+
+
+def _magnitudes(limbs, signed):
+    """
+    Absolute values of the limbs and a mask of the negative rows
+    """
+    limbs = np.asarray(limbs)
+    negative = limbs[:, 3] >= _SIGN_BIT if signed else np.zeros(len(limbs), dtype=bool)
+    if negative.any():
+        limbs = limbs.copy()
+        limbs[negative] = _negate(limbs[negative])
+    return limbs, negative
+
+
+def limbs_to_float(limbs, signed=False):
+    """
+    (rows, 4) limbs -> float64 values (rounded to 53 bits of precision)
+    """
+    limbs, negative = _magnitudes(limbs, signed)
+    values = np.zeros(len(limbs), dtype=np.float64)
+    for i in range(LIMBS - 1, -1, -1):
+        values = values * 2.0 ** 64 + limbs[:, i].astype(np.float64)
+    return np.where(negative, -values, values)
+
+
+def _divmod_small(limbs, divisor):
+    """
+    Long division of unsigned limbs by an integer below 2**32, one 32-bit word at a time
+    """
+    words = _to_words(limbs)
+    quotient = np.empty(words.shape, dtype=np.uint64)
+    remainder = np.zeros(len(words), dtype=np.uint64)
+    divisor = np.uint64(divisor)
+    for i in range(words.shape[1] - 1, -1, -1):
+        current = (remainder << _SHIFT32) | words[:, i]
+        quotient[:, i] = current // divisor
+        remainder = current % divisor
+    return quotient[:, 0::2] | (quotient[:, 1::2] << _SHIFT32), remainder
+
+
+def _mul_small(limbs, factor):
+    """
+    Unsigned limbs times an integer below 2**32, modulo 2**256
+    """
+    words = _to_words(limbs) * np.uint64(factor)
+    out = np.empty(words.shape, dtype=np.uint64)
+    carry = np.zeros(len(words), dtype=np.uint64)
+    for i in range(words.shape[1]):
+        # word * factor + carry stays below 2**64 for a factor below 2**32
+        total = words[:, i] + carry
+        out[:, i] = total & _MASK32
+        carry = total >> _SHIFT32
+    return out[:, 0::2] | (out[:, 1::2] << _SHIFT32)
+
+
+def _sub(a, b):
+    """
+    a - b for unsigned limbs with a >= b
+    """
+    out = np.empty(a.shape, dtype=np.uint64)
+    borrow = np.zeros(len(a), dtype=np.uint64)
+    for i in range(LIMBS):
+        diff = a[:, i] - b[:, i] - borrow
+        borrow = ((a[:, i] < b[:, i]) | ((a[:, i] == b[:, i]) & (borrow == 1))).astype(np.uint64)
+        out[:, i] = diff
+    return out
+
+
+def _pow10_steps(decimals):
+    return [_POW10_STEP] * (decimals // _POW10_STEP) + ([decimals % _POW10_STEP] if decimals % _POW10_STEP else [])
+
+
+def divmod_pow10(values, decimals):
+    """
+    Exact split of unsigned raw token amounts into whole units and the remainder, as limbs:
+    (values // 10**decimals, values % 10**decimals)
+    """
+    limbs = as_limbs(values)
+    quotient = limbs
+    for step in _pow10_steps(decimals):
+        quotient, _ = _divmod_small(quotient, 10 ** step)
+    scaled = quotient
+    for step in _pow10_steps(decimals):
+        scaled = _mul_small(scaled, 10 ** step)
+    return quotient, _sub(limbs, scaled)
+
+
+def scale_decimals(values, decimals, signed=False):
+    """
+    Raw token amounts divided by 10**decimals, as float64.
+    `decimals` is one int or a per-row array (e.g. mixed tokens); whole units and the fractional part
+    are computed exactly before the conversion to float.
+    """
+    limbs, negative = _magnitudes(as_limbs(values, signed), signed)
+    per_row = np.broadcast_to(np.asarray(decimals, dtype=np.int64), len(limbs))
+    result = np.empty(len(limbs), dtype=np.float64)
+    for d in np.unique(per_row):
+        rows = per_row == d
+        whole, fraction = divmod_pow10(limbs[rows], int(d))
+        result[rows] = limbs_to_float(whole) + limbs_to_float(fraction) / 10.0 ** int(d)
+    return np.where(negative, -result, result)
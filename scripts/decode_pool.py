@@ -0,0 +1,160 @@
+"""
+Long-lived worker pool for decoding logs row by row.
+
+`parallel_apply` pickled the row function, with everything it closes over,
+to its workers on every call and shipped each group as a pickled DataFrame,
+so small event groups cost more in dispatch than in decoding. The workers here
+are started once and build their `EventDecoderRegistry` from the ABI at
+startup. Each task carries only the raw log columns, written as an Arrow IPC
+stream into shared memory, and the decoded frame comes back as a pickle
+(protocol 5, so NumPy columns travel as raw buffers) in shared memory as well;
+only block names go through the queues.
+With `profile_dir` each worker runs cProfile around its decoding and saves the
+stats there when it exits (see metrics.py).
+
+Events the registry can decode column-wise are decoded in the calling process,
+which is faster than any dispatch, as are groups too small to be worth
+splitting.
+"""
+
+import cProfile
+import os
+import pickle
+import traceback
+from multiprocessing import Process, Queue, cpu_count, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import pandas as pd
+import pyarrow as pa
+
+from decoder import EventDecoderRegistry, log_columns
+from ingest import from_shared_memory, to_shared_memory
+
+_RESULT = 'result'
+_ERROR = 'error'
+
+
+def _bytes_to_shared_memory(data):
+    """
+    Copies a bytes payload into a new shared memory block; returns (name, size)
+    """
+    shm = SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[:len(data)] = data
+    shm.close()
+    return shm.name, len(data)
+
+
+def _bytes_from_shared_memory(name, size):
+    """
+    Reads back and frees a block written by `_bytes_to_shared_memory`
+    """
+    shm = SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _unlink(name):
+    try:
+        SharedMemory(name=name).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _decode_worker(abi, tasks, results, profile_dir=None):
+    """
+    Builds the decoders once, then decodes the batches taken from `tasks` until it gets None
+    """
+    registry = EventDecoderRegistry(abi)
+    # Only decoding is profiled, not the wait for the next task
+    profiler = cProfile.Profile() if profile_dir else None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, name, size = task
+        if profiler is not None:
+            profiler.enable()
+        try:
+            frame = from_shared_memory(name, size).to_pandas()
+            decoded = registry.decode_rows(frame)
+            results.put((_RESULT, task_id, _bytes_to_shared_memory(pickle.dumps(decoded, protocol=5))))
+        except Exception:
+            results.put((_ERROR, task_id, traceback.format_exc()))
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(profile_dir, f"decode_worker_{os.getpid()}.prof"))
+
+
+class DecodePool:
+    """
+    Decoder processes for one ABI, kept alive for every `decode_frame` call until `close()`.
+    Args:
+        abi (list): Contract ABI every worker builds its decoders from.
+        workers (int): Number of decoder processes, defaults to the CPU count; 0 decodes in this process.
+        batch_rows (int): Logs per task handed to a worker.
+        inline_rows (int): Frames up to this many logs are decoded in this process.
+        profile_dir (str): Folder the workers save their cProfile stats to when they exit, None for no profiling.
+    """
+
+    def __init__(self, abi, workers=None, batch_rows=20000, inline_rows=1000, profile_dir=None):
+        self.registry = EventDecoderRegistry(abi)
+        self.batch_rows = batch_rows
+        self.inline_rows = inline_rows
+        self.workers = cpu_count() if workers is None else workers
+        self.tasks, self.results = Queue(), Queue()
+        self.processes = [Process(target=_decode_worker, args=(abi, self.tasks, self.results, profile_dir), daemon=True)
+                          for _ in range(self.workers)]
+        # Workers must share the parent's resource tracker, or each one's tracker unlinks its blocks when it exits
+        resource_tracker.ensure_running()
+        for process in self.processes:
+            process.start()
+
+    def decode_frame(self, frame):
+        """
+        Same result as `EventDecoderRegistry.decode_frame`, with the row-by-row path split across the workers
+        """
+        decoded = self.registry.decode_columns(frame)
+        if decoded is not None:
+            return decoded
+        if not self.processes or len(frame) <= self.inline_rows:
+            return self.registry.decode_rows(frame)
+
+        frame = frame[log_columns(frame)]
+        pending = 0
+        for task_id, start in enumerate(range(0, len(frame), self.batch_rows)):
+            batch = pa.RecordBatch.from_pandas(frame.iloc[start:start + self.batch_rows], preserve_index=False)
+            self.tasks.put((task_id, *to_shared_memory(batch)))
+            pending += 1
+
+        parts, errors = {}, []
+        while pending:
+            kind, task_id, payload = self.results.get()
+            pending -= 1
+            if kind == _ERROR:
+                errors.append(payload)
+            elif errors:
+                # Still collect the other results so their blocks are freed
+                _unlink(payload[0])
+            else:
+                parts[task_id] = pickle.loads(_bytes_from_shared_memory(*payload))
+        if errors:
+            raise RuntimeError(f"Decoding failed in a worker:\n{errors[0]}")
+        return pd.concat([parts[i] for i in range(len(parts))], ignore_index=True)
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,544 @@
+"""
+Precompiled event decoders built once from a contract ABI.
+
+`df_log_to_receipt` rebuilds a web3 receipt for every log and lets
+`process_receipt` re-derive the event layout each time. The decoders here work
+out the indexed/non-indexed split, the `eth_abi` types and the argument names
+once per event, then decode the hex topics and `data` of a log row straight
+into the flat record that `flatten_attribute_dict(df_log_to_receipt(...))`
+produces.
+
+Events whose arguments all fit in single 32-byte words (uint/int, address, bool,
+bytesN, hashed indexed values) can also be decoded a whole group at a time:
+`decode_columns` turns the topic and `data` columns into byte matrices and
+slices every argument out as a NumPy column.
+
+Topics are carried as four hex columns, `topic0`..`topic3` (missing topics are
+empty), from ingest onwards; `topics_to_columns` splits a legacy `topics` list
+column once.
+"""
+
+import binascii
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from eth_abi import decode as abi_decode
+from eth_abi.grammar import BasicType, parse
+from eth_utils import event_abi_to_log_topic, to_checksum_address
+from web3._utils.abi import exclude_indexed_event_inputs, get_indexed_event_inputs, map_abi_data, named_tree, normalize_event_input_types
+from web3._utils.events import get_event_abi_types_for_decoding
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.datastructures import AttributeDict
+
+from utils import flatten_attribute_dict
+
+_TOPIC_RE = re.compile(r'0x[0-9a-fA-F]{64}')
+_ZERO_PAD = '0' * 64
+TOPIC_COLUMNS = ['topic0', 'topic1', 'topic2', 'topic3']
+_META_COLUMNS = ['log_index', 'transaction_index', 'transaction_hash', 'address', 'block_hash', 'block_number']
+
+
+@lru_cache(maxsize=2**16)
+def checksum_address(hex_address):
+    """
+    Cached `to_checksum_address`; the same holders and pools show up in millions of logs
+    """
+    return to_checksum_address(hex_address)
+
+
+def to_hexstr(value):
+    """
+    Lower-case 0x-prefixed hex string, the same text `HexBytes(value).hex()` gives for a hex string
+    """
+    value = value.lower()
+    return value if value.startswith('0x') else '0x' + value
+
+
+def split_topics(topics):
+    """
+    Returns the topics of a log as a list of 0x-prefixed hex strings.
+    Accepts the list repr of older raw CSVs as well as an actual list.
+    """
+    if isinstance(topics, str):
+        return _TOPIC_RE.findall(topics)
+    return list(topics)
+
+
+def topics_to_columns(topics):
+    """
+    Splits a column of topic lists (or their text form) into a topic0..topic3 DataFrame, None where a log has fewer topics
+    """
+    lists = [split_topics(t) for t in topics]
+    columns = pd.DataFrame(lists, index=getattr(topics, 'index', None)).reindex(columns=range(len(TOPIC_COLUMNS)))
+    columns.columns = TOPIC_COLUMNS
+    return columns.astype(object).where(columns.notna(), None)
+
+
+def with_topic_columns(df):
+    """
+    Replaces a `topics` column by topic0..topic3, in the same position
+    """
+    if 'topics' not in df.columns:
+        return df
+    position = df.columns.get_loc('topics')
+    topic_columns = topics_to_columns(df['topics'])
+    df = df.drop(columns='topics')
+    for offset, col in enumerate(TOPIC_COLUMNS):
+        df.insert(position + offset, col, topic_columns[col])
+    return df
+
+
+def row_topics(row):
+    """
+    Topics of a log row as a list, from the topic0..topic3 columns or a legacy `topics` field
+    """
+    if 'topic0' in row:
+        return [t for t in (row.get(col) for col in TOPIC_COLUMNS) if isinstance(t, str) and t[:2] in ('0x', '0X')]
+    return split_topics(row['topics'])
+
+
+def log_columns(frame):
+    """
+    The columns of a raw log frame the decoders read: topics, data and the log metadata
+    """
+    return [col for col in TOPIC_COLUMNS + ['topics', 'data'] + _META_COLUMNS if col in frame.columns]
+
+
+def _generic_word_decoder(type_str):
+    def decode_word(word):
+        value = abi_decode([type_str], bytes.fromhex(word))[0]
+        return map_abi_data(BASE_RETURN_NORMALIZERS, [type_str], [value])[0]
+    return decode_word
+
+
+def compile_word_decoder(type_str):
+    """
+    Builds a function decoding one 32-byte ABI word, given as 64 hex characters without prefix.
+    Common static types are handled directly; anything irregular (non-zero padding, values out
+    of range) is handed to `eth_abi` so errors and edge cases match the web3 path.
+    Returns None for types that do not fit in a single word.
+    """
+    abi_type = parse(type_str)
+    if not isinstance(abi_type, BasicType) or abi_type.arrlist or abi_type.is_dynamic:
+        return None
+
+    generic = _generic_word_decoder(type_str)
+    base, sub = abi_type.base, abi_type.sub
+
+    if base == 'address':
+        def decode_word(word):
+            if word[:24] != _ZERO_PAD[:24]:
+                return generic(word)
+            return checksum_address('0x' + word[24:])
+    elif base == 'uint':
+        limit = 2 ** sub
+        def decode_word(word):
+            value = int(word, 16)
+            return value if value < limit else generic(word)
+    elif base == 'int':
+        limit = 2 ** (sub - 1)
+        def decode_word(word):
+            value = int(word, 16)
+            if value >= 2 ** 255:
+                value -= 2 ** 256
+            return value if -limit <= value < limit else generic(word)
+    elif base == 'bool':
+        def decode_word(word):
+            if word == _ZERO_PAD:
+                return False
+            if word == _ZERO_PAD[:-1] + '1':
+                return True
+            return generic(word)
+    elif base == 'bytes':
+        width = 2 * sub
+        def decode_word(word):
+            if word[width:] != _ZERO_PAD[width:]:
+                return generic(word)
+            return bytes.fromhex(word[:width])
+    else:
+        return generic
+    return decode_word
+
+
+def _char_matrix(values, width):
+    """
+    Stacks equal-length ASCII strings into a (rows, width) uint8 matrix, None if any length differs or a value is not a string
+    """
+    try:
+        blob = ''.join(values).encode('ascii', errors='replace')
+    except TypeError:
+        return None
+    if len(blob) != width * len(values):
+        return None
+    return np.frombuffer(blob, dtype=np.uint8).reshape(len(values), width)
+
+
+def _hex_to_bytes(chars):
+    """
+    (rows, 2n) matrix of hex digits -> (rows, n) matrix of bytes, None on a non-hex digit
+    """
+    try:
+        raw = binascii.unhexlify(np.ascontiguousarray(chars).tobytes())
+    except binascii.Error:
+        return None
+    return np.frombuffer(raw, dtype=np.uint8).reshape(len(chars), -1)
+
+
+def _words_to_ints(words, signed, bits):
+    """
+    Integer column from a (rows, 32) byte matrix of big-endian words.
+    Returns an int64/uint64 array when every value fits, else Python ints (what pandas infers
+    from the per-row records), or None if a value is out of range for the ABI type.
+    """
+    limbs = np.ascontiguousarray(words).view('>u8').astype(np.uint64)
+    high, low = limbs[:, :3], limbs[:, 3]
+    if signed:
+        negative = low >= 2 ** 63
+        extended = np.where(negative, (high == np.iinfo(np.uint64).max).all(axis=1), (high == 0).all(axis=1))
+        if extended.all():
+            values = low.view(np.int64)
+            limit = 2 ** (bits - 1)
+            if bits < 64 and ((values < -limit) | (values >= limit)).any():
+                return None
+            return values
+    elif (high == 0).all():
+        if bits < 64 and (low >= 2 ** bits).any():
+            return None
+        return low.view(np.int64) if (low < 2 ** 63).all() else low
+
+    objects = limbs.astype(object)
+    values = (objects[:, 0] << 192) | (objects[:, 1] << 128) | (objects[:, 2] << 64) | objects[:, 3]
+    if signed:
+        values = np.where(values >= 2 ** 255, values - 2 ** 256, values)
+        limit = 2 ** (bits - 1)
+        if ((values < -limit) | (values >= limit)).any():
+            return None
+    elif bits < 256 and (values >= 2 ** bits).any():
+        return None
+    return values.tolist()
+
+
+def _words_to_column(words, type_str):
+    """
+    Decodes a (rows, 32) byte matrix of ABI words of one static type.
+    Returns None when a word is not canonically encoded, so the caller can fall back to eth_abi.
+    """
+    abi_type = parse(type_str)
+    base, sub = abi_type.base, abi_type.sub
+    if base == 'address':
+        if words[:, :12].any():
+            return None
+        hexed = np.frombuffer(binascii.hexlify(np.ascontiguousarray(words[:, 12:]).tobytes()), dtype='S40')
+        codes, uniques = pd.factorize(hexed)
+        checksummed = np.array([checksum_address('0x' + u.decode()) for u in uniques], dtype=object)
+        return checksummed[codes]
+    if base in ('uint', 'int'):
+        return _words_to_ints(words, base == 'int', sub)
+    if base == 'bool':
+        if words[:, :31].any() or (words[:, 31] > 1).any():
+            return None
+        return words[:, 31].astype(bool)
+    if base == 'bytes':
+        if words[:, sub:].any():
+            return None
+        blob = np.ascontiguousarray(words[:, :sub]).tobytes()
+        return [blob[i:i + sub] for i in range(0, len(blob), sub)]
+    return None
+
+
+def hexstr_column(values):
+    """
+    Vectorized `to_hexstr` for a column of hex strings; BigQuery exports are already lower-case and prefixed
+    """
+    values = np.asarray(values, dtype=object)
+    if len(values):
+        joined = ''.join(values)
+        chars = _char_matrix(values, len(joined) // len(values)) if joined == joined.lower() else None
+        if chars is not None and (chars[:, 0] == ord('0')).all() and (chars[:, 1] == ord('x')).all():
+            return values
+    return np.array([to_hexstr(v) for v in values], dtype=object)
+
+
+
+def hex_to_fixed(values, nbytes):
+    """
+    Column of 0x-prefixed hex strings -> NumPy array of fixed-width binary keys (dtype S{nbytes})
+    """
+    values = np.asarray(values, dtype=object)
+    chars = _char_matrix(values, 2 + 2 * nbytes)
+    raw = _hex_to_bytes(chars[:, 2:]) if chars is not None else None
+    if raw is None:
+        raw = [bytes.fromhex(to_hexstr(v)[2:].rjust(2 * nbytes, '0')) for v in values]
+        return np.array(raw, dtype=f'S{nbytes}')
+    return np.ascontiguousarray(raw).view(f'S{nbytes}').ravel()
+
+
+def fixed_to_hex(keys):
+    """
+    Inverse of `hex_to_fixed`: fixed-width binary keys -> object array of lower-case 0x-prefixed hex strings
+    """
+    nbytes = keys.dtype.itemsize
+    hexed = np.frombuffer(binascii.hexlify(np.ascontiguousarray(keys).tobytes()), dtype=f'S{2 * nbytes}')
+    return np.array(['0x' + h for h in hexed.astype(str)], dtype=object)
+
+
+class EventDecoder:
+    """
+    Decoder for a single event ABI.
+    Compiled once; `decode_row` then turns a log row (pandas Series or dict with the BigQuery
+    column names) into a flat record.
+    """
+
+    def __init__(self, event_abi):
+        self.abi = event_abi
+        self.name = event_abi['name']
+        self.anonymous = event_abi.get('anonymous', False)
+        self.topic0 = None if self.anonymous else '0x' + event_abi_to_log_topic(event_abi).hex()
+
+        topic_inputs = list(normalize_event_input_types(get_indexed_event_inputs(event_abi)))
+        data_inputs = list(normalize_event_input_types(exclude_indexed_event_inputs(event_abi)))
+        self.topic_names = [inp['name'] for inp in topic_inputs]
+        self.topic_types = list(get_event_abi_types_for_decoding(topic_inputs))
+        self.data_names = [inp['name'] for inp in data_inputs]
+        self.data_types = list(get_event_abi_types_for_decoding(data_inputs))
+        self.data_inputs = data_inputs
+
+        duplicate_names = set(self.topic_names).intersection(self.data_names)
+        if duplicate_names:
+            raise ValueError(f"{self.name}: argument names duplicated between event inputs: {', '.join(duplicate_names)}")
+
+        self.topic_decoders = [compile_word_decoder(t) or _generic_word_decoder(t) for t in self.topic_types]
+        word_decoders = [compile_word_decoder(t) for t in self.data_types]
+        # None when some non-indexed input is a tuple, an array or dynamic; those go through eth_abi + named_tree
+        self.data_decoders = word_decoders if all(word_decoders) else None
+        self.data_hex_length = 2 + 64 * len(self.data_types)
+
+        # Column-wise decoding needs every argument in its own word, in a fixed-size data payload
+        self.vectorizable = (
+            not self.anonymous
+            and self.data_decoders is not None
+            and all(compile_word_decoder(t) for t in self.topic_types)
+        )
+        self._topic0_chars = np.frombuffer(self.topic0.encode('ascii'), dtype=np.uint8) if self.topic0 else None
+
+    def decode_topics(self, topics):
+        log_topics = topics if self.anonymous else topics[1:]
+        if not self.anonymous and (not topics or topics[0].lower() != self.topic0):
+            raise ValueError(f"{self.name}: event signature does not match topic0 {topics[0] if topics else None}")
+        if len(log_topics) != len(self.topic_decoders):
+            raise ValueError(f"{self.name}: expected {len(self.topic_decoders)} log topics, got {len(log_topics)}")
+        return [dec(t[2:]) for dec, t in zip(self.topic_decoders, log_topics)]
+
+    def decode_data(self, data):
+        """
+        Returns the non-indexed arguments as a name: value dict
+        """
+        if self.data_decoders is not None and len(data) >= self.data_hex_length:
+            return {name: dec(data[2 + 64 * i:66 + 64 * i])
+                    for i, (name, dec) in enumerate(zip(self.data_names, self.data_decoders))}
+
+        decoded = abi_decode(self.data_types, bytes.fromhex(data[2:] if data.startswith('0x') else data))
+        normalized = map_abi_data(BASE_RETURN_NORMALIZERS, self.data_types, decoded)
+        # Same nesting as process_receipt, which flatten_attribute_dict then unpacks
+        return flatten_attribute_dict(AttributeDict.recursive(named_tree(self.data_inputs, normalized)))
+
+    def topic_words(self, frame):
+        """
+        (rows, 32) byte matrices for each indexed argument, taken from the topic0..topic3 columns.
+        None unless every row has exactly this event's topic0 and topic count.
+        """
+        n_topics = 1 + len(self.topic_types)
+        topic0 = _char_matrix(frame['topic0'].to_numpy(), 66)
+        # | 0x20 lower-cases hex letters and leaves digits and 'x' alone
+        if topic0 is None or ((topic0 | 0x20) != self._topic0_chars).any():
+            return None
+        for col in TOPIC_COLUMNS[n_topics:]:
+            if col in frame.columns and frame[col].notna().any():
+                return None
+        words = []
+        for col in TOPIC_COLUMNS[1:n_topics]:
+            chars = _char_matrix(frame[col].to_numpy(), 66)
+            word = _hex_to_bytes(chars[:, 2:]) if chars is not None else None
+            if word is None:
+                return None
+            words.append(word)
+        return words
+
+    def data_words(self, data):
+        """
+        (rows, 32) byte matrices for each non-indexed argument, None unless every payload has the exact static size
+        """
+        chars = _char_matrix(list(data), self.data_hex_length)
+        if chars is None:
+            return None
+        if self.data_types and (chars[:, :2] != np.frombuffer(b'0x', dtype=np.uint8)).any():
+            return None
+        payload = _hex_to_bytes(chars[:, 2:])
+        if payload is None:
+            return None
+        return [payload[:, 32 * i:32 * (i + 1)] for i in range(len(self.data_types))]
+
+    def decode_columns(self, frame):
+        """
+        Decodes a whole frame of this event's logs column by column.
+        Returns the same DataFrame as building one from `decode_row` records, or None when the
+        event or some row does not fit the static layout (use the per-row path then).
+        """
+        if not self.vectorizable or len(frame) == 0:
+            return None
+        if 'topic0' not in frame.columns:
+            frame = with_topic_columns(frame)
+        topic_words = self.topic_words(frame)
+        data_words = self.data_words(frame['data']) if topic_words is not None else None
+        if data_words is None:
+            return None
+
+        columns = {}
+        for name, type_str, words in zip(self.topic_names + self.data_names, self.topic_types + self.data_types, topic_words + data_words):
+            column = _words_to_column(words, type_str)
+            if column is None:
+                return None
+            columns[name] = column
+        columns['event'] = np.full(len(frame), self.name, dtype=object)
+        columns['logIndex'] = frame['log_index'].to_numpy()
+        columns['transactionIndex'] = frame['transaction_index'].to_numpy()
+        columns['transactionHash'] = hexstr_column(frame['transaction_hash'])
+        columns['address'] = hexstr_column(frame['address'])
+        columns['blockHash'] = hexstr_column(frame['block_hash'])
+        columns['blockNumber'] = frame['block_number'].to_numpy()
+        return pd.DataFrame(columns)
+
+    def decode_row(self, row, topics=None):
+        if topics is None:
+            topics = row_topics(row)
+        record = dict(zip(self.topic_names, self.decode_topics(topics)))
+        record.update(self.decode_data(row['data']))
+        record['event'] = self.name
+        record['logIndex'] = row['log_index']
+        record['transactionIndex'] = row['transaction_index']
+        record['transactionHash'] = to_hexstr(row['transaction_hash'])
+        record['address'] = to_hexstr(row['address'])
+        record['blockHash'] = to_hexstr(row['block_hash'])
+        record['blockNumber'] = row['block_number']
+        return record
+
+
+class EventDecoderRegistry:
+    """
+    topic0 -> EventDecoder map for every (non-anonymous) event of an ABI
+    """
+
+    def __init__(self, abi):
+        self.abi = abi
+        self.decoders = [EventDecoder(obj) for obj in abi if obj['type'] == 'event']
+        self.by_topic = {}
+        self.by_name = {}
+        for dec in self.decoders:
+            if dec.topic0 is not None:
+                self.by_topic.setdefault(dec.topic0, dec)
+            self.by_name.setdefault(dec.name, dec)
+
+    def __getitem__(self, topic0):
+        return self.by_topic[topic0.lower()]
+
+    def __contains__(self, topic0):
+        return topic0.lower() in self.by_topic
+
+    def event_signatures(self):
+        """
+        topic0: event name, same mapping the preprocess scripts build with event_abi_to_log_topic
+        """
+        return {topic0: dec.name for topic0, dec in self.by_topic.items()}
+
+    def decode_row(self, row):
+        """
+        Drop-in for `flatten_attribute_dict(df_log_to_receipt(row, contract, event))`,
+        picking the event from topic0 rather than from the event name
+        """
+        topics = row_topics(row)
+        try:
+            dec = self.by_topic[topics[0].lower()]
+        except (IndexError, KeyError):
+            raise ValueError(f"No event in the ABI matches topics {topics}")
+        return dec.decode_row(row, topics)
+
+    def decode_columns(self, frame):
+        """
+        Column-wise decoding of a frame holding logs of a single event, None if it does not apply
+        """
+        if len(frame) == 0:
+            return None
+        if 'topic0' not in frame.columns:
+            frame = with_topic_columns(frame)
+        topic0 = frame['topic0'].iloc[0]
+        if not isinstance(topic0, str) or topic0 not in self:
+            return None
+        return self[topic0].decode_columns(frame)
+
+    def decode_rows(self, frame):
+        """
+        Decodes a frame of logs row by row into a DataFrame of flat records
+        """
+        records = frame[log_columns(frame)].to_dict('records')
+        return pd.DataFrame([self.decode_row(row) for row in records])
+
+    def decode_frame(self, frame):
+        """
+        Decodes a frame of logs into a DataFrame, column-wise where possible and row by row otherwise
+        """
+        decoded = self.decode_columns(frame)
+        if decoded is None:
+            decoded = self.decode_rows(frame)
+        return decoded
+
+
+class ContractRouter:
+    """
+    Routes logs to decoders by (address, topic0).
+    With `abi` every address shares one registry (the single-contract scripts' behaviour, also fine for many
+    contracts of one type such as ERC20 tokens). With `abi_loader` (address -> abi or None) each address gets
+    its own registry, built the first time the address shows up.
+    """
+
+    def __init__(self, abi=None, abi_loader=None):
+        if (abi is None) == (abi_loader is None):
+            raise ValueError("Pass exactly one of abi and abi_loader")
+        self.shared = EventDecoderRegistry(abi) if abi is not None else None
+        self.abi_loader = abi_loader
+        self.registries = {}  # lower-case address -> EventDecoderRegistry, None when no abi is available
+        self._signatures = {}  # 'address:topic0' -> event name for every loaded address
+
+    @property
+    def multi_contract(self):
+        return self.shared is None
+
+    def registry(self, address):
+        if self.shared is not None:
+            return self.shared
+        address = address.lower()
+        if address not in self.registries:
+            abi = self.abi_loader(address)
+            registry = EventDecoderRegistry(abi) if abi else None
+            self.registries[address] = registry
+            if registry is not None:
+                self._signatures.update({f"{address}:{topic0}": name for topic0, name in registry.event_signatures().items()})
+        return self.registries[address]
+
+    def abi_for(self, address):
+        registry = self.registry(address)
+        return registry.abi if registry is not None else None
+
+    def classify(self, df):
+        """
+        Event name of every log of a frame with address and topic0 columns, 'Unknown' when no ABI matches
+        """
+        topic0 = df['topic0'].str.lower()
+        if self.shared is not None:
+            return topic0.map(self.shared.event_signatures()).fillna('Unknown')
+        address = df['address'].str.lower()
+        for a in address.unique():
+            if isinstance(a, str):
+                self.registry(a)
+        return (address + ':' + topic0).map(self._signatures).fillna('Unknown')
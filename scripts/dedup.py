@@ -0,0 +1,309 @@
+"""
+Streaming deduplication of raw logs on (transaction_hash, log_index).
+
+Overlapping exports and repeated date windows hand the same log over more than
+once. `LogDeduplicator` remembers every key it has let through, partitioned by
+block range (a log keeps its block, so a key can only reappear in its own
+bucket). For each bucket only a sorted array of 64-bit key hashes stays in
+memory; the exact 40-byte keys (transaction hash + big-endian log index) are
+kept with them in the bucket's file on disk and read, memory-mapped, only to
+verify a hash hit.
+When the loaded buckets go over `memory_budget`, the least recently used ones
+are written out and dropped, so exports read in block order only keep the
+buckets around the current position in memory.
+
+With a `path` the key files persist across runs (incremental decoding); writes
+are staged until `commit()`, so keys of outputs that were never committed are
+forgotten after a crash. `commit(shard, fingerprint)` also keeps the keys that
+shard added, so the keys can be committed ahead of the shard's outputs: when a
+crash leaves the outputs uncommitted, `replay()` lets that shard's own logs
+through again on the re-run. Without a path the keys spill to a temporary
+folder removed by `close()`.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from decoder import hex_to_fixed
+
+_KEY_DTYPE = np.dtype([('tx', 'S32'), ('log_index', '>u8')])
+# Multiplier spreading log indexes over 64 bits (2**64 / golden ratio)
+_INDEX_MIX = np.uint64(0x9E3779B97F4A7C15)
+_STAGED = '.staged'
+_ENTRY_DTYPE = np.dtype([('hash', '<u8'), ('key', 'S40')])
+_LAST_SHARD = 'last_shard.npz'
+
+
+def log_keys(tx_hashes, log_indexes):
+    """
+    Exact S40 keys (32-byte transaction hash + 8-byte log index) and their uint64 hashes
+    """
+    keys = np.empty(len(tx_hashes), dtype=_KEY_DTYPE)
+    keys['tx'] = hex_to_fixed(tx_hashes, 32)
+    keys['log_index'] = np.asarray(log_indexes, dtype=np.int64)
+    keys = keys.view('S40')
+    # Transaction hashes are already uniformly distributed: their first 8 bytes mixed with the log index
+    first_words = np.frombuffer(np.ascontiguousarray(keys).tobytes(), dtype='>u8').reshape(-1, 5)[:, 0].astype(np.uint64)
+    hashes = first_words ^ (np.asarray(log_indexes, dtype=np.int64).astype(np.uint64) * _INDEX_MIX)
+    return keys, hashes
+
+
+def _sorted_set(hashes, keys):
+    order = np.argsort(hashes, kind='stable')
+    return hashes[order], keys[order]
+
+
+def _merge_set(set_hashes, set_keys, hashes, keys):
+    """
+    Sorted set with (hash, key) pairs added: only the new pairs are sorted, then inserted with `searchsorted`
+    """
+    hashes, keys = _sorted_set(hashes, keys)
+    if len(set_hashes) == 0:
+        return hashes, keys
+    positions = np.searchsorted(set_hashes, hashes, side='right')
+    return np.insert(set_hashes, positions, hashes), np.insert(np.asarray(set_keys), positions, keys)
+
+
+def _contains(set_hashes, set_keys, hashes, keys):
+    """
+    Mask of the (hash, key) pairs present in a sorted set; `set_keys` is only read where a hash matches
+    """
+    found = np.zeros(len(hashes), dtype=bool)
+    if len(set_hashes) == 0:
+        return found
+    positions = np.searchsorted(set_hashes, hashes)
+    hits = np.flatnonzero((positions < len(set_hashes)) & (set_hashes[positions.clip(max=len(set_hashes) - 1)] == hashes))
+    if len(hits) == 0:
+        return found
+    keys_at = np.asarray(set_keys[positions[hits]])
+    found[hits] = keys_at == keys[hits]
+    # Two keys sharing a 64-bit hash: check the rest of the run of equal hashes
+    for row in hits[keys_at != keys[hits]]:
+        position = positions[row] + 1
+        while position < len(set_hashes) and set_hashes[position] == hashes[row]:
+            if set_keys[position] == keys[row]:
+                found[row] = True
+                break
+            position += 1
+    return found
+
+
+class _Bucket:
+    """
+    Keys of one block range: the saved ones (hashes in memory, keys on disk) and the ones added since
+    """
+
+    def __init__(self, hashes, file_path):
+        self.hashes = hashes
+        self.file_path = file_path
+        self.new_hashes = np.empty(0, dtype=np.uint64)
+        self.new_keys = np.empty(0, dtype='S40')
+
+    @property
+    def nbytes(self):
+        return self.hashes.nbytes + self.new_hashes.nbytes + self.new_keys.nbytes
+
+    def saved_keys(self):
+        if self.file_path is None or len(self.hashes) == 0:
+            return np.empty(0, dtype='S40')
+        return np.load(self.file_path, mmap_mode='r')['key']
+
+    def contains(self, hashes, keys):
+        found = _contains(self.new_hashes, self.new_keys, hashes, keys)
+        rest = ~found
+        if rest.any():
+            found[rest] = _contains(self.hashes, self.saved_keys(), hashes[rest], keys[rest])
+        return found
+
+    def add(self, hashes, keys):
+        if len(hashes):
+            self.new_hashes, self.new_keys = _merge_set(self.new_hashes, self.new_keys, hashes, keys)
+
+
+class LogDeduplicator:
+    """
+    Drops logs whose (transaction_hash, log_index) has been seen before, in this batch or an earlier one.
+    Args:
+        path (str): Folder keeping the keys across runs, or None for this run only.
+        memory_budget (int): Bytes of key hashes and unsaved keys held in memory.
+        block_bucket (int): Blocks per partition.
+    """
+
+    def __init__(self, path=None, memory_budget=256 * 2**20, block_bucket=100000):
+        self.persistent = path is not None
+        self.path = path or tempfile.mkdtemp(prefix='dedup_')
+        self.memory_budget = memory_budget
+        self.block_bucket = block_bucket
+        self.duplicates = 0
+        self._buckets = OrderedDict()
+        self._added = []  # Keys recorded since the last commit
+        self._replay = None  # Sorted keys of a shard re-read after a crash, and which of them were let through
+        os.makedirs(self.path, exist_ok=True)
+        # Staged files of a run that never committed belong to outputs that were never committed either
+        for name in os.listdir(self.path):
+            if _STAGED in name:
+                os.remove(os.path.join(self.path, name))
+
+    def _file(self, bucket, staged=False):
+        return os.path.join(self.path, f"{bucket}{_STAGED if staged else ''}.npy")
+
+    def _load(self, bucket):
+        bucket_data = self._buckets.get(bucket)
+        if bucket_data is not None:
+            self._buckets.move_to_end(bucket)
+            return bucket_data
+        for staged in (True, False):
+            path = self._file(bucket, staged)
+            if os.path.exists(path):
+                bucket_data = _Bucket(np.array(np.load(path, mmap_mode='r')['hash']), path)
+                break
+        else:
+            bucket_data = _Bucket(np.empty(0, dtype=np.uint64), None)
+        self._buckets[bucket] = bucket_data
+        return bucket_data
+
+    def _write(self, bucket, bucket_data):
+        """
+        Merges the bucket's new keys into its staged file
+        """
+        if len(bucket_data.new_hashes) == 0:
+            return
+        hashes, keys = _merge_set(bucket_data.hashes, bucket_data.saved_keys(), bucket_data.new_hashes, bucket_data.new_keys)
+        entries = np.empty(len(hashes), dtype=_ENTRY_DTYPE)
+        entries['hash'], entries['key'] = hashes, keys
+        path = self._file(bucket, staged=True)
+        with open(f"{path}.tmp", 'wb') as f:
+            np.save(f, entries)
+        os.replace(f"{path}.tmp", path)
+        bucket_data.hashes, bucket_data.file_path = hashes, path
+        bucket_data.new_hashes, bucket_data.new_keys = np.empty(0, dtype=np.uint64), np.empty(0, dtype='S40')
+
+    def _evict(self, keep):
+        used = sum(b.nbytes for b in self._buckets.values())
+        while used > self.memory_budget and len(self._buckets) > 1:
+            bucket, bucket_data = next(iter(self._buckets.items()))
+            if bucket in keep:
+                break
+            used -= bucket_data.nbytes
+            self._write(bucket, bucket_data)
+            del self._buckets[bucket]
+
+    def keep_mask(self, tx_hashes, log_indexes, block_numbers):
+        """
+        Mask of the logs seen for the first time (the first of any repeats within the batch); their keys are recorded
+        """
+        keys, hashes = log_keys(tx_hashes, log_indexes)
+        keep = np.zeros(len(keys), dtype=bool)
+        keep[np.unique(keys, return_index=True)[1]] = True
+        buckets = np.asarray(block_numbers, dtype=np.int64) // self.block_bucket
+        for bucket in np.unique(buckets):
+            rows = np.flatnonzero((buckets == bucket) & keep)
+            bucket_data = self._load(int(bucket))
+            seen = bucket_data.contains(hashes[rows], keys[rows])
+            keep[rows[seen]] = False
+            bucket_data.add(hashes[rows[~seen]], keys[rows[~seen]])
+        self._evict(set(int(b) for b in np.unique(buckets)))
+        if self._replay is not None:
+            keep |= self._replayed(keys, keep)
+        if self.persistent:
+            self._added.append(keys[keep])
+        self.duplicates += int(len(keep) - keep.sum())
+        return keep
+
+    def filter(self, df):
+        """
+        Rows of a raw log batch not seen before
+        """
+        if len(df) == 0:
+            return df
+        keep = self.keep_mask(df['transaction_hash'].to_numpy(), pd.to_numeric(df['log_index']).to_numpy(),
+                              pd.to_numeric(df['block_number']).to_numpy())
+        return df if keep.all() else df[keep]
+
+    def filter_table(self, table):
+        """
+        `filter` for an Arrow table from `ingest.iter_shard_tables`
+        """
+        if table.num_rows == 0:
+            return table
+        tx_hashes, log_indexes, block_numbers = (table.column(name).to_numpy(zero_copy_only=False)
+                                                 for name in ('transaction_hash', 'log_index', 'block_number'))
+        keep = self.keep_mask(tx_hashes, pd.to_numeric(log_indexes), pd.to_numeric(block_numbers))
+        return table if keep.all() else table.filter(pa.array(keep))
+
+    def _replayed(self, keys, keep):
+        """
+        Mask of the dropped logs that the replayed shard let through in its committed run (each key once)
+        """
+        replay_keys, used = self._replay
+        result = np.zeros(len(keys), dtype=bool)
+        rows = np.flatnonzero(~keep)
+        rows = rows[np.unique(keys[rows], return_index=True)[1]]
+        if len(rows) == 0 or len(replay_keys) == 0:
+            return result
+        positions = np.searchsorted(replay_keys, keys[rows]).clip(max=len(replay_keys) - 1)
+        hit = (replay_keys[positions] == keys[rows]) & ~used[positions]
+        used[positions[hit]] = True
+        result[rows[hit]] = True
+        return result
+
+    def replay(self, shard, fingerprint):
+        """
+        Lets the logs `shard` recorded in the last commit through again, when that commit was the shard's own and
+        its outputs were not committed after it. Returns whether the shard is replayed.
+        """
+        self._replay = None
+        path = os.path.join(self.path, _LAST_SHARD)
+        if not self.persistent or not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            if str(data['shard']) != shard or str(data['fingerprint']) != json.dumps(fingerprint, sort_keys=True):
+                return False
+            replay_keys = np.sort(data['keys'])
+        self._replay = (replay_keys, np.zeros(len(replay_keys), dtype=bool))
+        return True
+
+    def commit(self, shard=None, fingerprint=None):
+        """
+        Saves every key recorded so far; staged files become the persisted state.
+        With `shard`, the keys recorded since the previous commit are kept as that shard's, for `replay()`.
+        """
+        if shard is not None:
+            added = np.concatenate(self._added) if self._added else np.empty(0, dtype='S40')
+            path = os.path.join(self.path, _LAST_SHARD)
+            with open(f"{path}.tmp", 'wb') as f:
+                np.savez(f, shard=np.str_(shard), fingerprint=np.str_(json.dumps(fingerprint, sort_keys=True)), keys=added)
+            os.replace(f"{path}.tmp", path)
+        self._added = []
+        self._replay = None
+        for bucket, bucket_data in self._buckets.items():
+            self._write(bucket, bucket_data)
+        for name in os.listdir(self.path):
+            if name.endswith('.npy') and _STAGED in name:
+                os.replace(os.path.join(self.path, name), os.path.join(self.path, name.replace(_STAGED, '')))
+        for bucket, bucket_data in self._buckets.items():
+            if bucket_data.file_path is not None:
+                bucket_data.file_path = self._file(bucket)
+
+    def close(self):
+        """
+        Commits a persistent deduplicator; removes the spill folder of a temporary one
+        """
+        if self.persistent:
+            self.commit()
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+        self._buckets = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
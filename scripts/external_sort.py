@@ -0,0 +1,175 @@
+"""
+External sort of decoded events by (block_number, log_index).
+
+Batches reach the sinks in whatever order the shards were parsed and grouped,
+so consumers that replay state (balances, positions) had to sort 100M-row
+outputs themselves. `OrderedSink` sits in front of any sink: it buffers the
+batches of every event, and whenever `run_rows` rows are buffered it sorts each
+event's buffer and spills it to disk as a sorted run. On `close()` the runs of
+each event are k-way merged and handed to the wrapped sink in order, so every
+output file comes out globally sorted while memory stays bounded by the run
+size plus one chunk per run.
+
+Runs are sequences of pickled DataFrame chunks (protocol 5), which keeps the
+Python ints, bytes and lists of decoded columns intact. The merge is vectorized:
+it takes, from every run's current chunk, the rows up to the smallest last key
+among those chunks, which no unread row can precede, and sorts just those.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def sort_keys(df):
+    """
+    One int64 key per row, ordering by blockNumber then logIndex (log indexes are below 2**32)
+    """
+    blocks = pd.to_numeric(df['blockNumber']).to_numpy(np.int64)
+    log_indexes = pd.to_numeric(df['logIndex']).to_numpy(np.int64)
+    return (blocks << 32) | log_indexes
+
+
+def sort_frame(df):
+    """
+    A batch sorted by (blockNumber, logIndex); ties keep their order
+    """
+    order = np.argsort(sort_keys(df), kind='stable')
+    return df.iloc[order].reset_index(drop=True)
+
+
+def write_run(path, df, chunk_rows):
+    """
+    Sorts a batch and writes it to `path` as a run of pickled chunks
+    """
+    df = sort_frame(df)
+    with open(path, 'wb') as f:
+        for start in range(0, len(df), chunk_rows):
+            pickle.dump(df.iloc[start:start + chunk_rows], f, protocol=5)
+
+
+def iter_run(path):
+    """
+    Yields the chunks of a run in order
+    """
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class _RunReader:
+    """
+    Current chunk of one run and its sort keys
+    """
+
+    def __init__(self, path):
+        self.chunks = iter_run(path)
+        self.chunk, self.keys = None, None
+        self.advance()
+
+    def advance(self):
+        chunk = next(self.chunks, None)
+        self.chunk = chunk.reset_index(drop=True) if chunk is not None else None
+        self.keys = sort_keys(chunk) if chunk is not None else None
+
+    def take(self, boundary):
+        """
+        Removes and returns the rows of the current chunk with a key up to `boundary`
+        """
+        end = int(np.searchsorted(self.keys, boundary, side='right'))
+        taken = self.chunk.iloc[:end]
+        self.chunk, self.keys = self.chunk.iloc[end:], self.keys[end:]
+        if len(self.keys) == 0:
+            self.advance()
+        return taken
+
+
+def merge_runs(paths):
+    """
+    K-way merge of sorted runs; yields sorted DataFrames of about one chunk per run
+    """
+    readers = [r for r in (_RunReader(p) for p in paths) if r.chunk is not None]
+    while readers:
+        # No row left unread in any run can sort before the smallest of the chunks' last keys
+        boundary = min(r.keys[-1] for r in readers)
+        parts = [r.take(boundary) for r in readers]
+        readers = [r for r in readers if r.chunk is not None]
+        merged = pd.concat([p for p in parts if len(p)], ignore_index=True)
+        yield sort_frame(merged) if len(parts) > 1 else merged
+
+
+class OrderedSink:
+    """
+    Wraps a sink so each event's output is written sorted by (blockNumber, logIndex), through sorted runs
+    spilled to `spill_dir` and merged on `close()`.
+    Args:
+        sink: Any sink (CsvSink, ParquetSink, PartitionedSink).
+        run_rows (int): Rows buffered across events before they are sorted and spilled as runs.
+        chunk_rows (int): Rows per chunk in a run, read one at a time per run while merging.
+        spill_dir (str): Folder for the temporary run files (defaults to the system temp folder).
+    """
+
+    def __init__(self, sink, run_rows=1000000, chunk_rows=50000, spill_dir=None):
+        self.sink = sink
+        self.run_rows = run_rows
+        self.chunk_rows = chunk_rows
+        self.spill_dir = tempfile.mkdtemp(prefix='runs_', dir=spill_dir)
+        self._buffers = {}
+        self._buffered = 0
+        self._runs = {}
+        self._run_count = 0
+
+    def path(self, *args):
+        return self.sink.path(*args)
+
+    def write(self, event, df):
+        if len(df) == 0:
+            return
+        self._buffers.setdefault(event, []).append(df)
+        self._buffered += len(df)
+        if self._buffered >= self.run_rows:
+            self._spill()
+
+    def _spill_event(self, event, frames):
+        path = os.path.join(self.spill_dir, f"{self._run_count}.run")
+        self._run_count += 1
+        write_run(path, pd.concat(frames, ignore_index=True), self.chunk_rows)
+        self._runs.setdefault(event, []).append(path)
+
+    def _spill(self):
+        for event, frames in self._buffers.items():
+            self._spill_event(event, frames)
+        self._buffers = {}
+        self._buffered = 0
+
+    def close(self):
+        """
+        Merges the runs of every event into the wrapped sink, then closes it
+        """
+        try:
+            for event, frames in self._buffers.items():
+                if event in self._runs:
+                    self._spill_event(event, frames)
+                else:
+                    # Never spilled: sorted in memory
+                    self.sink.write(event, sort_frame(pd.concat(frames, ignore_index=True)))
+            for event, runs in self._runs.items():
+                for df in merge_runs(runs):
+                    self.sink.write(event, df)
+            self.sink.close()
+        finally:
+            self._buffers, self._runs = {}, {}
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,363 @@
+"""
+Parallel, bounded-memory ingest of newline-delimited JSON log shards.
+
+Shards are memory-mapped and split into newline-aligned byte ranges, so several
+workers can share one large shard. Workers parse the ranges into columnar Arrow
+record batches (topics already split into topic0..topic3) and hand them to the
+parent as Arrow IPC streams in shared memory, so only a block name crosses the
+process boundary instead of a pickled list of dicts. The bytes of every batch
+not yet consumed by the parent count against `memory_budget`; a worker that
+would go over it waits until the writer catches up, which keeps peak RAM
+bounded however fast the shards parse. Progress is reported in input bytes, so
+no pass over the data is needed to count lines first.
+
+Gzip and zstd shards (detected from their first bytes) are stream-decompressed
+by the worker that parses them, never written out as plain text; each one is a
+single work unit, so independent shards decompress in parallel.
+"""
+
+import gzip
+import io
+import json
+import mmap
+import os
+import traceback
+from multiprocessing import Condition, Process, Queue, Value, cpu_count, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import pyarrow as pa
+
+from decoder import TOPIC_COLUMNS, split_topics
+from shard_index import ShardIndexBuilder, batch_entry
+
+try:
+    import zstandard
+except ImportError:  # only needed for .zst shards
+    zstandard = None
+
+_DONE = 'done'
+_ERROR = 'error'
+_BATCH = 'batch'
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+
+
+def shard_compression(file_path):
+    """
+    'gzip', 'zstd' or None, from the first bytes of the file rather than its name
+    """
+    with open(file_path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(_GZIP_MAGIC):
+        return 'gzip'
+    if magic == _ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+def is_shard(filename, file_type='.json'):
+    """
+    True for export shards of `file_type`, plain or compressed (e.g. logs-000.json.gz)
+    """
+    return any(filename.endswith(file_type + suffix) for suffix in ('',) + COMPRESSED_SUFFIXES)
+
+
+def _decompressed(raw, compression):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw)
+    if zstandard is None:
+        raise ImportError("Reading zstd-compressed shards requires the 'zstandard' package")
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw))
+
+
+def open_shard(file_path, mode='r'):
+    """
+    Opens a shard for reading ('r' text or 'rb' binary), stream-decompressing gzip/zstd shards on the fly
+    """
+    compression = shard_compression(file_path)
+    if compression is None:
+        return open(file_path, mode)
+    stream = _decompressed(open(file_path, 'rb'), compression)
+    return stream if mode == 'rb' else io.TextIOWrapper(stream, encoding='utf-8')
+
+
+def _record_columns(records):
+    """
+    Column names of a batch: record keys in first-seen order, with 'topics' expanded in place
+    """
+    keys = {}
+    for record in records:
+        keys.update(dict.fromkeys(record))
+    columns = []
+    for key in keys:
+        columns.extend(TOPIC_COLUMNS if key == 'topics' else [key])
+    return columns
+
+
+def _arrow_column(values):
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed types within a batch (e.g. numbers exported as text in some rows): keep the text form
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+def records_to_batch(records):
+    """
+    Converts a list of log records (dicts) to an Arrow RecordBatch with topic0..topic3 columns
+    """
+    columns = _record_columns(records)
+    data = {}
+    for col in columns:
+        if col in TOPIC_COLUMNS:
+            continue
+        data[col] = [record.get(col) for record in records]
+    if 'topic0' in columns:
+        topics = [split_topics(record.get('topics') or []) for record in records]
+        for i, col in enumerate(TOPIC_COLUMNS):
+            data[col] = [t[i] if i < len(t) else None for t in topics]
+    return pa.RecordBatch.from_arrays([_arrow_column(data[col]) for col in columns], names=columns)
+
+
+def to_shared_memory(batch):
+    """
+    Serializes a batch as an Arrow IPC stream into a new shared memory block; returns (name, size)
+    """
+    def write_stream(sink):
+        with pa.ipc.new_stream(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+
+    # Measure the stream first so it can be written straight into the block, without a staging copy
+    sizer = pa.MockOutputStream()
+    write_stream(sizer)
+    size = sizer.size()
+    shm = SharedMemory(create=True, size=max(size, 1))
+    buffer = pa.py_buffer(shm.buf)
+    write_stream(pa.FixedSizeBufferWriter(buffer))
+    del buffer
+    shm.close()
+    return shm.name, size
+
+
+def from_shared_memory(name, size):
+    """
+    Reads back and frees a block written by `to_shared_memory`
+    """
+    shm = SharedMemory(name=name)
+    try:
+        data = pa.py_buffer(bytes(shm.buf[:size]))
+    finally:
+        shm.close()
+        shm.unlink()
+    return pa.ipc.open_stream(data).read_all()
+
+
+def _reserve(inflight, cond, size, memory_budget):
+    """
+    Blocks until `size` more bytes fit in the budget; a batch larger than the budget waits for an empty pipeline
+    """
+    with cond:
+        while inflight.value > 0 and inflight.value + size > memory_budget:
+            cond.wait()
+        inflight.value += size
+
+
+def _release(inflight, cond, size):
+    with cond:
+        inflight.value -= size
+        cond.notify_all()
+
+
+def shard_ranges(file_path, range_bytes=64 * 2**20):
+    """
+    Splits a shard into newline-aligned (start, end) byte ranges of about `range_bytes`, found through a memory map.
+    A compressed shard cannot be entered mid-stream and is a single (0, None) range.
+    """
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return []
+    if shard_compression(file_path) is not None:
+        return [(0, None)]
+    starts = [0]
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = range_bytes
+        while position < size:
+            newline = mm.find(b'\n', position)
+            if newline == -1 or newline + 1 >= size:
+                break
+            starts.append(newline + 1)
+            position = newline + 1 + range_bytes
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def _iter_range_lines(file_path, start, end):
+    """
+    Yields (line, end offset) for the lines of a memory-mapped shard between two newline-aligned offsets
+    """
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = start
+        while position < end:
+            newline = mm.find(b'\n', position, end)
+            line_end = end if newline == -1 else newline + 1
+            yield mm[position:line_end], line_end
+            position = line_end
+
+
+def _iter_stream_lines(file_path):
+    """
+    Yields (line, compressed bytes read so far) while stream-decompressing a shard
+    """
+    with open(file_path, 'rb') as raw, _decompressed(raw, shard_compression(file_path)) as stream:
+        for line in stream:
+            yield line, raw.tell()
+
+
+def _parse_worker(tasks, results, inflight, cond, batch_rows, memory_budget):
+    """
+    Parses the byte ranges taken from `tasks` and puts one shared memory handle per batch on `results`
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        file_path, start, end = task
+        try:
+            records = []
+            # Start offset of the batch being filled, for progress reporting and the shard index
+            batch_start = start
+            seekable = end is not None
+            if not seekable:
+                end = os.path.getsize(file_path)
+                lines = _iter_stream_lines(file_path)
+            else:
+                lines = _iter_range_lines(file_path, start, end)
+            for line, line_end in lines:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    print(f"Error parsing {file_path}: {str(e)}")
+                    continue
+                if len(records) >= batch_rows:
+                    _put_batch(results, inflight, cond, records, file_path, memory_budget, batch_start, line_end, seekable)
+                    records, batch_start = [], line_end
+            _put_batch(results, inflight, cond, records, file_path, memory_budget, batch_start, end, seekable, last=True)
+        except Exception:
+            results.put((_ERROR, file_path, traceback.format_exc()))
+    results.put((_DONE, None, None))
+
+
+def _put_batch(results, inflight, cond, records, file_path, memory_budget, start, end, seekable, last=False):
+    """
+    Hands a batch covering bytes [start, end) of its shard to the parent, with its shard index entry;
+    `last` marks the final batch of the worker's byte range
+    """
+    if not records:
+        results.put((_BATCH, file_path, (None, 0, 0, end - start, None, last)))
+        return
+    batch = records_to_batch(records)
+    entry = batch_entry(batch, start, end) if seekable else batch_entry(batch, None, None)
+    _reserve(inflight, cond, batch.nbytes, memory_budget)
+    name, size = to_shared_memory(batch)
+    results.put((_BATCH, file_path, (name, size, batch.nbytes, end - start, entry, last)))
+
+
+def total_bytes(file_paths, selection=None):
+    """
+    Combined size of the shards (or of their selected spans), the total for byte-based progress bars
+    """
+    if selection is None:
+        return sum(os.path.getsize(p) for p in file_paths)
+    return sum(os.path.getsize(p) if spans is None else sum(end - start for start, end in spans)
+               for p, spans in selection.items())
+
+
+def iter_shard_tables(file_paths, workers=None, batch_rows=100000, memory_budget=2**30, range_bytes=64 * 2**20,
+                      progress=None, selection=None, index=False):
+    """
+    Parses shards in `workers` processes and yields (shard path, Arrow table) batches as they complete.
+    Each shard is split into newline-aligned byte ranges, so the workers share a single large shard too.
+    Args:
+        file_paths (list): Newline-delimited JSON shards.
+        workers (int): Number of parser processes, defaults to the CPU count.
+        batch_rows (int): Records per batch.
+        memory_budget (int): Bytes of parsed batches allowed to wait for the consumer.
+        range_bytes (int): Approximate size of the byte range a worker parses at a time.
+        progress (callable): Called with the number of input bytes each batch covered (e.g. a tqdm `update`).
+        selection (dict): Spans to read from `shard_index.select_spans`; shards missing from it are skipped.
+        index (bool): Write the sidecar block-range index of every shard read in full.
+    Returns:
+        generator: (str, pyarrow.Table) pairs, in completion order rather than file order.
+    """
+    ranges, builders = [], {}
+    for p in file_paths:
+        if selection is not None and p not in selection:
+            continue
+        spans = selection.get(p) if selection is not None else None
+        if spans is None:
+            spans = shard_ranges(p, range_bytes)
+            if index and spans:
+                builders[p] = ShardIndexBuilder(p, len(spans))
+        ranges.extend((p, start, end) for start, end in spans)
+    workers = min(workers or cpu_count(), max(len(ranges), 1))
+    tasks, results = Queue(), Queue()
+    inflight, cond = Value('q', 0, lock=False), Condition()
+    for task in ranges:
+        tasks.put(task)
+    for _ in range(workers):
+        tasks.put(None)
+    processes = [Process(target=_parse_worker, args=(tasks, results, inflight, cond, batch_rows, memory_budget), daemon=True)
+                 for _ in range(workers)]
+    # Workers must share the parent's resource tracker, or each one's tracker unlinks its blocks when it exits
+    resource_tracker.ensure_running()
+    for process in processes:
+        process.start()
+
+    running = workers
+    try:
+        while running:
+            kind, file_path, payload = results.get()
+            if kind == _DONE:
+                running -= 1
+            elif kind == _ERROR:
+                raise RuntimeError(f"Parsing {file_path} failed:\n{payload}")
+            else:
+                name, size, nbytes, input_bytes, entry, last = payload
+                if progress is not None:
+                    progress(input_bytes)
+                builder = builders.get(file_path)
+                if builder is not None:
+                    builder.add(entry, last)
+                    if builder.complete:
+                        builder.save()
+                        del builders[file_path]
+                if name is None:
+                    continue
+                yield file_path, from_shared_memory(name, size)
+                # The batch stays counted until the consumer asks for the next one
+                _release(inflight, cond, nbytes)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        # Free the blocks of batches nobody will read (early exit or error)
+        while not results.empty():
+            kind, _, payload = results.get()
+            if kind == _BATCH and payload[0] is not None:
+                try:
+                    SharedMemory(name=payload[0]).unlink()
+                except FileNotFoundError:
+                    pass
+
+
+def iter_shard_frames(file_paths, workers=None, batch_rows=100000, memory_budget=2**30, range_bytes=64 * 2**20,
+                      progress=None, selection=None, index=False):
+    """
+    `iter_shard_tables` as pandas DataFrames, with the same columns `with_topic_columns` produces
+    """
+    for _, table in iter_shard_tables(file_paths, workers, batch_rows, memory_budget, range_bytes, progress, selection, index):
+        yield table.to_pandas()
@@ -0,0 +1,186 @@
+"""
+Shard manifest and checkpointed commits for incremental runs.
+
+The manifest is a JSON file next to the outputs recording every input shard
+already decoded (path, size, mtime and optionally a SHA-256), the highest
+`block_number` committed per event, and the committed size of every output
+file. Which shards a re-run decodes is decided by the shard fingerprints alone;
+the per-event blocks are informational (how far each output reaches). A shard's outputs are first written to a staging folder and only then
+moved into place, with the files about to be touched logged in the manifest
+beforehand, so a crash leaves nothing that the next run cannot roll back.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from sinks import align_columns, csv_header
+
+
+def atomic_write_json(path, obj):
+    """
+    Writes JSON to a temporary file, fsyncs it and renames it over `path`
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def file_sha256(path, block_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def shard_fingerprint(path, checksum=False):
+    """
+    Size and mtime of a shard, plus its SHA-256 when `checksum` is set
+    """
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if checksum:
+        fingerprint['sha256'] = file_sha256(path)
+    return fingerprint
+
+
+class Manifest:
+    """
+    Record of processed shards, the highest block written per event (informational) and committed output sizes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {'shards': {}, 'events': {}, 'outputs': {}, 'inflight': [], 'commits': 0}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data.update(json.load(f))
+            # Written by earlier versions, which skipped logs below it
+            self.data.pop('complete_block', None)
+
+    def save(self):
+        atomic_write_json(self.path, self.data)
+
+    def is_done(self, shard_path, checksum=False):
+        """
+        True if the shard was committed and has not changed since
+        """
+        record = self.data['shards'].get(os.path.abspath(shard_path))
+        if record is None:
+            return False
+        fingerprint = shard_fingerprint(shard_path, checksum=checksum and 'sha256' in record)
+        return all(record.get(k) == v for k, v in fingerprint.items())
+
+    def pending(self, file_paths, checksum=False):
+        """
+        Shards that still need decoding
+        """
+        return [p for p in file_paths if not self.is_done(p, checksum)]
+
+    def max_block(self, event):
+        """
+        Highest block committed for an event; informational, it does not decide what is decoded
+        """
+        return self.data['events'].get(event)
+
+    def committed_size(self, output_path):
+        return self.data['outputs'].get(output_path, 0)
+
+    def next_part(self):
+        return self.data['commits']
+
+    def recover(self):
+        """
+        Rolls back output files touched by a commit that did not finish
+        """
+        for output_path in self.data['inflight']:
+            size = self.committed_size(output_path)
+            if not os.path.exists(output_path):
+                continue
+            if size == 0:
+                os.remove(output_path)
+            elif os.path.getsize(output_path) > size:
+                with open(output_path, 'r+b') as f:
+                    f.truncate(size)
+        self.data['inflight'] = []
+        self.save()
+
+    def begin(self, output_paths):
+        """
+        Logs the outputs a commit is about to modify, before modifying them
+        """
+        self.data['inflight'] = list(output_paths)
+        self.save()
+
+    def commit(self, shard_path, fingerprint, event_blocks, output_sizes):
+        """
+        Marks a shard as done together with the outputs it produced, in one manifest write
+        """
+        self.data['shards'][os.path.abspath(shard_path)] = fingerprint
+        for event, block in event_blocks.items():
+            previous = self.data['events'].get(event)
+            self.data['events'][event] = block if previous is None else max(previous, block)
+        self.data['outputs'].update(output_sizes)
+        self.data['inflight'] = []
+        self.data['commits'] += 1
+        self.save()
+
+
+def _append_csv(staged_path, final_path, committed_size):
+    """
+    Appends a staged CSV to the committed part of `final_path`, dropping its header unless the final file is new.
+    A staged header in another column order (a shard whose first batch came from another overload) is remapped
+    to the final file's columns.
+    """
+    header = csv_header(final_path) if committed_size > 0 else None
+    with open(final_path, 'ab') as out:
+        out.truncate(committed_size)
+        out.seek(committed_size)
+        if header is None or csv_header(staged_path) == header:
+            with open(staged_path, 'rb') as staged:
+                if header is not None:
+                    staged.readline()
+                shutil.copyfileobj(staged, out, 2**20)
+        else:
+            for chunk in pd.read_csv(staged_path, dtype=str, keep_default_na=False, chunksize=100000):
+                out.write(align_columns(chunk, header, final_path).to_csv(index=False, header=False).encode())
+        out.flush()
+        os.fsync(out.fileno())
+        return out.tell()
+
+
+def commit_staged_outputs(manifest, staging_dir, output_dir, shard_path, fingerprint, event_blocks):
+    """
+    Moves one shard's staged outputs into place and records the shard in the manifest.
+    Every file under `staging_dir` maps to the same relative path under `output_dir`: CSV outputs are
+    appended to that file from its committed size, Parquet outputs become a new part file in a folder
+    named after it.
+    """
+    moves = {}
+    for root, _, files in os.walk(staging_dir):
+        for name in sorted(files):
+            staged_path = os.path.join(root, name)
+            final_path = os.path.join(output_dir, os.path.relpath(staged_path, staging_dir))
+            if final_path.endswith('.parquet'):
+                dataset = final_path[:-len('.parquet')]
+                final_path = f"{dataset}/part-{manifest.next_part():06d}.parquet"
+            moves[staged_path] = final_path
+
+    manifest.begin(moves.values())
+    output_sizes = {}
+    for staged_path, final_path in moves.items():
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        if final_path.endswith('.parquet'):
+            os.replace(staged_path, final_path)
+            output_sizes[final_path] = os.path.getsize(final_path)
+        else:
+            output_sizes[final_path] = _append_csv(staged_path, final_path, manifest.committed_size(final_path))
+            os.remove(staged_path)
+    manifest.commit(shard_path, fingerprint, event_blocks, output_sizes)
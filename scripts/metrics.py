@@ -0,0 +1,358 @@
+"""
+Per-stage metrics and profiling hooks for the decode scripts.
+
+A long parse run only showed tqdm bars, so there was no telling whether the
+hours went into reading, decoding, enrichment or writing. Stages are wrapped in
+`metrics.stage(name, event)` blocks (or `metrics.timed_iter` for the reads) that
+record wall and CPU time, rows in/out, bytes read/written where a file is
+involved, and the current RSS. The RSS high-water mark is reset at the start of
+every chunk (Linux `/proc/self/clear_refs`), so each chunk record carries the
+peak RSS reached during that chunk, not over the process lifetime. Every record is appended to a JSON-lines
+file as soon as its stage ends, so a crashed run still leaves its metrics, and
+`close()` appends per-stage totals and prints them.
+
+With `path=None` the `Metrics` object is disabled: `stage()` returns one shared
+no-op context, `timed_iter` returns the iterable itself and nothing is measured,
+so the hooks can stay in the scripts at no measurable cost.
+
+Profiling covers only the stages opened with `profile=True` (the decode hot
+path): 'cprofile' runs cProfile in this process and in the decode workers
+(see `worker_profile_dir`) and saves the merged stats to `{path}.prof`; 'sample'
+samples the main thread's stack every `sample_interval` seconds and writes the
+counts as collapsed stacks to `{path}.stacks.txt` (flame graph input).
+"""
+
+import cProfile
+import glob
+import json
+import os
+import pstats
+import resource
+import shutil
+import sys
+import threading
+import time
+from collections import Counter
+
+import pandas as pd
+
+PROFILERS = ('cprofile', 'sample')
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process in MB (None where /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 2**20
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _status_mb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Resets this process's RSS high-water mark, so `peak_rss_mb()` covers only what runs after; False where unsupported
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident set size of this process since it started or since `reset_peak_rss()` (VmHWM), or of its
+    largest exited child process. ru_maxrss is only the fallback: it is never reset and, on Linux, carries a
+    spawning parent's peak over into the child.
+    """
+    if not children:
+        peak = _status_mb('VmHWM')
+        if peak is not None:
+            return peak
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    return usage.ru_maxrss * _MAXRSS_UNIT / 2**20
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+class _NullStage:
+    """
+    What a disabled `Metrics` hands out: enters, exits and ignores any counts set on it
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage:
+    """
+    One measured stage; `rows_out` (and `rows_in`, `bytes_in`, `bytes_out`) can be set inside the block.
+    With `output` (a file path), `bytes_out` defaults to how much the file grew during the stage.
+    """
+
+    def __init__(self, metrics, name, event=None, rows_in=None, bytes_in=None, output=None, profile=False):
+        self.metrics = metrics
+        self.name = name
+        self.event = event
+        self.rows_in, self.rows_out = rows_in, None
+        self.bytes_in, self.bytes_out = bytes_in, None
+        self.output = output
+        self.profile = profile
+
+    def __enter__(self):
+        self._output_size = (_file_size(self.output) or 0) if self.output is not None else None
+        if self.profile:
+            self.metrics._start_profile()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        if self.profile:
+            self.metrics._stop_profile()
+        if self.bytes_out is None and self._output_size is not None:
+            size = _file_size(self.output)
+            self.bytes_out = size - self._output_size if size is not None else None
+        self.metrics.record(self.name, self.event, wall, cpu, self.rows_in, self.rows_out, self.bytes_in, self.bytes_out)
+        return False
+
+
+class _Sampler(threading.Thread):
+    """
+    Counts the main thread's stacks every `interval` seconds while `active` is set
+    """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.target = threading.main_thread().ident
+        self.active = threading.Event()
+        self.stopped = threading.Event()
+        self.stacks = Counter()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.active.wait(0.1)
+            if not self.active.is_set():
+                continue
+            frame = sys._current_frames().get(self.target)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+            time.sleep(self.interval)
+
+
+class Metrics:
+    """
+    Stage metrics written as JSON lines to `path`, or disabled with `path=None`.
+    Args:
+        path (str): JSON-lines metrics file (replaced at start).
+        profile (str): None, 'cprofile' or 'sample', applied to the stages opened with `profile=True`.
+        sample_interval (float): Seconds between stack samples with profile='sample'.
+    """
+
+    def __init__(self, path=None, profile=None, sample_interval=0.005):
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError(f"Unknown profiler {profile}, expected one of {', '.join(PROFILERS)}")
+        self.enabled = path is not None
+        self.path = path
+        self.profile = profile if self.enabled else None
+        self.chunk = 0
+        self._file = open(path, 'w') if self.enabled else None
+        self._totals = {}
+        self._chunk_wall, self._chunk_cpu = time.perf_counter(), time.process_time()
+        # Highest of the chunk peaks, as the high-water mark itself is reset for every chunk
+        self._peak_rss = peak_rss_mb() if self.enabled else None
+        if self.enabled:
+            reset_peak_rss()
+        self._profile_depth = 0
+        self._profiler = cProfile.Profile() if self.profile == 'cprofile' else None
+        self._sampler = None
+        if self.profile == 'sample':
+            self._sampler = _Sampler(sample_interval)
+            self._sampler.start()
+        # Decode workers profile themselves into this folder and the stats are merged by close()
+        self.worker_profile_dir = f"{path}.workers" if self.profile == 'cprofile' else None
+        if self.worker_profile_dir is not None:
+            shutil.rmtree(self.worker_profile_dir, ignore_errors=True)
+            os.makedirs(self.worker_profile_dir)
+
+    def stage(self, name, event=None, rows_in=None, bytes_in=None, output=None, profile=False):
+        """
+        Context measuring one stage (a shared no-op when disabled)
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return Stage(self, name, event, rows_in, bytes_in, output, profile)
+
+    def timed_iter(self, name, iterable, rows=len, event=None, position=None, profile=False):
+        """
+        Yields the items of `iterable`, recording the time spent producing each one as a stage.
+        Args:
+            rows (callable): Rows out of an item.
+            event (callable): Event name of an item, if any.
+            position (callable): Bytes consumed so far (e.g. a file's `tell`), to record bytes read.
+            profile (bool): Profile the production of the items (for generators doing the decoding).
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iterable, rows, event, position, profile)
+
+    def _timed_iter(self, name, iterable, rows, event, position, profile):
+        iterator = iter(iterable)
+        consumed = position() if position is not None else None
+        while True:
+            if profile:
+                self._start_profile()
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                if profile:
+                    self._stop_profile()
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            bytes_in = None
+            if position is not None:
+                now = position()
+                bytes_in, consumed = now - consumed, now
+            self.record(name, event(item) if event is not None else None, wall, cpu, None, rows(item) if rows else None, bytes_in, None)
+            yield item
+
+    def record(self, stage, event, wall, cpu, rows_in=None, rows_out=None, bytes_in=None, bytes_out=None, kind='stage'):
+        """
+        Appends one record; chunk records also carry `peak_rss_mb`, the peak RSS reached during the chunk
+        """
+        if not self.enabled:
+            return
+        entry = {'type': kind, 'stage': stage, 'event': event, 'chunk': self.chunk, 'wall_s': round(wall, 6),
+                 'cpu_s': round(cpu, 6), 'rows_in': rows_in, 'rows_out': rows_out, 'bytes_in': bytes_in,
+                 'bytes_out': bytes_out, 'rss_mb': current_rss_mb(), 'time': time.time()}
+        if kind == 'chunk':
+            entry['peak_rss_mb'] = peak_rss_mb()
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        if kind == 'stage':
+            totals = self._totals.setdefault((stage, event), Counter())
+            totals.update({'calls': 1, 'wall_s': wall, 'cpu_s': cpu, 'rows_in': rows_in or 0, 'rows_out': rows_out or 0,
+                           'bytes_in': bytes_in or 0, 'bytes_out': bytes_out or 0})
+
+    def chunk_done(self, rows_in=None, rows_out=None):
+        """
+        Records a chunk's wall and CPU time, its RSS at the end and its peak RSS, then starts the next chunk
+        """
+        if not self.enabled:
+            return
+        wall, cpu = time.perf_counter(), time.process_time()
+        self.record('chunk', None, wall - self._chunk_wall, cpu - self._chunk_cpu, rows_in, rows_out, kind='chunk')
+        self._peak_rss = max(self._peak_rss, peak_rss_mb())
+        reset_peak_rss()
+        self._chunk_wall, self._chunk_cpu = wall, cpu
+        self.chunk += 1
+
+    def _start_profile(self):
+        self._profile_depth += 1
+        if self._profile_depth > 1:
+            return
+        if self._profiler is not None:
+            self._profiler.enable()
+        elif self._sampler is not None:
+            self._sampler.active.set()
+
+    def _stop_profile(self):
+        self._profile_depth -= 1
+        if self._profile_depth > 0:
+            return
+        if self._profiler is not None:
+            self._profiler.disable()
+        elif self._sampler is not None:
+            self._sampler.active.clear()
+
+    def summary(self):
+        """
+        Totals per (stage, event) as a DataFrame
+        """
+        rows = [{'stage': stage, 'event': event, **totals} for (stage, event), totals in self._totals.items()]
+        columns = ['stage', 'event', 'calls', 'wall_s', 'cpu_s', 'rows_in', 'rows_out', 'bytes_in', 'bytes_out']
+        return pd.DataFrame(rows, columns=columns)
+
+    def _save_profile(self):
+        if self._profiler is not None:
+            stats = pstats.Stats(self._profiler)
+            # Worker stats are saved when the decode pool is closed, before this
+            for worker_stats in sorted(glob.glob(os.path.join(self.worker_profile_dir, '*.prof'))):
+                stats.add(worker_stats)
+            stats.dump_stats(f"{self.path}.prof")
+            print(f"cProfile stats saved to {self.path}.prof; top functions by cumulative time:")
+            stats.sort_stats('cumulative').print_stats(15)
+            shutil.rmtree(self.worker_profile_dir, ignore_errors=True)
+        elif self._sampler is not None:
+            self._sampler.stopped.set()
+            self._sampler.join()
+            with open(f"{self.path}.stacks.txt", 'w') as f:
+                for stack, count in self._sampler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            print(f"Stack samples saved to {self.path}.stacks.txt")
+
+    def close(self):
+        """
+        Appends the per-stage totals to the metrics file, prints them and saves the profiles
+        """
+        if not self.enabled or self._file is None:
+            return
+        summary = self.summary()
+        peak = max(self._peak_rss, peak_rss_mb())
+        for entry in summary.to_dict('records'):
+            self._file.write(json.dumps({'type': 'summary', **entry, 'peak_rss_mb': peak,
+                                         'workers_peak_rss_mb': peak_rss_mb(children=True)}, default=float) + '\n')
+        self._file.close()
+        self._file = None
+        print(f"Stage metrics (also in {self.path}):")
+        print(summary.sort_values('wall_s', ascending=False).to_string(index=False))
+        print(f"Peak RSS: {peak:.0f} MB (largest worker: {peak_rss_mb(children=True):.0f} MB)")
+        self._save_profile()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,319 @@
+# node_logs.py
+# Purpose: Pulls contract logs straight from an Ethereum node with eth_getLogs and writes them as shards in the BigQuery export format.
+# Note:
+# - For near-real-time updates between BigQuery exports: the shards land in pipeline.py's folder_path, and pipeline.py with incremental = True decodes only the new ones.
+# - Block ranges adapt to the node: a range rejected for returning too many results is bisected, and the range grows again after sparse ones.
+# - Throttling (HTTP 429, rate-limit errors) is retried with exponential backoff and does not shrink the range.
+# - Ranges are fetched concurrently over one pooled connection. Block timestamps (and msg_sender, from the block's transactions) are read with JSON-RPC batch requests.
+# - Shards are named node_logs_{first block}_{last block}.json and written atomically, so a re-run resumes after the last complete shard.
+# - Only blocks at least 'confirmations' deep are pulled, so the shards are not affected by chain reorganizations.
+
+import asyncio
+import json
+import os
+import re
+import time
+
+import aiohttp
+from tqdm import tqdm
+
+# Configuration: node, contracts and output folder
+rpc_url = "http://localhost:8545"  # HTTP JSON-RPC endpoint of the node (or a local mock node)
+contract_address = ""  # Contract address, or a list of them; empty for the logs of every contract
+topics = []  # Optional eth_getLogs topic filter, e.g. [[topic0 of Transfer, topic0 of Approval]]
+folder_path = "data/your platform"  # pipeline.py's folder_path, next to the BigQuery shards
+from_block = 0  # First block pulled when the folder has no node shards yet
+to_block = None  # Last block pulled, None for the latest block less 'confirmations'
+confirmations = 12  # Blocks left below the chain head
+shard_blocks = 10000  # Blocks per shard file
+initial_span = 2000  # Blocks per eth_getLogs request at the start, then adapted
+max_span = 100000  # Largest block range per request
+target_logs = 5000  # Ranges returning fewer than half this many logs grow
+concurrency = 4  # Ranges in flight at once
+with_sender = True  # Read the blocks' transactions for msg_sender (heavier than block headers only)
+follow = False  # Keep polling for new blocks instead of stopping at the chain head
+poll_seconds = 12  # Seconds between polls when following
+
+SHARD_PATTERN = re.compile(r'node_logs_(\d+)_(\d+)\.json$')
+# Messages nodes and providers use when a range holds too many logs (geth, erigon, nethermind, Alchemy, Infura, QuickNode)
+_RANGE_ERRORS = ('query returned more than', 'exceeds max results', 'response size exceeded', 'too many logs',
+                 'block range too large', 'block range is too large', 'block range is too wide', 'exceed maximum block range',
+                 'is limited to a')
+# Throttling: retried after a pause, without shrinking the range (EIP-1474 -32005 "limit exceeded" is also used for it)
+_RATE_ERRORS = ('rate limit', 'rate exceeded', 'request count exceeded', 'too many requests', 'throttl', 'compute units')
+_MAX_BACKOFF = 30  # Longest pause between retries, in seconds
+
+
+class RangeTooLarge(Exception):
+    """
+    The node refused an eth_getLogs range for holding too many logs
+    """
+
+
+def _message(error):
+    return (str(error.get('message', '')) if isinstance(error, dict) else str(error)).lower()
+
+
+def is_range_error(error):
+    """
+    Whether a JSON-RPC error object asks for a smaller block range
+    """
+    return any(p in _message(error) for p in _RANGE_ERRORS)
+
+
+def is_rate_limited(error):
+    """
+    Whether a JSON-RPC error object reports throttling, to be retried as is after a pause
+    """
+    if is_range_error(error):
+        return False
+    code = error.get('code') if isinstance(error, dict) else None
+    return code in (-32005, 429) or any(p in _message(error) for p in _RATE_ERRORS)
+
+
+def _rate_limited_reply(body):
+    """
+    Whether a reply, or any reply in a batch, is a throttling error
+    """
+    replies = body if isinstance(body, list) else [body]
+    return any(isinstance(r, dict) and 'error' in r and is_rate_limited(r['error']) for r in replies)
+
+
+def shard_path(folder, first, last):
+    return os.path.join(folder, f"node_logs_{first:010d}_{last:010d}.json")
+
+
+def next_block(folder, default=from_block):
+    """
+    Block after the last one covered by the node shards in `folder`
+    """
+    lasts = [int(m.group(2)) for m in map(SHARD_PATTERN.match, os.listdir(folder) if os.path.isdir(folder) else []) if m]
+    return max(lasts) + 1 if lasts else default
+
+
+def to_record(log, block):
+    """
+    One eth_getLogs log as a BigQuery logs row (plus msg_sender), given its block from eth_getBlockByNumber
+    """
+    tx_hash = log['transactionHash']
+    return {
+        'log_index': int(log['logIndex'], 16),
+        'transaction_hash': tx_hash,
+        'transaction_index': int(log['transactionIndex'], 16),
+        'address': log['address'].lower(),
+        'data': log['data'],
+        'topics': log['topics'],
+        'block_timestamp': time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(int(block['timestamp'], 16))),
+        'block_number': int(log['blockNumber'], 16),
+        'block_hash': log['blockHash'],
+        'msg_sender': block['senders'].get(tx_hash) if block['senders'] is not None else None,
+    }
+
+
+class NodeLogSource:
+    """
+    eth_getLogs paged by block range, with the range adapted to the node's result limit.
+    Args:
+        rpc_url (str): HTTP JSON-RPC endpoint.
+        address (str or list): Contract address(es) to filter on, None for all.
+        topics (list): eth_getLogs topic filter, None for none.
+        span (int): Initial blocks per request.
+        max_span (int): Largest blocks per request.
+        target_logs (int): A range returning fewer than half this many logs doubles the next span.
+        concurrency (int): Requests in flight at once, over pooled connections.
+        with_sender (bool): Add msg_sender from the blocks' transactions.
+        batch_size (int): Block reads per JSON-RPC batch request.
+        timeout (float): Seconds allowed per request.
+        retries (int): Extra attempts of a request that failed in transport or was throttled (HTTP 429 or a
+            rate-limit error), with exponential backoff.
+    """
+
+    def __init__(self, rpc_url, address=None, topics=None, span=initial_span, max_span=max_span, target_logs=target_logs,
+                 concurrency=concurrency, with_sender=with_sender, batch_size=100, timeout=60, retries=6):
+        self.rpc_url = rpc_url
+        self.address = address or None
+        self.topics = topics or None
+        self.span = span
+        self.max_span = max_span
+        self.target_logs = target_logs
+        self.concurrency = concurrency
+        self.with_sender = with_sender
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.requests = 0
+        self.bisections = 0
+        self.throttled = 0
+
+    def _session(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def _post(self, session, payload):
+        """
+        JSON reply to a request or batch; transport failures and throttling are retried with backoff, then raised
+        """
+        for attempt in range(self.retries + 1):
+            pause = min(_MAX_BACKOFF, 0.5 * 2**attempt)
+            try:
+                self.requests += 1
+                async with session.post(self.rpc_url, json=payload) as response:
+                    if response.status == 413:
+                        # Reply too large for the provider's gateway
+                        return {'error': {'code': 413, 'message': 'response size exceeded'}}
+                    if response.status == 429:
+                        retry_after = response.headers.get('Retry-After', '')
+                        pause = min(_MAX_BACKOFF, float(retry_after)) if retry_after.isdigit() else pause
+                        error = "HTTP 429 (throttled)"
+                    else:
+                        response.raise_for_status()
+                        body = await response.json(content_type=None)
+                        if not _rate_limited_reply(body):
+                            return body
+                        error = f"throttled: {body}"
+                self.throttled += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+            if attempt == self.retries:
+                raise ConnectionError(f"JSON-RPC request to {self.rpc_url} failed after {self.retries} retries: {error}")
+            await asyncio.sleep(pause)
+
+    async def _call(self, session, method, params):
+        reply = await self._post(session, {'jsonrpc': '2.0', 'id': 0, 'method': method, 'params': params})
+        if 'error' in reply:
+            raise ValueError(f"{method} failed: {reply['error']}")
+        return reply['result']
+
+    async def latest_block(self, session):
+        return int(await self._call(session, 'eth_blockNumber', []), 16)
+
+    async def _get_logs(self, session, first, last):
+        query = {'fromBlock': hex(first), 'toBlock': hex(last)}
+        if self.address is not None:
+            query['address'] = self.address
+        if self.topics is not None:
+            query['topics'] = self.topics
+        reply = await self._post(session, {'jsonrpc': '2.0', 'id': 0, 'method': 'eth_getLogs', 'params': [query]})
+        if 'error' in reply:
+            if is_range_error(reply['error']):
+                raise RangeTooLarge(reply['error'])
+            raise ValueError(f"eth_getLogs {first}-{last} failed: {reply['error']}")
+        return reply['result']
+
+    async def _fetch_part(self, session, first, last):
+        """
+        Logs of blocks first..last, walking the part with a span halved on refusals and doubled after sparse ranges
+        """
+        logs = []
+        span = self.span
+        start = first
+        while start <= last:
+            end = min(start + span - 1, last)
+            try:
+                part = await self._get_logs(session, start, end)
+            except RangeTooLarge as e:
+                if start == end:
+                    raise ValueError(f"Block {start} alone holds more logs than the node returns: {e}") from e
+                self.bisections += 1
+                span = max(1, (end - start + 1) // 2)
+                continue
+            logs.extend(log for log in part if not log.get('removed'))
+            start = end + 1
+            if len(part) < self.target_logs // 2:
+                span = min(span * 2, self.max_span)
+            # The next parts start from the span learned here
+            self.span = span
+        return logs
+
+    async def _blocks(self, session, numbers):
+        """
+        block number -> {'hash', 'timestamp', 'senders' (tx hash -> from, None without with_sender)}, in batch requests
+        """
+        numbers = sorted(numbers)
+        batches = [numbers[i:i + self.batch_size] for i in range(0, len(numbers), self.batch_size)]
+
+        async def read(batch):
+            payload = [{'jsonrpc': '2.0', 'id': i, 'method': 'eth_getBlockByNumber', 'params': [hex(n), self.with_sender]}
+                       for i, n in enumerate(batch)]
+            replies = await self._post(session, payload)
+            if not isinstance(replies, list):
+                raise ValueError(f"eth_getBlockByNumber batch rejected: {replies.get('error', replies)}")
+            by_id = {reply.get('id'): reply for reply in replies}
+            blocks = {}
+            for i, number in enumerate(batch):
+                block = (by_id.get(i) or {}).get('result')
+                if block is None:
+                    raise ValueError(f"Block {number} missing from the node: {by_id.get(i)}")
+                senders = {tx['hash']: tx['from'] for tx in block['transactions']} if self.with_sender else None
+                blocks[number] = {'hash': block['hash'], 'timestamp': block['timestamp'], 'senders': senders}
+            return blocks
+
+        blocks = {}
+        for part in await asyncio.gather(*(read(batch) for batch in batches)):
+            blocks.update(part)
+        return blocks
+
+    async def _fetch(self, session, first, last):
+        """
+        Records of blocks first..last sorted by (block_number, log_index); the range is split between concurrent requests
+        """
+        parts = min(self.concurrency, last - first + 1)
+        size = -(-(last - first + 1) // parts)
+        bounds = [(start, min(start + size - 1, last)) for start in range(first, last + 1, size)]
+        logs = [log for part in await asyncio.gather(*(self._fetch_part(session, a, b) for a, b in bounds)) for log in part]
+        blocks = await self._blocks(session, {int(log['blockNumber'], 16) for log in logs})
+        records = []
+        for log in logs:
+            block = blocks[int(log['blockNumber'], 16)]
+            if block['hash'] != log['blockHash']:
+                raise ValueError(f"Block {int(log['blockNumber'], 16)} changed while reading it (reorg); "
+                                 f"re-run with more confirmations")
+            records.append(to_record(log, block))
+        records.sort(key=lambda r: (r['block_number'], r['log_index']))
+        return records
+
+    def fetch(self, first, last):
+        """
+        BigQuery-shaped records (dicts) of the logs in blocks first..last, in block and log order
+        """
+        async def run():
+            async with self._session() as session:
+                return await self._fetch(session, first, last)
+        return asyncio.run(run())
+
+    def write_shards(self, folder, first=None, last=None, blocks_per_shard=shard_blocks, confirmations=confirmations):
+        """
+        Writes the logs from `first` (default: after the last node shard in `folder`) to `last` (default: the
+        chain head less `confirmations`) as newline-delimited JSON shards of `blocks_per_shard` blocks.
+        Returns the paths written.
+        """
+        async def run():
+            async with self._session() as session:
+                end = last if last is not None else await self.latest_block(session) - confirmations
+                start = first if first is not None else next_block(folder)
+                paths = []
+                pbar = tqdm(total=max(0, end - start + 1), desc="Pulling blocks", unit='block')
+                for window in range(start, end + 1, blocks_per_shard):
+                    window_end = min(window + blocks_per_shard - 1, end)
+                    records = await self._fetch(session, window, window_end)
+                    path = shard_path(folder, window, window_end)
+                    with open(f"{path}.tmp", 'w') as f:
+                        for record in records:
+                            f.write(json.dumps(record) + '\n')
+                    os.replace(f"{path}.tmp", path)
+                    paths.append(path)
+                    pbar.update(window_end - window + 1)
+                pbar.close()
+                return paths
+        os.makedirs(folder, exist_ok=True)
+        return asyncio.run(run())
+
+
+if __name__ == "__main__":
+    source = NodeLogSource(rpc_url, contract_address, topics)
+    while True:
+        paths = source.write_shards(folder_path, None, to_block)
+        print(f"{len(paths)} shards written to {folder_path} ({source.requests} requests, {source.bisections} ranges bisected)")
+        if not follow or to_block is not None:
+            break
+        time.sleep(poll_seconds)
@@ -3,54 +3,72 @@
 # Note: 
 # - Run preprocess_jsonlogs.py before executing this script.
 
+import os
 import pandas as pd 
-from utils import df_log_to_receipt, flatten_attribute_dict
-from pandarallel import pandarallel
-from web3 import Web3
-from datetime import datetime
-from hexbytes import HexBytes
+from decode_pool import DecodePool
+from block_index import BlockIndex
+from sinks import make_sink
+from external_sort import OrderedSink
+from aggregate import Aggregation, Counterparties, NetFlow, PeriodTotals
+from schema import OutputSchema
+from metrics import Metrics
 from tqdm import tqdm 
 from preprocess_jsonlogs import output_csv, contract_name, parsed_output, abi
-import ast 
 
-# Initialize Pandarallel for parallel processing without a progress bar
-pandarallel.initialize(progress_bar=False)
+# Per-stage metrics (wall/CPU time, rows, bytes, RSS) written as JSON lines, with a summary at the end
+metrics_path = None  # e.g. f"{parsed_output}/{contract_name}_metrics.jsonl"; None turns the instrumentation off
+profile = None  # Profiling of the decode stage: None, 'cprofile' (also inside the decode workers) or 'sample' (stack sampling)
+metrics = Metrics(metrics_path, profile)
+
+# Decoder processes for events that need row-by-row decoding, started once with the ABI decoders built in each
+decode_workers = None  # Number of worker processes, None for one per CPU, 0 to decode in this process
+decode_batch_rows = 20000  # Logs per task sent to a worker
+pool = DecodePool(abi, decode_workers, decode_batch_rows, profile_dir=metrics.worker_profile_dir)
+
+# Output format for the decoded events: 'csv' (one CSV per event), 'parquet' (typed columns, row groups by block range)
+# or 'sqlite' (one table per event in {contract_name}.sqlite, indexed on block, transaction and indexed arguments)
+output_format = 'csv'
+ordered_output = False  # Sort each event file by (block_number, log_index) instead of keeping the raw log order
+
+# Formats of the decoded arguments, applied per column from the event ABI (binary formats are meant for Parquet)
+output_schema = OutputSchema(bytes_format='hex',  # bytes/bytesN: 'hex', 'binary' or 'fixed'
+                             address_format='checksum',  # address: 'checksum', 'lower', 'binary' or 'fixed' (S20)
+                             uint_format='int',  # integers wider than 64 bits: 'int', 'decimal', 'float', 'fixed' (S32) or 'limbs'
+                             hash_format='hex',  # transactionHash/blockHash: 'hex' or 'fixed' (S32)
+                             categorical=False)  # event and contract address as categoricals
+
+# Aggregates computed from the decoded events during the run, written to {contract_name}_agg_{name}.csv
+aggregate = False
+aggregation = Aggregation([NetFlow('Transfer', 'from', 'to', 'value'),  # Per-holder inflow, outflow and net balance
+                           PeriodTotals('day', {'Transfer': ['value']}),  # Event counts (and Transfer volume) per day
+                           Counterparties('Transfer', 'from', 'to')]) if aggregate else None  # Distinct counterparties per address
 
 # Loading the raw log data with event names
-df = pd.read_csv(output_csv, dtype={'log_index':'int', 'transaction_hash':'str', 'transaction_index':'int', 
-                                    'address':'str', 'data':'str', 'topics':'str', 'block_timestamp':'str', 
-                                    'block_number':'int', 'block_hash':'str', 'event':'str', 'msg_sender':'str'}, engine='pyarrow')
+with metrics.stage('read_csv', bytes_in=os.path.getsize(output_csv)) as stage:
+    df = pd.read_csv(output_csv, dtype={'log_index':'int', 'transaction_hash':'str', 'transaction_index':'int', 
+                                        'address':'str', 'data':'str', 'topic0':'str', 'block_timestamp':'str', 
+                                        'block_number':'int', 'block_hash':'str', 'event':'str', 'msg_sender':'str'}, engine='pyarrow')
+    stage.rows_out = len(df)
 
 # Removing logs where the event type is 'Unknown'
 df.drop(df[df['event'] == 'Unknown'].index, inplace=True)
 df.reset_index(inplace=True)
 
-# Extracting timestamp and ensuring one-to-one relation with transaction hash
-df_timestamp = (
-    df[['transaction_hash', 'block_timestamp', 'msg_sender']]
-    .drop_duplicates('transaction_hash')
-    .rename(columns={'transaction_hash': 'transactionHash'})
-)
+# Block timestamps and msg_sender per transaction, kept in a block index persisted next to the outputs
+# (sorted NumPy arrays looked up by block number and binary transaction hash instead of a merge on hex strings)
+block_index = BlockIndex(f"{parsed_output}/{contract_name}_block_index.npz")
+with metrics.stage('block_index', rows_in=len(df)):
+    block_index.update(df)
+    block_index.save()
 
-# Convert the 'block_timestamp' column to datetime
-# Assuming the timezone is always UTC
-df_timestamp['block_timestamp'] = pd.to_datetime(df_timestamp['block_timestamp'], utc=True)
+# # Date column (optional if you need less time precision), to add after the enrichment in the event loop:
+# df_temp['date'] = df_temp['block_timestamp'].dt.strftime("%Y-%m-%d") # Modify here for different date formats or precision
 
-# Convert the datetime to Unix timestamp (seconds since the Unix epoch)
-df_timestamp['block_timestamp_unix'] = df_timestamp['block_timestamp'].parallel_apply(lambda x: int(x.timestamp()))
-
-# # Function to parse and format the date from the timestamp (optional if you need less time precision)
-# def parse_date(timestamp):
-#     return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S %Z").strftime("%Y-%m-%d") # Modify here for different date formats or precision
-
-# # Apply the parse_date function to 'block_timestamp'
-# df_timestamp['date'] = df_timestamp['block_timestamp'].parallel_apply(parse_date)
-# df_timestamp.drop(columns=['block_timestamp'], inplace=True)
-
-# Initialize the Web3 contract object (local operations only, no node required)
-w3 = Web3()
-contract_address = Web3.to_checksum_address(df['address'][0])
-contract = w3.eth.contract(address=contract_address, abi=abi)
+# One output file per event
+sink = make_sink(output_format, parsed_output, contract_name, abi, output_schema=output_schema)
+if ordered_output:
+    # Events are sorted as sorted runs spilled next to the outputs, merged when the sink is closed
+    sink = OrderedSink(sink, spill_dir=parsed_output)
 
 # Processing each unique event
 grouped_df = df.groupby('event')
@@ -58,32 +76,37 @@ grouped_df = df.groupby('event')
 for evt, group in tqdm(grouped_df, desc='Processing Events', unit='event'):
     tqdm.write(f'Parsing {evt} event:')
 
-    # Process logs and flatten the resulting AttributeDict
-    flattened_result = group.parallel_apply(lambda row: flatten_attribute_dict(df_log_to_receipt(row, contract, evt)), axis=1)
-
-    # Convert the list of dictionaries into a DataFrame
-    df_temp = pd.DataFrame(flattened_result.tolist())
-
-    # Converting hex byte columns to hexadecimal strings
-    hex_columns = ['transactionHash', 'address', 'blockHash']
-    df_temp[hex_columns] = df_temp[hex_columns].parallel_applymap(lambda x: x.hex())
-
-    # Merging with the timestamp data
-    df_temp = pd.merge(df_temp, df_timestamp, on='transactionHash', how='inner')
-
-    # Check each cell in the first row for a backslash to identify un-hexed value
-    byte_string_columns = []
-    for col in df_temp.columns:
-        if '\\' in str(df_temp[col].iloc[0]):
-            byte_string_columns.append(col)
-    
-    # Byte string to byte then hex it
-    for col in byte_string_columns:
-        df_temp[col] = df_temp[col].parallel_apply(lambda x: ast.literal_eval(str(x)))
-        df_temp[col] = df_temp[col].parallel_apply(lambda x: HexBytes(x).hex())
-
-    # Saving the processed data to a CSV file
-    tqdm.write(f'{evt} event parsing finished, saving to {parsed_output}/{contract_name}_{evt}.csv:')
-    df_temp.to_csv(f'{parsed_output}/{contract_name}_{evt}.csv', index=False)
-
-    tqdm.write(f'{evt} event saved to {parsed_output}/{contract_name}_{evt}.csv.')
\ No newline at end of file
+    # Overloaded event names share a name but not a topic0: each overload is decoded and formatted with its own ABI
+    for topic0, logs in group.groupby(group['topic0'].str.lower(), sort=False):
+        # Events with only static arguments are decoded column-wise in one go, others row by row in the decode workers
+        # (transactionHash, address and blockHash come out as hex strings)
+        with metrics.stage('decode', evt, rows_in=len(logs), profile=True) as stage:
+            df_temp = pool.decode_frame(logs)
+            stage.rows_out = len(df_temp)
+
+        # Adding block_timestamp, msg_sender and block_timestamp_unix from the block index
+        with metrics.stage('enrich', evt, rows_in=len(df_temp)):
+            df_temp = block_index.enrich(df_temp)
+
+        # Convert argument columns to the output formats chosen from the event ABI
+        with metrics.stage('format', evt, rows_in=len(df_temp)):
+            df_temp = output_schema.apply(pool.registry[topic0].abi, df_temp)
+
+        # Updating the aggregates from the decoded events
+        if aggregation is not None:
+            with metrics.stage('aggregate', evt, rows_in=len(df_temp)):
+                aggregation.update(evt, df_temp)
+
+        # Saving the processed data
+        tqdm.write(f'{evt} event parsing finished, saving to {sink.path(evt)}:')
+        with metrics.stage('write', evt, rows_in=len(df_temp), output=sink.path(evt)):
+            sink.write(evt, df_temp)
+
+    tqdm.write(f'{evt} event saved to {sink.path(evt)}.')
+
+with metrics.stage('close_sink'):
+    sink.close()
+pool.close()
+if aggregation is not None:
+    aggregation.write_results(parsed_output, contract_name)
+metrics.close()
@@ -5,25 +5,57 @@
 # - It employs DataFrame chunking and explicit garbage collection to handle large datasets effectively while maintaining optimal RAM usage.
 
 import pandas as pd 
-from utils import df_log_to_receipt, flatten_attribute_dict, count_lines_in_file
-from web3 import Web3
+from utils import count_lines_in_file
+from decode_pool import DecodePool
+from block_index import BlockIndex
+from sinks import make_sink
+from external_sort import OrderedSink
+from aggregate import Aggregation, Counterparties, NetFlow, PeriodTotals
+from schema import OutputSchema
+from metrics import Metrics
 from tqdm import tqdm 
-from pandarallel import pandarallel
 import gc
-import os
-from hexbytes import HexBytes
 from preprocess_jsonlogs_RamEz import processed_output_csv, contract_name, parent_name, abi
 import math 
-import ast 
 
 
-# Initialize Pandarallel for efficient parallel processing
-pandarallel.initialize(progress_bar=False) 
-
-# Initialize Web3 and set up contract
-w3 = Web3()
-contract_address = Web3.to_checksum_address('') # Contract address (leave empty if ABI is cached in previous script)
-contract = w3.eth.contract(address=contract_address, abi=abi)
+# Per-stage metrics (wall/CPU time, rows, bytes, RSS per chunk) written as JSON lines, with a summary at the end
+metrics_path = None  # e.g. f"{parent_name}/{contract_name}_metrics.jsonl"; None turns the instrumentation off
+profile = None  # Profiling of the decode stage: None, 'cprofile' (also inside the decode workers) or 'sample' (stack sampling)
+metrics = Metrics(metrics_path, profile)
+
+# Decoder processes started once for the whole run, each compiling the ABI decoders at startup
+# (events with only static arguments are decoded column-wise in this process instead)
+decode_workers = None  # Number of worker processes, None for one per CPU, 0 to decode in this process
+decode_batch_rows = 20000  # Logs per task sent to a worker
+pool = DecodePool(abi, decode_workers, decode_batch_rows, profile_dir=metrics.worker_profile_dir)
+
+# Output format for the decoded events: 'csv' (appended chunk by chunk), 'parquet' (typed columns, row groups by block range)
+# or 'sqlite' (one table per event in {contract_name}.sqlite, indexed once all chunks are loaded)
+# Event files and tables are rewritten on each run, so re-running after a crash does not duplicate rows
+output_format = 'csv'
+ordered_output = False  # Sort each event file by (block_number, log_index): chunks are spilled as sorted runs and merged at the end
+sort_run_rows = 1000000  # Decoded rows sorted in memory per run
+
+# Formats of the decoded arguments, applied per column from the event ABI (binary formats are meant for Parquet)
+output_schema = OutputSchema(bytes_format='hex',  # bytes/bytesN: 'hex', 'binary' or 'fixed'
+                             address_format='checksum',  # address: 'checksum', 'lower', 'binary' or 'fixed' (S20)
+                             uint_format='int',  # integers wider than 64 bits: 'int', 'decimal', 'float', 'fixed' (S32) or 'limbs'
+                             hash_format='hex',  # transactionHash/blockHash: 'hex' or 'fixed' (S32)
+                             categorical=False)  # event and contract address as categoricals
+
+# Aggregates computed from the decoded events during the run, written to {contract_name}_agg_{name}.csv
+aggregate = False
+aggregation = Aggregation([NetFlow('Transfer', 'from', 'to', 'value'),  # Per-holder inflow, outflow and net balance
+                           PeriodTotals('day', {'Transfer': ['value']}),  # Event counts (and Transfer volume) per day
+                           Counterparties('Transfer', 'from', 'to')]) if aggregate else None  # Distinct counterparties per address
+
+sink = make_sink(output_format, parent_name, contract_name, abi, output_schema=output_schema)
+if ordered_output:
+    sink = OrderedSink(sink, sort_run_rows, spill_dir=parent_name)
+
+# Block timestamps and msg_sender per transaction, grown chunk by chunk and persisted across runs
+block_index = BlockIndex(f"{parent_name}/{contract_name}_block_index.npz")
 
 # Define the chunk size for processing
 chunk_size = 500000  # Adjust based on performance and available memory
@@ -31,55 +63,57 @@ total_rows = count_lines_in_file(processed_output_csv)  # Total rows including h
 total_chunks = math.ceil((total_rows - 1) / chunk_size)  # Subtract 1 for header, then calculate total chunks
 
 # Process data in chunks
-for df_chunk in tqdm(pd.read_csv(processed_output_csv, dtype=str, 
-                                            chunksize=chunk_size), total=total_chunks, desc=f"Parsing {contract_name} logs:"):
+csv_file = open(processed_output_csv, 'rb')
+chunks = metrics.timed_iter('read_csv', pd.read_csv(csv_file, dtype=str, chunksize=chunk_size), position=csv_file.tell)
+for df_chunk in tqdm(chunks, total=total_chunks, desc=f"Parsing {contract_name} logs:"):
+    rows_in = len(df_chunk)
     
     df_chunk.drop(df_chunk[df_chunk['event'] == 'Unknown'].index, inplace=True)
 
+    with metrics.stage('block_index', rows_in=len(df_chunk)):
+        block_index.update(df_chunk)
+
     # Group by 'event'
     for event_name, group in df_chunk.groupby('event'):
-        # Process timestamps and merge with group data
-        df_timestamp = (
-            group[['transaction_hash', 'block_timestamp']]
-            .drop_duplicates('transaction_hash')
-            .rename(columns={'transaction_hash': 'transactionHash'})
-        )
-
-        # Process each log entry
-        processed_data = group.parallel_apply(lambda row: flatten_attribute_dict(df_log_to_receipt(row, contract, event_name)), axis=1)
-        df_temp = pd.DataFrame(processed_data.tolist())
-
-        # Convert hex columns to hex strings
-        hex_columns = ['transactionHash', 'address', 'blockHash']
-        df_temp[hex_columns] = df_temp[hex_columns].parallel_applymap(lambda x: x.hex() if x else x)
-        df_temp = pd.merge(df_temp, df_timestamp, on='transactionHash', how='inner')
-
-        # Check each cell in the first row for a backslash
-        byte_string_columns = []
-        for col in df_temp.columns:
-            if '\\' in str(df_temp[col].iloc[0]):
-                byte_string_columns.append(col)
-        
-        # Byte string to byte then hex it
-        for col in byte_string_columns:
-            df_temp[col] = df_temp[col].parallel_apply(lambda x: ast.literal_eval(str(x)))
-            df_temp[col] = df_temp[col].parallel_apply(lambda x: HexBytes(x).hex())
-
-        # File path for the event
-        event_file = f"{parent_name}/{contract_name}_{event_name}.csv"
-
-        # Write processed data to CSV
-        with open(event_file, mode='a' if os.path.exists(event_file) else 'w', newline='') as file:
-            df_temp.to_csv(file, index=False, header=not os.path.exists(event_file))
-
-        tqdm.write(f'CSV file for {event_name} saved')
+        # Overloaded event names share a name but not a topic0: each overload is decoded and formatted with its own ABI
+        for topic0, logs in group.groupby(group['topic0'].str.lower(), sort=False):
+            # Decode static-typed events column-wise, otherwise each log entry in the decode workers
+            # (hash and address columns are decoded straight to hex strings)
+            with metrics.stage('decode', event_name, rows_in=len(logs), profile=True) as stage:
+                df_temp = pool.decode_frame(logs)
+                stage.rows_out = len(df_temp)
+            # Add block_timestamp, msg_sender and block_timestamp_unix from the block index
+            with metrics.stage('enrich', event_name, rows_in=len(df_temp)):
+                df_temp = block_index.enrich(df_temp)
+
+            # Convert argument columns to the output formats chosen from the event ABI
+            with metrics.stage('format', event_name, rows_in=len(df_temp)):
+                df_temp = output_schema.apply(pool.registry[topic0].abi, df_temp)
+
+            # Update the aggregates and write processed data for the event
+            if aggregation is not None:
+                with metrics.stage('aggregate', event_name, rows_in=len(df_temp)):
+                    aggregation.update(event_name, df_temp)
+            with metrics.stage('write', event_name, rows_in=len(df_temp), output=sink.path(event_name)):
+                sink.write(event_name, df_temp)
+
+        tqdm.write(f'{event_name} chunk saved to {sink.path(event_name)}')
 
         # Clear memory
-        del group, df_temp, processed_data
+        del group, logs, df_temp
         gc.collect()
 
     # Clear memory
+    metrics.chunk_done(rows_in, len(df_chunk))
     del df_chunk
     gc.collect()
 
+with metrics.stage('close_sink'):
+    sink.close()
+csv_file.close()
+pool.close()
+if aggregation is not None:
+    aggregation.write_results(parent_name, contract_name)
+block_index.save()
+metrics.close()
 tqdm.write('All files processed')
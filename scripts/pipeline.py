@@ -0,0 +1,394 @@
+# pipeline.py
+# Purpose: Decodes Google BigQuery JSON log shards straight into per-event outputs in a single streaming pass.
+# Note:
+# - Replaces the preprocess_jsonlogs*.py -> raw CSV -> parse_allevents*.py round trip; those scripts remain useful for inspecting intermediate data.
+# - Records are read line by line (or parsed by 'ingest_workers' processes, see ingest.py), batched, classified by topic0, decoded and handed to the output sink, so RAM is bounded by 'batch_size'.
+# - With 'multi_contract' set, logs are routed by (address, topic0) so one pass decodes every contract of a protocol.
+# - Shards may be gzip or zstd compressed (e.g. a BigQuery export with GZIP compression); they are decompressed while streaming.
+# - With 'block_range' or 'only_events' set, shard indexes (see shard_index.py) let the run skip shards and byte ranges that cannot match.
+# - With 'deduplicate' set, logs repeated across overlapping exports are dropped on (transaction_hash, log_index) (see dedup.py).
+# - With 'aggregate' set, balances, daily counts and counterparties are computed from the decoded batches during the run (see aggregate.py).
+# - With 'ordered_output' set, every event file is sorted by (block_number, log_index) through an external sort (see external_sort.py).
+# - With 'metrics_path' set, wall/CPU time, rows and bytes of every stage are written as JSON lines, with optional profiling of the decode (see metrics.py).
+# - With 'incremental' set, a manifest records the shards already decoded; re-runs only decode new or changed shards and resume after a crash.
+
+import os
+import json
+import shutil
+from collections import Counter
+
+import pandas as pd
+from tqdm import tqdm
+from web3 import Web3
+
+from utils import get_cached_abi, get_cached_abis
+from decoder import ContractRouter, with_topic_columns
+from sinks import PartitionedSink, make_sink
+from manifest import Manifest, commit_staged_outputs, shard_fingerprint
+from ingest import is_shard, iter_shard_frames, iter_shard_tables, open_shard, total_bytes
+from shard_index import load_index, select_logs, select_spans
+from schema import OutputSchema
+from dedup import LogDeduplicator
+from external_sort import OrderedSink
+from aggregate import Aggregation, Counterparties, NetFlow, PeriodTotals
+from metrics import Metrics
+from proxies import ProxyResolver
+
+# Configuration: data folder, contract name and output settings
+folder_path = "data/your platform"
+file_type = ".json"
+contract_name = "your platform"
+contract_address = ""  # ABI address; leave empty to use the address of the first log
+multi_contract = False  # Decode every contract in the export with its own ABI, outputs in one folder per contract
+contract_labels = {}  # Optional address: folder name for multi-contract outputs (defaults to the address)
+abi_addresses = {}  # Optional address: address to take the ABI from (e.g. a proxy's implementation)
+rpc_url = ""  # JSON-RPC endpoint to resolve proxies to their implementation's ABI (cached in abis/proxies.json), empty to skip
+output_format = 'csv'  # 'csv', 'parquet' or 'sqlite' (one indexed table per event, see sinks.SqliteSink)
+bytes_format = 'hex'  # bytes/bytesN arguments: 'hex', 'binary' or 'fixed' (Parquet)
+address_format = 'checksum'  # address arguments: 'checksum', 'lower', 'binary' or 'fixed' (Parquet)
+uint_format = 'int'  # integers wider than 64 bits: 'int', 'decimal', 'float', 'fixed' (S32) or 'limbs' (4 x uint64), see compact.py
+hash_format = 'hex'  # transactionHash/blockHash: 'hex' or 'fixed' (S32)
+categorical = False  # Event names and contract addresses as categoricals
+batch_size = 500000  # Logs decoded per batch, adjust to the available memory
+ingest_workers = 0  # Parse shards in this many processes (0 reads them in the main process)
+memory_budget = 2 * 2**30  # Bytes of parsed batches allowed to wait for the decoder when ingest_workers > 0
+build_index = True  # Write a block-range index next to each shard parsed by the ingest workers
+block_range = None  # (first, last) block, inclusive, to re-decode only part of the export
+only_events = []  # Event names or topic0 hashes to re-decode, empty for all
+deduplicate = True  # Drop logs already seen on (transaction_hash, log_index), across runs in incremental mode
+dedup_memory = 256 * 2**20  # Bytes of deduplication keys kept in memory, the rest spills to disk
+ordered_output = False  # Sort each event file by (block_number, log_index), spilling sorted runs to disk
+sort_run_rows = 1000000  # Rows sorted in memory per run when ordered_output is set
+aggregate = False  # Compute the aggregates below while decoding, written to {contract_name}_agg_{name}.csv
+aggregates = [NetFlow('Transfer', 'from', 'to', 'value'),  # Per-holder inflow, outflow and net balance
+              PeriodTotals('day', {'Transfer': ['value']}),  # Event counts (and Transfer volume) per contract and day
+              Counterparties('Transfer', 'from', 'to')]  # Distinct counterparties per address
+metrics_path = None  # JSON-lines file of per-stage wall/CPU time, rows, bytes and RSS (e.g. f"{parsed_output}/{contract_name}_metrics.jsonl"), None for none
+profile = None  # Profiling of the decode stage when metrics_path is set: None, 'cprofile' or 'sample' (stack sampling)
+incremental = False  # Skip shards recorded in the manifest and commit outputs shard by shard
+verify_checksums = False  # Also compare shard SHA-256 (slower) rather than only size and mtime
+
+parent_name = os.path.basename(os.path.dirname(folder_path))
+parsed_output = f"{parent_name}/{contract_name}_parsed"
+
+
+def list_shards(folder, suffix=file_type):
+    """
+    Sorted paths of the export shards in a folder, plain or gzip/zstd compressed
+    """
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if is_shard(f, suffix))
+
+
+def contract_addresses(file_paths, workers=None, index=build_index):
+    """
+    Lower-case addresses of the contracts in the export: read from the shard indexes, with one pass over
+    the shards that have no current index (which builds theirs when `index` is set)
+    """
+    addresses = set()
+    unindexed = []
+    for path in file_paths:
+        shard = load_index(path)
+        if shard is None:
+            unindexed.append(path)
+        else:
+            addresses.update(shard['address'])
+    if unindexed:
+        for _, table in tqdm(iter_shard_tables(unindexed, workers or 1, index=index), desc="Listing contracts", unit='batch'):
+            addresses.update(a.lower() for a in table.column('address').unique().to_pylist() if a)
+    return addresses
+
+
+def iter_json_records(file_paths):
+    """
+    Yields one log record (dict) per line of the newline-delimited JSON shards
+    """
+    for file_path in file_paths:
+        with open_shard(file_path) as text_file:
+            for line in text_file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"Error parsing {file_path}: {str(e)}")
+
+
+def iter_batches(records, size):
+    """
+    Groups an iterator of records into DataFrames of at most `size` rows, with topic0..topic3 columns
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield with_topic_columns(pd.DataFrame(batch))
+            batch = []
+    if batch:
+        yield with_topic_columns(pd.DataFrame(batch))
+
+
+def enrich_events(decoded, logs):
+    """
+    Adds the transaction-level columns parse_allevents.py merges in from the raw logs.
+    Rows are aligned one to one with `logs`, so no join on transactionHash is needed.
+    """
+    block_timestamp = pd.to_datetime(logs['block_timestamp'].to_numpy(), utc=True)
+    decoded['block_timestamp'] = block_timestamp
+    if 'msg_sender' in logs.columns:
+        decoded['msg_sender'] = logs['msg_sender'].to_numpy()
+    decoded['block_timestamp_unix'] = (block_timestamp - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    return decoded
+
+
+def decode_batch(df, router, output_schema):
+    """
+    Decodes one batch of raw logs carrying an 'event' column from `router.classify`, converting the
+    argument columns with `output_schema`.
+    Yields (event name, decoded DataFrame) for each event (and contract, in multi-contract mode) present;
+    'Unknown' logs are skipped.
+    """
+    known = df[df['event'] != 'Unknown']
+    keys = [known['address'].str.lower(), 'event'] if router.multi_contract else ['event']
+    for _, group in known.groupby(keys, sort=False):
+        registry = router.registry(group['address'].iloc[0])
+        evt = group['event'].iloc[0]
+        topic0 = group['topic0'].str.lower()
+        # Overloaded event names share a name but not a topic0
+        for t0, logs in group.groupby(topic0, sort=False):
+            decoded = enrich_events(registry.decode_frame(logs), logs)
+            yield evt, output_schema.apply(registry[t0].abi, decoded)
+
+
+def make_output_sink(router, output_format, output_dir, prefix, labels=None, output_schema=None):
+    """
+    The sink for a router: per-contract folders in multi-contract mode, a single set of event files otherwise
+    """
+    if router.multi_contract:
+        return PartitionedSink(output_format, output_dir, prefix, router.abi_for, labels, output_schema=output_schema)
+    return make_sink(output_format, output_dir, prefix, router.shared.abi, output_schema=output_schema)
+
+
+def event_topics(router, events):
+    """
+    topic0 hashes of the configured events; names are resolved through the shared ABI
+    """
+    topics = set()
+    for evt in events:
+        if evt.startswith('0x'):
+            topics.add(evt.lower())
+        elif router.multi_contract:
+            raise ValueError(f"Give topic0 hashes rather than event names ({evt}) in multi-contract mode")
+        else:
+            matches = [t for t, name in router.shared.event_signatures().items() if name == evt]
+            if not matches:
+                raise ValueError(f"No event {evt} in the ABI")
+            topics.update(matches)
+    return topics
+
+
+def run_pipeline(file_paths, router, sink, size=batch_size, workers=ingest_workers, budget=memory_budget,
+                 blocks=None, events=None, index=build_index, output_schema=None, dedup=None, aggregation=None, metrics=None):
+    """
+    Streams every shard through classification, decoding and the sink.
+    `router` is a ContractRouter, or an ABI to decode every log with. With `workers` set, shards are
+    parsed in that many processes, batches arriving in completion order rather than shard order, and
+    each shard read in full gets a block-range index when `index` is set.
+    With `blocks` ((first, last) inclusive) or `events` (names or topic0 hashes), only matching logs are
+    decoded, and shards or byte ranges whose index rules them out are not read at all.
+    `output_schema` sets the argument column formats (hex bytes, checksum addresses and int amounts by default).
+    With `dedup` (a dedup.LogDeduplicator), logs seen before are dropped ahead of classification.
+    With `aggregation` (an aggregate.Aggregation), every decoded batch also updates its aggregates.
+    With `metrics` (a metrics.Metrics), the time, rows and bytes of every stage are recorded.
+    Returns the per-event log counts (including 'Unknown').
+    """
+    if not isinstance(router, ContractRouter):
+        router = ContractRouter(abi=router)
+    output_schema = output_schema or OutputSchema()
+    metrics = metrics or Metrics()
+    topic0s = event_topics(router, events) if events else None
+    selective = blocks is not None or topic0s is not None
+    counts = Counter()
+    if workers or selective:
+        selection = select_spans(file_paths, blocks, topic0s) if selective else None
+        pbar = tqdm(total=total_bytes(file_paths, selection), desc="Decoding shards", unit='B', unit_scale=True)
+        batches = iter_shard_frames(file_paths, workers or 1, size, budget, progress=pbar.update, selection=selection, index=index)
+    else:
+        pbar = None
+        batches = tqdm(iter_batches(iter_json_records(file_paths), size), desc="Decoding batches", unit='batch')
+    for df in metrics.timed_iter('read', batches):
+        if selective:
+            df = select_logs(df, blocks, topic0s)
+        if dedup is not None:
+            with metrics.stage('dedup', rows_in=len(df)) as stage:
+                df = dedup.filter(df)
+                stage.rows_out = len(df)
+        with metrics.stage('classify', rows_in=len(df)):
+            df = df.assign(event=router.classify(df))
+        counts.update(df['event'].value_counts().to_dict())
+        # Decoding, enrichment and formatting happen in the generator, timed as one 'decode' stage per event
+        decoded_events = decode_batch(df, router, output_schema)
+        for evt, decoded in metrics.timed_iter('decode', decoded_events, rows=lambda item: len(item[1]),
+                                               event=lambda item: item[0], profile=True):
+            if aggregation is not None:
+                with metrics.stage('aggregate', evt, rows_in=len(decoded)):
+                    aggregation.update(evt, decoded)
+            output = sink.path(evt, decoded['address'].iloc[0]) if router.multi_contract else sink.path(evt)
+            with metrics.stage('write', evt, rows_in=len(decoded), output=output):
+                sink.write(evt, decoded)
+        metrics.chunk_done(len(df), None)
+        del df
+    if pbar is not None:
+        pbar.close()
+    with metrics.stage('close_sink'):
+        sink.close()
+    return counts
+
+
+def run_incremental(file_paths, router, output_dir, prefix, output_format='csv', manifest_path=None, checksum=False, size=batch_size, labels=None,
+                    output_schema=None, dedup=None, aggregation=None, metrics=None):
+    """
+    Decodes only the shards not yet recorded in the manifest, committing each shard's outputs atomically.
+    Every log of a new shard is decoded, whatever its block (backfill exports, contracts added later,
+    rare events), so logs repeated by a re-export that overlaps earlier ones are only dropped by `dedup`.
+    CSV outputs grow in place; Parquet outputs become one part file per shard in a `{prefix}_{event}` folder.
+    With `dedup` (a persistent dedup.LogDeduplicator), logs seen in any earlier shard or run are dropped;
+    its keys are committed before each shard's outputs, and a shard whose outputs a crash left uncommitted
+    gets its own logs through again.
+    With `aggregation` (an aggregate.Aggregation with a state path), each shard's logs are added to the
+    aggregates, whose state is saved before the shard's outputs are committed; a shard already counted
+    in it is not counted again when a crash left its outputs uncommitted.
+    With `metrics` (a metrics.Metrics), the time, rows and bytes of every stage are recorded, one chunk per shard.
+    Returns the per-event log counts of the shards decoded in this run.
+    """
+    if not isinstance(router, ContractRouter):
+        router = ContractRouter(abi=router)
+    output_schema = output_schema or OutputSchema()
+    metrics = metrics or Metrics()
+    manifest = Manifest(manifest_path or f"{output_dir}/{prefix}_manifest.json")
+    manifest.recover()
+    staging_dir = f"{output_dir}/.staging"
+    counts = Counter()
+
+    for shard in tqdm(manifest.pending(file_paths, checksum), desc="Decoding shards", unit='shard'):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        fingerprint = shard_fingerprint(shard, checksum)
+        staging_sink = make_output_sink(router, output_format, staging_dir, prefix, labels, output_schema)
+        shard_aggregation = aggregation if aggregation is not None and not aggregation.applied(shard, fingerprint) else None
+        if dedup is not None:
+            dedup.replay(shard, fingerprint)
+        event_blocks = {}
+        shard_rows = 0
+        for df in metrics.timed_iter('read', iter_batches(iter_json_records([shard]), size)):
+            if dedup is not None:
+                with metrics.stage('dedup', rows_in=len(df)) as stage:
+                    df = dedup.filter(df)
+                    stage.rows_out = len(df)
+            with metrics.stage('classify', rows_in=len(df)):
+                df = df.assign(event=router.classify(df))
+            counts.update(df['event'].value_counts().to_dict())
+            shard_rows += len(df)
+            decoded_events = decode_batch(df, router, output_schema)
+            for evt, decoded in metrics.timed_iter('decode', decoded_events, rows=lambda item: len(item[1]),
+                                                   event=lambda item: item[0], profile=True):
+                if shard_aggregation is not None:
+                    with metrics.stage('aggregate', evt, rows_in=len(decoded)):
+                        shard_aggregation.update(evt, decoded)
+                with metrics.stage('write', evt, rows_in=len(decoded)):
+                    staging_sink.write(evt, decoded)
+                # Highest blocks written (informational) are per event, or per contract and event in multi-contract mode
+                key = f"{decoded['address'].iloc[0]}/{evt}" if router.multi_contract else evt
+                block = int(pd.to_numeric(decoded['blockNumber']).max())
+                event_blocks[key] = max(event_blocks.get(key, block), block)
+        with metrics.stage('commit'):
+            staging_sink.close()
+            if aggregation is not None:
+                aggregation.commit(shard, fingerprint)
+            if dedup is not None:
+                dedup.commit(shard, fingerprint)
+            commit_staged_outputs(manifest, staging_dir, output_dir, shard, fingerprint, event_blocks)
+        metrics.chunk_done(shard_rows, None)
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    return counts
+
+
+if __name__ == "__main__":
+    file_paths = list_shards(folder_path)
+    if not os.path.exists(parsed_output):
+        os.makedirs(parsed_output)
+
+    # Proxies take their implementation's ABI unless abi_addresses names one; resolved addresses are cached
+    resolver = ProxyResolver(rpc_url) if rpc_url else None
+    overrides = {a.lower(): b for a, b in abi_addresses.items()}
+
+    def abi_sources(addresses):
+        """
+        lower-case address -> address to take its ABI from, with every proxy resolved in one batched call
+        """
+        sources = {address.lower(): overrides.get(address.lower(), address) for address in addresses}
+        if resolver is not None:
+            sources.update({address.lower(): implementation for address, implementation
+                            in resolver.resolve([a for a in sources if a not in overrides]).items()})
+        return {address: Web3.to_checksum_address(source) for address, source in sources.items()}
+
+    if multi_contract:
+        # Every contract of the export is resolved and its ABI fetched up front; routing then only reads the results
+        sources = abi_sources(contract_addresses(file_paths, ingest_workers))
+        abis = get_cached_abis(sorted(set(sources.values())))
+
+        def load_abi(address):
+            source = sources.get(address.lower())
+            return abis.get(source) if source is not None else None
+        router = ContractRouter(abi_loader=load_abi)
+    else:
+        # Use the first log's address for the ABI unless one is configured
+        if not contract_address:
+            with open_shard(file_paths[0]) as f:
+                contract_address = json.loads(f.readline())['address']
+        router = ContractRouter(abi=get_cached_abi(abi_sources([contract_address])[contract_address.lower()]))
+
+    output_schema = OutputSchema(bytes_format, address_format, uint_format, hash_format, categorical)
+    metrics = Metrics(metrics_path, profile)
+    dedup = None
+    if deduplicate:
+        # Keys persist next to the manifest in incremental mode; other runs start from an empty set
+        dedup = LogDeduplicator(f"{parsed_output}/{contract_name}_dedup" if incremental else None, dedup_memory)
+    aggregation = None
+    if aggregate:
+        # Incremental runs add new shards to the state saved by earlier runs
+        aggregation = Aggregation(aggregates, f"{parsed_output}/{contract_name}_aggregates.pkl" if incremental else None)
+    results_dir = parsed_output
+    if block_range is not None or only_events:
+        if incremental:
+            raise ValueError("block_range and only_events re-decode part of the export; run them with incremental = False")
+        # Partial re-decodes go to their own folder rather than replacing the full outputs
+        slice_output = results_dir = f"{parsed_output}_slice"
+        os.makedirs(slice_output, exist_ok=True)
+        sink = make_output_sink(router, output_format, slice_output, contract_name, contract_labels, output_schema)
+        if ordered_output:
+            sink = OrderedSink(sink, sort_run_rows, spill_dir=slice_output)
+        counts = run_pipeline(file_paths, router, sink, blocks=block_range, events=only_events, output_schema=output_schema, dedup=dedup,
+                              aggregation=aggregation, metrics=metrics)
+    elif incremental:
+        if ordered_output:
+            raise ValueError("Incremental outputs grow shard by shard and cannot be sorted globally; run ordered_output with incremental = False")
+        if output_format == 'sqlite':
+            raise ValueError("Staged shard outputs are committed as CSV appends or Parquet parts; run sqlite with incremental = False")
+        counts = run_incremental(file_paths, router, parsed_output, contract_name, output_format, checksum=verify_checksums,
+                                 labels=contract_labels, output_schema=output_schema, dedup=dedup, aggregation=aggregation,
+                                 metrics=metrics)
+    else:
+        sink = make_output_sink(router, output_format, parsed_output, contract_name, contract_labels, output_schema)
+        if ordered_output:
+            sink = OrderedSink(sink, sort_run_rows, spill_dir=parsed_output)
+        counts = run_pipeline(file_paths, router, sink, output_schema=output_schema, dedup=dedup, aggregation=aggregation, metrics=metrics)
+
+    if dedup is not None:
+        print(f'Duplicate logs dropped: {dedup.duplicates}')
+        dedup.close()
+    if aggregation is not None:
+        aggregation.write_results(results_dir, contract_name)
+        print(f'Aggregates written to {results_dir}/{contract_name}_agg_*.csv')
+    metrics.close()
+
+    print('Event counts:')
+    print(pd.Series(counts).sort_values(ascending=False))
@@ -1,26 +1,30 @@
 # preprocess_jsonlogs.py
 # Purpose: Concatenates Ethereum contract logs into a CSV file, enriching the logs with event names and printing event statistics.
 # Note: 
+# - Shards are split into byte ranges and parsed in parallel into bounded-memory batches (see ingest.py) and written out batch by batch.
+# - Logs repeated across overlapping exports are dropped on (transaction_hash, log_index) with 'deduplicate' (see dedup.py).
 # - Specify 'folder_path' for the location of Google BigQuery results and 'contract_name' for the output CSV file.
 # - The function 'get_cached_abi' does not support proxy contract addresses.
 
 import os
-import json
 import pandas as pd
-from multiprocessing import Pool, cpu_count
+from collections import Counter
+from multiprocessing import cpu_count
 from tqdm import tqdm
 from web3 import Web3
-from utils import get_proxy_address, get_cached_abi
-from eth_utils import event_abi_to_log_topic
-from pandarallel import pandarallel
-import ast 
-
-# Initialize Pandarallel for efficient parallel processing
-pandarallel.initialize(progress_bar=False)
-
+from utils import get_proxy_address, get_cached_abi, get_event_signatures
+from ingest import is_shard, iter_shard_frames, total_bytes
+from dedup import LogDeduplicator
 # Configuration: Define the data folder and contract name
 folder_path = "data/your platform"
 contract_name = "your platform"
+num_processes = cpu_count()  # Parser processes
+batch_rows = 100000  # Logs per parsed batch
+memory_budget = 2 * 2**30  # Bytes of parsed batches allowed to wait for the CSV writer
+range_bytes = 64 * 2**20  # Shards are split into byte ranges of about this size, parsed in parallel
+build_index = True  # Write a block-range index next to each shard (see shard_index.py)
+deduplicate = True  # Drop logs repeated across overlapping exports
+dedup_memory = 256 * 2**20  # Bytes of deduplication keys kept in memory, the rest spills to disk
 
 # Define the output file path for the consolidated logs
 parent_name = os.path.basename(os.path.dirname(folder_path))
@@ -32,23 +36,21 @@ if not os.path.exists(parsed_output):
     os.makedirs(parsed_output)
 
 
-def parse_json_file(file_path):
+def prepare_batch(df, columns):
     """
-    Parses a JSON file and returns a list of data.
+    Aligns a parsed batch on the first batch's columns and casts them.
     Args:
-        file_path (str): Path to the JSON file.
+        df (DataFrame): Batch from `iter_shard_frames`.
+        columns (list): Column order of the output CSV.
     Returns:
-        list: A list of data extracted from the JSON file.
+        DataFrame: The batch with the output columns and types.
     """
-    data_list = []
-    with open(file_path, "r") as text_file:
-        for line in text_file:
-            try:
-                data = json.loads(line)
-                data_list.append(data)
-            except json.JSONDecodeError as e:
-                print(f"Error parsing {file_path}: {str(e)}")
-    return data_list
+    # BigQuery leaves null fields out of the JSON, so a batch can miss a column
+    df = df.reindex(columns=columns)
+    # Define data types for DataFrame columns (you might have to edit this)
+    return df.astype({'log_index':'int', 'transaction_hash':'str', 'transaction_index':'int', 
+                      'address':'str', 'data':'str', 'block_timestamp':'str', 
+                      'block_number':'int', 'block_hash':'str', 'msg_sender':'str'})
 
 if __name__ == "__main__":
 
@@ -56,78 +58,70 @@ if __name__ == "__main__":
     # Concatenation 
     ####################
 
-    # Determine the number of processes based on CPU count
-    num_processes = cpu_count()
-    
-    with Pool(num_processes) as pool:
-        file_paths = [os.path.join(folder_path, filename) for filename in os.listdir(folder_path)]
-        
-        # Progress bar for tracking file processing
-        print("Text files concatenation started.")
-        with tqdm(total=len(file_paths)) as pbar:
-            data_lists = []
-            
-            def update(*a):
-                pbar.update()
-            
-            # Process each file in parallel and update progress bar
-            for data_list in pool.imap_unordered(parse_json_file, file_paths):
-                data_lists.append(data_list)
-                update()
-    
-    pool.close()
-    pool.join() 
-
-    # Flatten the list of data lists and create a DataFrame
-    combined_data_list = [item for sublist in data_lists for item in sublist]
-    df = pd.DataFrame(combined_data_list)
-
-    # Define data types for DataFrame columns (you might have to edit this)
-    df = df.astype({'log_index':'int', 'transaction_hash':'str', 'transaction_index':'int', 
-                    'address':'str', 'data':'str', 'topics':'str', 'block_timestamp':'str', 
-                    'block_number':'int', 'block_hash':'str', 'msg_sender':'str'})
-
-    # Convert 'topics' column to list using ast.literal_eval
-    df['topics'] = df['topics'].parallel_apply(ast.literal_eval)
-
-    ####################
-    # ABIs & Events
-    ####################
-
-    # Initialize Web3 (requires a valid node for proxy address resolution)
-    w3 = Web3()
-
-    # Get the checksummed contract address from the DataFrame
-    contract_address = Web3.to_checksum_address(df['address'][0])
-
-    # Retrieve ABI for the contract (different methods for proxy and non-proxy contracts)
-    # a) non-proxy
-    abi = get_cached_abi(contract_address)
-    contract = w3.eth.contract(address=contract_address, abi=abi)
-    # b) proxy
-    # proxy = get_proxy_address(w3, contract_address)
-    # abi = get_cached_abi(proxy)
-    # contract = w3.eth.contract(address=contract_address, abi=abi)
-
-    # Extract event ABIs and compute their signatures
-    events = [obj for obj in abi if obj['type'] == 'event']
-    event_signatures = {('0x' + event_abi_to_log_topic(evt).hex()): evt['name'] for evt in events}
-    for evt_name, sig in event_signatures.items():
-        print(f"{evt_name} - {sig}")
-
-    ##################
-    # Mapping Event
-    ##################
-
-    # Assign event names to each log entry based on 'topics' column
-    print('Assigning names to each event.')
-    df['event'] = df['topics'].parallel_apply(lambda x: event_signatures.get(x[0], 'Unknown'))
+    # Shards are parsed in 'num_processes' workers into columnar batches (topics split into topic0..topic3);
+    # each batch is classified and appended to the CSV as it arrives, so only 'memory_budget' worth of
+    # parsed logs waits in memory
+    file_paths = [os.path.join(folder_path, filename) for filename in os.listdir(folder_path) if is_shard(filename)]
+    print("Text files concatenation started.")
+
+    columns = None
+    event_counts = Counter()
+    dedup = LogDeduplicator(memory_budget=dedup_memory) if deduplicate else None
+    # Progress is reported in bytes of input parsed
+    pbar = tqdm(total=total_bytes(file_paths), unit='B', unit_scale=True)
+    for df in iter_shard_frames(file_paths, num_processes, batch_rows, memory_budget, range_bytes, pbar.update, index=build_index):
+        if columns is None:
+            columns = list(df.columns)
+            df = prepare_batch(df, columns)
+
+            ####################
+            # ABIs & Events
+            ####################
+
+            # Initialize Web3 (requires a valid node for proxy address resolution)
+            w3 = Web3()
+
+            # Get the checksummed contract address from the first batch
+            contract_address = Web3.to_checksum_address(df['address'].iloc[0])
+
+            # Retrieve ABI for the contract (different methods for proxy and non-proxy contracts)
+            # a) non-proxy
+            abi = get_cached_abi(contract_address)
+            contract = w3.eth.contract(address=contract_address, abi=abi)
+            # b) proxy
+            # proxy = get_proxy_address(w3, contract_address)
+            # abi = get_cached_abi(proxy)
+            # contract = w3.eth.contract(address=contract_address, abi=abi)
+
+            # Event signatures (topic0: name) from the index stored with the cached ABI
+            event_signatures = get_event_signatures(contract_address)  # b) proxy: get_event_signatures(proxy)
+            for evt_name, sig in event_signatures.items():
+                print(f"{evt_name} - {sig}")
+        else:
+            df = prepare_batch(df, columns)
+
+        # Drop logs an overlapping shard already delivered
+        if dedup is not None:
+            df = dedup.filter(df)
+
+        ##################
+        # Mapping Event
+        ##################
+
+        # Assign event names to each log entry with a lookup on the 'topic0' column
+        df['event'] = df['topic0'].str.lower().map(event_signatures).fillna('Unknown')
+        event_counts.update(df['event'].value_counts().to_dict())
+
+        # Append the enriched batch to the CSV file (the first batch replaces it)
+        first_batch = sum(event_counts.values()) == len(df)
+        df.to_csv(output_csv, mode='w' if first_batch else 'a', header=first_batch, index=False)
+
+    pbar.close()
+    if dedup is not None:
+        print(f'Duplicate logs dropped: {dedup.duplicates}')
+        dedup.close()
 
     # Print the count of each event type
     print('Event counts:')
-    event_count = df['event'].value_counts()
-    print(event_count)
-
-    # Save the enriched DataFrame to a CSV file
-    print(f'Saving to {output_csv} (this may take a while)')
-    df.to_csv(output_csv, index=False)
+    print(pd.Series(event_counts, dtype='int').sort_values(ascending=False))
+    print(f'Saved to {output_csv}')
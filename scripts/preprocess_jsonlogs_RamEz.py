@@ -2,22 +2,23 @@
 # Purpose: Concatenates large Ethereum contract logs into a CSV file with controlled RAM usage, then adds event name column
 # Note: 
 # - This script is a variant of preprocess_jsonlogs.py, optimized for handling extremely large logs.
-# - It uses CSV module, df chunking, and explicit garbage collection for efficient, write-as-you-go operations to manage RAM usage effectively.
+# - It uses streamed CSV writing, df chunking, and explicit garbage collection for efficient, write-as-you-go operations to manage RAM usage effectively.
+# - Shards are memory-mapped and parsed in parallel by byte range (see ingest.py); 'memory_budget' caps the parsed rows waiting to be written.
+# - Logs repeated across overlapping exports are dropped on (transaction_hash, log_index) with 'deduplicate', keys spilling to disk past 'dedup_memory' (see dedup.py).
 
 import os
 import json
 from tqdm import tqdm
-import csv
-import ast
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from web3 import Web3
-from utils import get_proxy_address, get_cached_abi, count_lines_in_file
-from eth_utils import event_abi_to_log_topic
+from utils import get_proxy_address, get_cached_abi, get_event_signatures
+from ingest import is_shard, iter_shard_tables, open_shard, total_bytes
+from decoder import TOPIC_COLUMNS
+from dedup import LogDeduplicator
 import gc 
 import math
-from pandarallel import pandarallel
-
-pandarallel.initialize(progress_bar=False)
 
 # Initialize Web3 with the provided URL
 url = "" # your Ethereum node
@@ -27,6 +28,11 @@ w3 = Web3(Web3.HTTPProvider(url))
 # Reads all files of type 
 folder_path = "path/to/data"
 file_type = ".json"
+num_workers = os.cpu_count()  # Parser processes
+memory_budget = 256 * 2**20  # Bytes of parsed logs allowed to wait for the CSV writer
+build_index = True  # Write a block-range index next to each shard (see shard_index.py)
+deduplicate = True  # Drop logs repeated across overlapping exports
+dedup_memory = 128 * 2**20  # Bytes of deduplication keys kept in memory, the rest spills to disk
 contract_name = "CONTRACT-NAME"
 # Convert the provided contract address to checksum address
 # add your contract address for abi fetching, if processing contract of the same type, say ERC20, whichever contract works fine.
@@ -41,43 +47,45 @@ parent_name = os.path.basename(os.path.dirname(folder_path))
 # file_paths = [os.path.join(folder_path, filename) for filename in os.listdir(folder_path)]
 file_paths = list()
 for filename in os.listdir(folder_path):
-    if filename.endswith(file_type):
+    if is_shard(filename, file_type):  # also matches .json.gz / .json.zst exports
         file_paths.append(os.path.join(folder_path, filename))
 
 
-# Function to count all lines in each file
-def count_all_lines(files):
+def align_table(table, fieldnames):
     """
-    Counts the number of lines in each file.
-    Args:
-        files: List of file paths.
-    Returns:
-        Dictionary with file paths as keys and line counts as values.
+    Orders a parsed batch on the CSV fieldnames, with empty columns for fields the batch does not have.
     """
-    line_counts = {}
-    for file in tqdm(files, desc="Counting lines in"):
-        with open(file, 'r') as f:
-            line_counts[file] = sum(1 for _ in f)
-    return line_counts
+    columns = [table.column(name) if name in table.column_names else pa.nulls(table.num_rows) for name in fieldnames]
+    return pa.Table.from_arrays(columns, names=fieldnames)
 
 # Main execution block
 if __name__ == "__main__":
     tqdm.write("Text files concatenation started.")
-    line_counts = count_all_lines(file_paths)
 
     # Writing data to CSV in a memory-efficient way
-    with open(output_csv, 'w', newline='') as csvfile:
-        with open(file_paths[0], 'r') as f:
-            first_line = json.loads(f.readline())
-            writer = csv.DictWriter(csvfile, fieldnames=first_line.keys())
-            writer.writeheader()
-
-        for file_path in tqdm(file_paths, desc=f"Processing files:"):
-            with open(file_path, 'r') as text_file:
-                for line in tqdm(text_file, total=line_counts[file_path], desc="Lines in file", leave=False):
-                    data = json.loads(line)
-                    writer.writerow(data)
-        
+    with open_shard(file_paths[0]) as f:
+        first_line = json.loads(f.readline())
+    # Topics are written as topic0..topic3 columns in place of the 'topics' list
+    fieldnames = []
+    for key in first_line.keys():
+        fieldnames.extend(TOPIC_COLUMNS if key == 'topics' else [key])
+
+    written_rows = 0
+    dedup = LogDeduplicator(memory_budget=dedup_memory) if deduplicate else None
+    write_options = pa_csv.WriteOptions(include_header=False, quoting_style='needed')
+    with open(output_csv, 'wb') as csvfile, \
+            tqdm(total=total_bytes(file_paths), desc="Processing files", unit='B', unit_scale=True) as pbar:
+        csvfile.write((','.join(fieldnames) + '\n').encode())
+        for _, table in iter_shard_tables(file_paths, num_workers, memory_budget=memory_budget, progress=pbar.update, index=build_index):
+            if dedup is not None:
+                table = dedup.filter_table(table)
+            pa_csv.write_csv(align_table(table, fieldnames), csvfile, write_options)
+            written_rows += table.num_rows
+            del table
+
+    if dedup is not None:
+        tqdm.write(f"Duplicate logs dropped: {dedup.duplicates}")
+        dedup.close()
     tqdm.write(f"Data wrote to {output_csv}. Mapping event names next.")
 
     ####################
@@ -93,13 +101,12 @@ if __name__ == "__main__":
     # abi = get_cached_abi(proxy)
     # contract = w3.eth.contract(address=contract_address, abi=abi)
 
-    events = [obj for obj in abi if obj['type'] == 'event']
-    event_signatures = {('0x' + event_abi_to_log_topic(evt).hex()): evt['name'] for evt in events}
+    # Event signatures (topic0: name) from the index stored with the cached ABI
+    event_signatures = get_event_signatures(contract_address)  # b) proxy: get_event_signatures(proxy)
 
 
     chunk_size = 10**5  # Adjust based on your system's capability
-    total_rows = count_lines_in_file(output_csv)  # Total rows including header
-    total_chunks = math.ceil((total_rows - 1) / chunk_size)  # Subtract 1 for header, then calculate total chunks
+    total_chunks = math.ceil(written_rows / chunk_size)  # Rows written above, no need to count the CSV lines
 
     # Initialize a boolean to control header writing
     first_chunk = True
@@ -113,14 +120,16 @@ if __name__ == "__main__":
                                       'transaction_index':'int', 
                                       'address':'str', 
                                       'data':'str', 
-                                      'topics':'str', 
+                                      'topic0':'str', 
+                                      'topic1':'str', 
+                                      'topic2':'str', 
+                                      'topic3':'str', 
                                       'block_timestamp':'str', 
                                       'block_number':'int', 
                                       'block_hash':'str'}), total=total_chunks):
 
-        # Convert 'topics' column to list and assign event names
-        chunk['topics'] = chunk['topics'].parallel_apply(ast.literal_eval)
-        chunk['event'] = chunk['topics'].parallel_apply(lambda x: event_signatures.get(x[0], 'Unknown'))
+        # Assign event names with a lookup on the 'topic0' column
+        chunk['event'] = chunk['topic0'].str.lower().map(event_signatures).fillna('Unknown')
 
         # Append the processed chunk to the output CSV
         mode = 'a' if not first_chunk else 'w'
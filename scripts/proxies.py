@@ -0,0 +1,205 @@
+"""
+Batched proxy resolution over JSON-RPC, with the results cached on disk.
+
+`utils.get_proxy_address` reads up to five storage slots one `get_storage_at`
+call at a time, plus an `eth_call` for beacon proxies, so a protocol with
+hundreds of proxies took minutes. `ProxyResolver.resolve(addresses)` sends the
+slot reads of every address as JSON-RPC batch requests (`batch_size` calls
+each), posted concurrently over one pooled aiohttp session, then reads the
+implementation of every beacon found in one more round of batches. Slots keep
+the priority order of `get_proxy_address`: the first non-zero slot wins.
+
+Results (the implementation, or null for a contract that is not a proxy) are
+kept in a JSON cache keyed by lower-case address, so a re-run resolves cached
+addresses without any RPC call. Addresses whose reads failed in transport (the
+node unreachable, a batch lost or throttled after `retries` attempts) resolve
+to themselves for this run and are not cached; other errors returned by the
+node for a single call count as an empty slot, as in `get_proxy_address`.
+"""
+
+import asyncio
+import json
+import os
+
+import aiohttp
+from web3 import Web3
+
+# Same slots and order as utils.get_proxy_address
+PROXY_SLOTS = [
+    "0x360894a13ba1a3210667c828492db98dca3e2076cc3735a920a3ca505d382bbc",  # EIP-1967 implementation
+    "0xa3f0ad74e5423aebfd80d3ef4346578335a9a72aeaee59ff6cb3582b35133d50",  # EIP-1967 beacon
+    "0x7050c9e0f4ca769c69bd3a8ef740bc37934f8e2c036e5a723fd8ee048ed3f8c3",  # OpenZeppelin (zeppelinos) implementation
+    "0xc5f16f0fcc639fa48a6947836d9850f504798523bf8c9a3a87d5876cf622bcf7",  # EIP-1822 PROXIABLE
+    "0x5f3b5dfeb7b28cdbd7faba78963ee202a494e2a2cc8c9978d5e30d2aebb8c197",  # Recommended by TrueBlocks
+]
+BEACON_SLOT = PROXY_SLOTS[1]
+IMPLEMENTATION_SELECTOR = '0x5c60da1b'  # implementation(), called on beacons
+# Error codes of throttled calls (EIP-1474 "limit exceeded", HTTP 429 passed through by some providers)
+THROTTLE_CODES = (-32005, 429)
+
+
+def is_throttled(reply):
+    """
+    Whether a call's reply is a rate-limit error, which says nothing about the slot
+    """
+    error = reply.get('error') if isinstance(reply, dict) else None
+    if not isinstance(error, dict):
+        return False
+    return error.get('code') in THROTTLE_CODES or 'rate limit' in str(error.get('message', '')).lower()
+
+
+def word_address(word):
+    """
+    Checksum address in the last 20 bytes of a storage word or call result, None when zero or malformed
+    """
+    if not isinstance(word, str) or not word.startswith('0x') or len(word) < 42:
+        return None
+    try:
+        if int(word[-40:], 16) == 0:
+            return None
+    except ValueError:
+        return None
+    return Web3.to_checksum_address('0x' + word[-40:])
+
+
+class ProxyResolver:
+    """
+    Resolves proxies to their implementation addresses through batched, concurrent JSON-RPC calls.
+    Args:
+        rpc_url (str): HTTP JSON-RPC endpoint (a node, a provider URL or a local stub).
+        cache_path (str): JSON cache of address: implementation (null when not a proxy), or None for none.
+        batch_size (int): Calls per JSON-RPC batch request.
+        concurrency (int): Batch requests in flight at once (pooled connections).
+        timeout (float): Seconds allowed per batch request.
+        retries (int): Extra attempts of a batch request that failed in transport or was throttled, with exponential backoff.
+        block (str): Block tag or number the slots are read at.
+    """
+
+    def __init__(self, rpc_url, cache_path="abis/proxies.json", batch_size=100, concurrency=8, timeout=30, retries=2,
+                 block='latest'):
+        self.rpc_url = rpc_url
+        self.cache_path = cache_path
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.block = block
+        self.requests = 0
+        self.failed = set()
+        self.cache = self._load_cache()
+
+    def _load_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        with open(self.cache_path) as f:
+            return json.load(f)
+
+    def _save_cache(self, results):
+        """
+        Merges new results into the cache file (re-read first, so parallel runs keep each other's entries)
+        """
+        self.cache.update(results)
+        if self.cache_path is None or not results:
+            return
+        cache = {**self._load_cache(), **results}
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=0, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+        self.cache = cache
+
+    def resolve(self, addresses, refresh=False):
+        """
+        Implementation address of each proxy; addresses that are not proxies (or could not be read) map to themselves.
+        Args:
+            addresses (list): Contract addresses, any case.
+            refresh (bool): Read every address again instead of using the cache.
+        Returns:
+            dict: address as given -> checksum implementation address (or the address itself).
+        """
+        keys = {address: address.lower() for address in addresses}
+        missing = sorted({key for key in keys.values() if refresh or key not in self.cache})
+        if missing:
+            results = asyncio.run(self._resolve(missing))
+            self._save_cache(results)
+            if self.failed:
+                print(f"Proxy resolution failed for {len(self.failed)} addresses (not cached, read again next run)")
+        resolved = {}
+        for address, key in keys.items():
+            implementation = self.cache.get(key)
+            resolved[address] = implementation if implementation is not None else Web3.to_checksum_address(address)
+        return resolved
+
+    def proxies(self, addresses, refresh=False):
+        """
+        Only the proxies among `addresses`: address -> implementation address
+        """
+        return {address: implementation for address, implementation in self.resolve(addresses, refresh).items()
+                if implementation.lower() != address.lower()}
+
+    async def _resolve(self, addresses):
+        """
+        address -> implementation (None for non-proxies) for every address whose reads all went through
+        """
+        self.failed = set()
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            calls = [('eth_getStorageAt', [address, slot, self.block]) for address in addresses for slot in PROXY_SLOTS]
+            replies = await self._call_all(session, calls)
+            found = {}
+            for i, address in enumerate(addresses):
+                for j, slot in enumerate(PROXY_SLOTS):
+                    reply = replies[i * len(PROXY_SLOTS) + j]
+                    if reply is None:
+                        # A lower-priority slot cannot be trusted while this one is unknown
+                        self.failed.add(address)
+                        break
+                    implementation = word_address(reply.get('result'))
+                    if implementation is not None:
+                        found[address] = (slot, implementation)
+                        break
+
+            # Beacon proxies: the implementation is read from the beacon
+            beacons = [address for address, (slot, _) in found.items() if slot == BEACON_SLOT and address not in self.failed]
+            calls = [('eth_call', [{'to': found[address][1], 'data': IMPLEMENTATION_SELECTOR}, self.block]) for address in beacons]
+            for address, reply in zip(beacons, await self._call_all(session, calls)):
+                if reply is None:
+                    self.failed.add(address)
+                    continue
+                implementation = word_address(reply.get('result'))
+                if implementation is not None:
+                    found[address] = (BEACON_SLOT, implementation)
+        return {address: found[address][1] if address in found else None
+                for address in addresses if address not in self.failed}
+
+    async def _call_all(self, session, calls):
+        """
+        Replies (dicts with 'result' or 'error') to (method, params) calls in order, None where the batch failed
+        """
+        batches = [calls[start:start + self.batch_size] for start in range(0, len(calls), self.batch_size)]
+        replies = await asyncio.gather(*(self._post_batch(session, batch) for batch in batches))
+        return [reply for batch_replies in replies for reply in batch_replies]
+
+    async def _post_batch(self, session, calls):
+        payload = [{'jsonrpc': '2.0', 'id': i, 'method': method, 'params': params} for i, (method, params) in enumerate(calls)]
+        for attempt in range(self.retries + 1):
+            try:
+                self.requests += 1
+                async with session.post(self.rpc_url, json=payload) as response:
+                    response.raise_for_status()
+                    body = await response.json(content_type=None)
+                if isinstance(body, list):
+                    # Replies to a batch may come in any order
+                    by_id = {reply.get('id'): reply for reply in body if isinstance(reply, dict)}
+                    if any(map(is_throttled, by_id.values())):
+                        raise ValueError(f"Batch throttled by {self.rpc_url}")
+                    return [by_id.get(i) for i in range(len(calls))]
+                # A single error object: the node rejected the whole batch
+                error = body.get('error') if isinstance(body, dict) else body
+                raise ValueError(f"Batch rejected by {self.rpc_url}: {error}")
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                if attempt == self.retries:
+                    print(f"JSON-RPC batch of {len(calls)} calls failed: {e}")
+                    return [None] * len(calls)
+                await asyncio.sleep(0.5 * 2**attempt)
@@ -0,0 +1,214 @@
+"""
+Output schema of decoded events, generated from the event ABI.
+
+Each argument column gets one converter chosen from its ABI type and applied to
+the whole column once per batch:
+- bytes/bytesN (and hashed indexed values): 0x-prefixed hex text, raw binary, or fixed-width `S{n}`
+- address: EIP-55 checksum text (what the decoder returns), lower-case text, 20-byte binary, or `S20`
+- integers wider than 64 bits: Python ints, decimal text, float64, `S32` words or four uint64 limbs
+- transactionHash/blockHash: hex text or `S32`
+- event and contract address: text or categoricals
+Fixed-width formats are NumPy columns the helpers in compact.py work on without Python objects.
+Binary and fixed-width formats are meant for Parquet output, where they are stored as Arrow binary
+columns; the CSV sink writes fixed-width columns back as hex.
+"""
+
+import binascii
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from eth_abi.grammar import BasicType, parse
+from web3._utils.abi import normalize_event_input_types
+from web3._utils.events import get_event_abi_types_for_decoding
+
+from compact import fixed_to_limbs, ints_to_fixed, limb_columns
+from decoder import hex_to_fixed
+
+BYTES_FORMATS = ('hex', 'binary', 'fixed')
+ADDRESS_FORMATS = ('checksum', 'lower', 'binary', 'fixed')
+UINT_FORMATS = ('int', 'decimal', 'float', 'fixed', 'limbs')
+HASH_FORMATS = ('hex', 'fixed')
+HASH_COLUMNS = ['transactionHash', 'blockHash']
+CATEGORICAL_COLUMNS = ['event', 'address']
+
+
+def _flatten_input(inp):
+    """
+    (name, type) of the columns an event input becomes; non-array tuples are flattened like `flatten_attribute_dict`
+    """
+    if inp['type'] == 'tuple':
+        return [col for component in inp['components'] for col in _flatten_input(component)]
+    return [(inp['name'], inp['type'])]
+
+
+def output_columns(event_abi):
+    """
+    (name, ABI type) of every decoded argument column of an event.
+    Indexed dynamic values (string, bytes, T[]) only exist as their hash in the topics and decode as bytes32.
+    """
+    columns = []
+    for inp in event_abi['inputs']:
+        if inp.get('indexed'):
+            columns.extend(zip([inp['name']], get_event_abi_types_for_decoding(normalize_event_input_types([inp]))))
+        else:
+            columns.extend(_flatten_input(inp))
+    return columns
+
+
+def _bytes_to_hex(values, width=None):
+    """
+    Column of bytes -> 0x-prefixed hex; `width` (bytesN) allows hexing the whole column in one call
+    """
+    values = np.asarray(values, dtype=object)
+    if width and len(values):
+        try:
+            blob = b''.join(values)
+        except TypeError:
+            blob = None
+        if blob is not None and len(blob) == width * len(values):
+            hexed = np.frombuffer(binascii.hexlify(blob), dtype=f'S{2 * width}').astype(f'U{2 * width}')
+            return np.char.add('0x', hexed).astype(object)
+    return np.array([('0x' + bytes(v).hex()) if isinstance(v, (bytes, bytearray)) else v for v in values], dtype=object)
+
+
+def _array_bytes_to_hex(values):
+    return np.array([[('0x' + bytes(b).hex()) if isinstance(b, (bytes, bytearray)) else b for b in v]
+                     if isinstance(v, (list, tuple)) else v for v in values], dtype=object)
+
+
+def _addresses_to_binary(values):
+    """
+    Column of address text -> 20-byte binary values (bytes objects, so no trailing zero byte is lost)
+    """
+    blob = hex_to_fixed(values, 20).tobytes()
+    return np.array([blob[i:i + 20] for i in range(0, len(blob), 20)], dtype=object)
+
+
+def _bytes_to_fixed(values, width):
+    """
+    Column of bytesN values -> S{width} array, padded the way the ABI pads them
+    """
+    return np.array([bytes(v) for v in values], dtype=f'S{width}')
+
+
+def _ints_to_limbs(name, signed):
+    def convert(values):
+        limbs = fixed_to_limbs(ints_to_fixed(values, signed))
+        return dict(zip(limb_columns(name), limbs.T))
+    return convert
+
+
+def _to_categorical(values):
+    return pd.Categorical(values)
+
+
+def _ints_to_decimal(values):
+    return np.asarray(values).astype(str).astype(object)
+
+
+def _ints_to_float(values):
+    return np.asarray(values, dtype=object).astype(np.float64)
+
+
+class EventSchema:
+    """
+    Column converters and Arrow types for one event, from its ABI and the chosen formats
+    """
+
+    def __init__(self, event_abi, bytes_format='hex', address_format='checksum', uint_format='int', hash_format='hex',
+                 categorical=False):
+        self.name = event_abi['name']
+        self.converters = {}
+        self.arrow_types = {}
+        for name, type_str in output_columns(event_abi):
+            try:
+                abi_type = parse(type_str)
+            except Exception:
+                continue
+            if not isinstance(abi_type, BasicType):
+                continue
+            if abi_type.arrlist:
+                if abi_type.base == 'bytes' and bytes_format == 'hex' and len(abi_type.arrlist) == 1:
+                    self.converters[name] = _array_bytes_to_hex
+                continue
+            if abi_type.base == 'bytes':
+                if bytes_format == 'hex':
+                    self.converters[name] = lambda v, width=abi_type.sub: _bytes_to_hex(v, width)
+                elif bytes_format == 'fixed' and abi_type.sub:
+                    self.converters[name] = lambda v, width=abi_type.sub: _bytes_to_fixed(v, width)
+                    self.arrow_types[name] = pa.binary(abi_type.sub)
+                else:
+                    self.arrow_types[name] = pa.binary(abi_type.sub) if abi_type.sub else pa.binary()
+            elif abi_type.base == 'address':
+                if address_format == 'lower':
+                    self.converters[name] = lambda v: pd.Series(v).str.lower().to_numpy(dtype=object)
+                elif address_format == 'binary':
+                    self.converters[name] = _addresses_to_binary
+                    self.arrow_types[name] = pa.binary(20)
+                elif address_format == 'fixed':
+                    self.converters[name] = lambda v: hex_to_fixed(v, 20)
+                    self.arrow_types[name] = pa.binary(20)
+            elif abi_type.base in ('uint', 'int') and abi_type.sub > 64:
+                if uint_format == 'decimal':
+                    self.converters[name] = _ints_to_decimal
+                elif uint_format == 'float':
+                    self.converters[name] = _ints_to_float
+                    self.arrow_types[name] = pa.float64()
+                elif uint_format == 'fixed':
+                    self.converters[name] = lambda v, signed=abi_type.base == 'int': ints_to_fixed(v, signed)
+                    self.arrow_types[name] = pa.binary(32)
+                elif uint_format == 'limbs':
+                    self.converters[name] = _ints_to_limbs(name, abi_type.base == 'int')
+                    self.arrow_types.update({col: pa.uint64() for col in limb_columns(name)})
+        if hash_format == 'fixed':
+            for name in HASH_COLUMNS:
+                self.converters[name] = lambda v: hex_to_fixed(v, 32)
+                self.arrow_types[name] = pa.binary(32)
+        if categorical:
+            for name in CATEGORICAL_COLUMNS:
+                self.converters[name] = _to_categorical
+                self.arrow_types[name] = pa.dictionary(pa.int32(), pa.string())
+
+    def apply(self, df):
+        """
+        Converts the columns of a decoded batch in place and returns it.
+        A value stored as limbs replaces its column with `{name}_limb0`..`{name}_limb3`.
+        """
+        for name, convert in self.converters.items():
+            if name in df.columns and len(df):
+                converted = convert(df[name].to_numpy())
+                if isinstance(converted, dict):
+                    position = df.columns.get_loc(name)
+                    df.drop(columns=name, inplace=True)
+                    for offset, (col, values) in enumerate(converted.items()):
+                        df.insert(position + offset, col, values)
+                else:
+                    df[name] = converted
+        return df
+
+
+class OutputSchema:
+    """
+    The chosen output formats, with the `EventSchema` of every event they have been applied to
+    """
+
+    def __init__(self, bytes_format='hex', address_format='checksum', uint_format='int', hash_format='hex', categorical=False):
+        for value, allowed in ((bytes_format, BYTES_FORMATS), (address_format, ADDRESS_FORMATS), (uint_format, UINT_FORMATS),
+                               (hash_format, HASH_FORMATS)):
+            if value not in allowed:
+                raise ValueError(f"Unknown output format {value}, expected one of {', '.join(allowed)}")
+        self.formats = {'bytes_format': bytes_format, 'address_format': address_format, 'uint_format': uint_format,
+                        'hash_format': hash_format, 'categorical': categorical}
+        self._events = {}
+
+    def for_event(self, event_abi):
+        key = (event_abi['name'], json.dumps(event_abi['inputs'], sort_keys=True))
+        schema = self._events.get(key)
+        if schema is None:
+            schema = self._events[key] = EventSchema(event_abi, **self.formats)
+        return schema
+
+    def apply(self, event_abi, df):
+        return self.for_event(event_abi).apply(df)
@@ -0,0 +1,167 @@
+"""
+Sidecar block-range index of raw log shards.
+
+While the parallel ingest parses a shard it also records, for every batch of
+rows, the byte range it came from, its lowest and highest `block_number` and
+the topic0 values and contract addresses it holds. Once the whole shard has been parsed these entries
+are written next to it as `{shard}.idx`. A run restricted to a block range or
+to some events then reads only the indexes, skips the shards that cannot match
+and hands the parser just the byte ranges that can.
+
+Compressed shards cannot be entered mid-stream, so their index only has the
+shard-level summary: they are either skipped or read in full.
+"""
+
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from manifest import atomic_write_json, shard_fingerprint
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 2
+
+
+def index_path(shard_path):
+    return f"{shard_path}{INDEX_SUFFIX}"
+
+
+def batch_entry(batch, start, end):
+    """
+    Index entry of a parsed batch covering bytes [start, end) of its shard (None offsets for compressed shards)
+    """
+    entry = {'start': start, 'end': end, 'rows': batch.num_rows, 'min_block': None, 'max_block': None, 'topic0': [],
+             'address': []}
+    if 'block_number' in batch.schema.names:
+        blocks = batch.column('block_number')
+        if not pa.types.is_integer(blocks.type):
+            blocks = pc.cast(blocks, pa.int64())
+        bounds = pc.min_max(blocks).as_py()
+        entry['min_block'], entry['max_block'] = bounds['min'], bounds['max']
+    if 'topic0' in batch.schema.names:
+        entry['topic0'] = sorted(t.lower() for t in pc.unique(batch.column('topic0')).to_pylist() if t)
+    if 'address' in batch.schema.names:
+        entry['address'] = sorted({a.lower() for a in pc.unique(batch.column('address')).to_pylist() if a})
+    return entry
+
+
+class ShardIndexBuilder:
+    """
+    Collects the batch entries of one shard and writes its index once the last batch of each of its
+    `ranges` byte ranges has arrived. Completion is not judged from the bytes covered: a compressed
+    shard's read position runs ahead of the batches because of the decompressor's read-ahead.
+    """
+
+    def __init__(self, shard_path, ranges=1):
+        self.shard_path = shard_path
+        self.fingerprint = shard_fingerprint(shard_path)
+        self.entries = []
+        self.ranges_left = ranges
+
+    @property
+    def complete(self):
+        return self.ranges_left <= 0
+
+    def add(self, entry, last=False):
+        """
+        Records a batch entry (None for an empty batch); `last` marks the final batch of a byte range
+        """
+        if entry is not None:
+            self.entries.append(entry)
+        if last:
+            self.ranges_left -= 1
+
+    def save(self):
+        entries = sorted(self.entries, key=lambda e: e['start'] or 0)
+        min_blocks = [e['min_block'] for e in entries if e['min_block'] is not None]
+        max_blocks = [e['max_block'] for e in entries if e['max_block'] is not None]
+        seekable = all(e['start'] is not None for e in entries)
+        atomic_write_json(index_path(self.shard_path), {
+            'version': INDEX_VERSION,
+            'fingerprint': self.fingerprint,
+            'rows': sum(e['rows'] for e in entries),
+            'min_block': min(min_blocks) if min_blocks else None,
+            'max_block': max(max_blocks) if max_blocks else None,
+            'topic0': sorted(set(t for e in entries for t in e['topic0'])),
+            'address': sorted(set(a for e in entries for a in e['address'])),
+            'batches': entries if seekable else [],
+        })
+
+
+def load_index(shard_path):
+    """
+    The index of a shard, or None when there is none or the shard changed since it was built
+    """
+    path = index_path(shard_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        index = json.load(f)
+    if index.get('version') != INDEX_VERSION or index.get('fingerprint') != shard_fingerprint(shard_path):
+        return None
+    return index
+
+
+def _matches(summary, blocks, topic0s):
+    """
+    False only when the index entry proves none of its rows can be selected
+    """
+    if blocks is not None and summary['min_block'] is not None:
+        first, last = blocks
+        if summary['max_block'] < first or summary['min_block'] > last:
+            return False
+    if topic0s is not None and not topic0s.intersection(summary['topic0']):
+        return False
+    return True
+
+
+def select_spans(file_paths, blocks=None, topic0s=None, range_bytes=64 * 2**20):
+    """
+    Byte spans of the shards that can hold logs in `blocks` with a topic0 in `topic0s`.
+    Args:
+        file_paths (list): Shard paths.
+        blocks (tuple): Inclusive (first, last) block range, or None for every block.
+        topic0s (iterable): topic0 hashes, or None for every event.
+        range_bytes (int): Adjacent matching batches are merged into spans of up to about this size.
+    Returns:
+        dict: path -> list of (start, end) spans, or None to read the whole shard (no current index,
+        or a compressed one). Shards that cannot match are left out.
+    """
+    topic0s = {t.lower() for t in topic0s} if topic0s is not None else None
+    selection = {}
+    for path in file_paths:
+        index = load_index(path)
+        if index is None:
+            selection[path] = None
+            continue
+        if not _matches(index, blocks, topic0s):
+            continue
+        if not index['batches']:
+            selection[path] = None
+            continue
+        spans = []
+        for entry in index['batches']:
+            if entry['rows'] == 0 or not _matches(entry, blocks, topic0s):
+                continue
+            if spans and spans[-1][1] == entry['start'] and entry['end'] - spans[-1][0] <= range_bytes:
+                spans[-1] = (spans[-1][0], entry['end'])
+            else:
+                spans.append((entry['start'], entry['end']))
+        selection[path] = spans
+    return selection
+
+
+def select_logs(df, blocks=None, topic0s=None):
+    """
+    Rows of a parsed batch inside the block range and topic0 selection (the index only narrows it down to batches)
+    """
+    mask = pd.Series(True, index=df.index)
+    if blocks is not None:
+        block_number = pd.to_numeric(df['block_number'])
+        mask &= block_number.between(*blocks)
+    if topic0s is not None:
+        mask &= df['topic0'].str.lower().isin({t.lower() for t in topic0s})
+    return df[mask]
@@ -0,0 +1,512 @@
+"""
+Output sinks for decoded events.
+
+The parse scripts hand every decoded batch to a sink with `sink.write(event, df)`.
+`CsvSink` keeps the original one-CSV-per-event layout; `ParquetSink` writes one
+Parquet file per event with column types taken from the event ABI and row groups
+cut at `block_number` range boundaries, streaming each batch out so memory stays
+bounded by the chunk size. `SqliteSink` loads every event into its own table of
+one SQLite database and indexes the columns lookups filter on (block, transaction
+and the indexed event arguments) once the load is done, so a query for one
+address reads a few index pages instead of scanning a whole CSV.
+"""
+
+import csv
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from eth_abi.grammar import BasicType, parse
+from eth_utils import event_abi_to_log_topic
+
+from compact import limb_columns
+from decoder import fixed_to_hex
+from schema import output_columns
+
+# Columns added around the decoded arguments by the decoder and the timestamp merge
+META_SCHEMA = {
+    'event': pa.string(),
+    'logIndex': pa.int64(),
+    'transactionIndex': pa.int64(),
+    'transactionHash': pa.string(),
+    'address': pa.string(),
+    'blockHash': pa.string(),
+    'blockNumber': pa.int64(),
+    'block_timestamp': pa.timestamp('s', tz='UTC'),
+    'block_timestamp_unix': pa.int64(),
+    'msg_sender': pa.string(),
+}
+
+
+def abi_type_to_arrow(type_str):
+    """
+    Arrow type for a decoded ABI value.
+    Integers wider than 64 bits (uint256 amounts) are kept as decimal strings so no value is lost;
+    bytes are written as 0x-prefixed hex and arrays/tuples as their text form, like the CSV output.
+    """
+    try:
+        abi_type = parse(type_str)
+    except Exception:
+        return pa.string()
+    if not isinstance(abi_type, BasicType) or abi_type.arrlist:
+        return pa.string()
+    if abi_type.base == 'bool':
+        return pa.bool_()
+    if abi_type.base == 'uint' and abi_type.sub <= 64:
+        return pa.uint64()
+    if abi_type.base == 'int' and abi_type.sub <= 64:
+        return pa.int64()
+    return pa.string()
+
+
+def event_schema(event_abi):
+    """
+    column name -> Arrow type for the arguments of an event plus the metadata columns
+    """
+    schema = {inp['name']: abi_type_to_arrow(inp['type']) for inp in event_abi['inputs']}
+    schema.update(META_SCHEMA)
+    return schema
+
+
+def event_schemas(abi, output_schema=None):
+    """
+    topic0 -> (event name, column types) of every event in the ABI, so overloads sharing a name keep their own types
+    """
+    schemas = {}
+    for obj in abi or []:
+        if obj['type'] == 'event':
+            schema = event_schema(obj)
+            if output_schema is not None:
+                schema.update(output_schema.for_event(obj).arrow_types)
+            schemas['0x' + event_abi_to_log_topic(obj).hex()] = (obj['name'], schema)
+    return schemas
+
+
+def event_columns(event_abi, output_schema=None):
+    """
+    Names of the decoded argument columns of an event, with values stored as limbs split into their limb columns
+    """
+    arrow_types = output_schema.for_event(event_abi).arrow_types if output_schema is not None else {}
+    columns = []
+    for name, _ in output_columns(event_abi):
+        limbs = limb_columns(name)
+        columns.extend(limbs if limbs[0] in arrow_types else [name])
+    return columns
+
+
+def csv_header(path):
+    """
+    Column names on the first line of a CSV file
+    """
+    with open(path, newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def align_columns(df, header, path):
+    """
+    A batch reordered to the columns of `header`, empty where it lacks one (another overload of the event).
+    A column the header does not have raises ValueError: appending it would shift every value after it.
+    """
+    unknown = [col for col in df.columns if col not in header]
+    if unknown:
+        raise ValueError(f"{path} has no column for {', '.join(unknown)}")
+    return df if list(df.columns) == header else df.reindex(columns=header)
+
+
+def batch_column_types(schemas, event, columns):
+    """
+    Column types of the overload of `event` a decoded batch comes from: the one whose arguments are all
+    among `columns`, the one with the most arguments when several are (META_SCHEMA for an unknown event)
+    """
+    best, best_score = META_SCHEMA, None
+    for name, schema in schemas.values():
+        if name != event:
+            continue
+        arguments = [col for col in schema if col not in META_SCHEMA]
+        present = sum(col in columns for col in arguments)
+        score = (present == len(arguments), present)
+        if best_score is None or score > best_score:
+            best, best_score = schema, score
+    return best
+
+
+def _to_text(value):
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + bytes(value).hex()
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return str(value)
+
+
+def _to_arrow_column(values, arrow_type):
+    if values.dtype.kind == 'S' and pa.types.is_fixed_size_binary(arrow_type):
+        # Straight from the NumPy buffer: going through Python bytes would drop trailing zero bytes
+        buffer = pa.py_buffer(np.ascontiguousarray(values.to_numpy()).tobytes())
+        return pa.FixedSizeBinaryArray.from_buffers(arrow_type, len(values), [None, buffer])
+    if pa.types.is_dictionary(arrow_type):
+        return pa.array(values.astype('category')).cast(arrow_type)
+    if pa.types.is_binary(arrow_type) or pa.types.is_fixed_size_binary(arrow_type):
+        return pa.array([v if isinstance(v, (bytes, bytearray)) else None for v in values], type=arrow_type)
+    if pa.types.is_string(arrow_type):
+        return pa.array([_to_text(v) for v in values], type=arrow_type)
+    if pa.types.is_boolean(arrow_type):
+        if values.dtype == object:
+            values = values.map(lambda v: v if isinstance(v, (bool, np.bool_)) else str(v) == 'True')
+        return pa.array(values, type=arrow_type)
+    if pa.types.is_timestamp(arrow_type):
+        return pa.array(pd.to_datetime(values, utc=True), type=arrow_type)
+    return pa.array(pd.to_numeric(values), type=arrow_type)
+
+
+def _arrow_fields(df, column_types):
+    """
+    Arrow fields of a first batch: the ABI types, inferred for columns the ABI does not describe
+    """
+    fields = []
+    for col in df.columns:
+        arrow_type = column_types.get(col)
+        if arrow_type is None:
+            # Columns the ABI does not describe (flattened tuple components): infer once, then keep
+            arrow_type = pa.string() if df[col].dtype == object else pa.array(df[col]).type
+        fields.append(pa.field(col, arrow_type))
+    return fields
+
+
+class CsvSink:
+    """
+    One CSV file per event in `output_dir`, named `{prefix}_{event}.csv`.
+    The first write of an event in this sink replaces the file unless `append` is set,
+    later writes append without a header.
+    The header is the first batch's columns followed by the argument columns of the event's other overloads
+    in `abi`; every batch is written in that column order, empty where its overload lacks a column.
+    """
+
+    def __init__(self, output_dir, prefix, abi=None, append=False, output_schema=None):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.append = append
+        self.overloads = {}
+        for obj in abi or []:
+            if obj['type'] == 'event':
+                self.overloads.setdefault(obj['name'], []).append(event_columns(obj, output_schema))
+        self._headers = {}
+
+    def path(self, event):
+        return f"{self.output_dir}/{self.prefix}_{event}.csv"
+
+    def write(self, event, df):
+        path = self.path(event)
+        # Binary and fixed-width columns (output formats meant for Parquet) are written as hex text
+        binary = {col: fixed_to_hex(df[col].to_numpy()) for col in df.columns if df[col].dtype.kind == 'S'}
+        binary.update({col: df[col].map(_to_text) for col in df.columns
+                       if df[col].dtype == object and len(df) and isinstance(df[col].iloc[0], (bytes, bytearray))})
+        if binary:
+            df = df.assign(**binary)
+        header = self._headers.get(event)
+        if header is None and self.append and os.path.exists(path) and os.path.getsize(path):
+            header = self._headers[event] = csv_header(path)
+        if header is None:
+            extra = [col for columns in self.overloads.get(event, []) for col in columns if col not in df.columns]
+            header = self._headers[event] = list(df.columns) + list(dict.fromkeys(extra))
+            align_columns(df, header, path).to_csv(path, mode='w', index=False)
+        else:
+            align_columns(df, header, path).to_csv(path, mode='a', index=False, header=False)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _ParquetEventWriter:
+    """
+    Streams batches of one event into a Parquet file, one row group per block range
+    """
+
+    def __init__(self, path, block_range, max_rows):
+        self.path = path
+        self.block_range = block_range
+        self.max_rows = max_rows
+        self.schema = None
+        self.writer = None
+        self.pending = []
+        self.pending_rows = 0
+        self.pending_bucket = None
+
+    def _table(self, df, column_types):
+        if self.schema is None:
+            self.schema = pa.schema(_arrow_fields(df, column_types))
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        # A later batch may lack some columns (another overload, a tuple without some flattened component): nulls
+        arrays = [_to_arrow_column(df[field.name], field.type) if field.name in df.columns else pa.nulls(len(df), field.type)
+                  for field in self.schema]
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def write(self, df, column_types):
+        if 'blockNumber' in df.columns:
+            df = df.assign(blockNumber=pd.to_numeric(df['blockNumber'])).sort_values('blockNumber', kind='stable')
+            buckets = df['blockNumber'].to_numpy() // self.block_range
+            bounds = np.flatnonzero(np.diff(buckets)) + 1
+            starts, ends = np.r_[0, bounds], np.r_[bounds, len(df)]
+        else:
+            buckets, starts, ends = [None], [0], [len(df)]
+
+        table = self._table(df.reset_index(drop=True), column_types)
+        for start, end in zip(starts, ends):
+            bucket = buckets[start]
+            if self.pending and (bucket != self.pending_bucket or self.pending_rows + end - start > self.max_rows):
+                self.flush()
+            self.pending.append(table.slice(start, end - start))
+            self.pending_rows += end - start
+            self.pending_bucket = bucket
+
+    def flush(self):
+        if self.pending:
+            table = pa.concat_tables(self.pending)
+            self.writer.write_table(table, row_group_size=max(len(table), 1))
+        self.pending = []
+        self.pending_rows = 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ParquetSink:
+    """
+    One Parquet file per event in `output_dir`, named `{prefix}_{event}.parquet`.
+    Column types come from the event ABI (the batch's overload for overloaded names); rows are sorted by block within each batch and
+    row groups never span two `block_range` buckets, so readers can skip by block number.
+    With `output_schema` (schema.OutputSchema), binary and float output formats get matching Arrow types.
+    Files are complete only after `close()`.
+    """
+
+    def __init__(self, output_dir, prefix, abi, block_range=100000, max_rows_per_group=1000000, output_schema=None):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.block_range = block_range
+        self.max_rows_per_group = max_rows_per_group
+        self.schemas = event_schemas(abi, output_schema)
+        self._writers = {}
+
+    def path(self, event):
+        return f"{self.output_dir}/{self.prefix}_{event}.parquet"
+
+    def write(self, event, df):
+        if len(df) == 0:
+            return
+        writer = self._writers.get(event)
+        if writer is None:
+            writer = _ParquetEventWriter(self.path(event), self.block_range, self.max_rows_per_group)
+            self._writers[event] = writer
+        writer.write(df, batch_column_types(self.schemas, event, df.columns))
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def arrow_to_sqlite(arrow_type):
+    """
+    SQLite column type for an Arrow type.
+    uint64 values are stored bit for bit in SQLite's signed 64-bit integers, so values from 2**63 read back
+    negative (`compact.as_limbs` turns limb columns read back this way into the original limbs).
+    """
+    if pa.types.is_integer(arrow_type) or pa.types.is_boolean(arrow_type):
+        return 'INTEGER'
+    if pa.types.is_floating(arrow_type):
+        return 'REAL'
+    if pa.types.is_binary(arrow_type) or pa.types.is_fixed_size_binary(arrow_type):
+        return 'BLOB'
+    return 'TEXT'
+
+
+def _to_sqlite_column(values, arrow_type):
+    """
+    Column -> list of Python values sqlite3 binds as the column's SQLite type
+    """
+    array = _to_arrow_column(values, arrow_type)
+    if pa.types.is_dictionary(arrow_type):
+        array = array.dictionary_decode()
+    elif pa.types.is_timestamp(arrow_type):
+        array = pc.strftime(array, format='%Y-%m-%d %H:%M:%S')
+    elif pa.types.is_uint64(arrow_type):
+        array = array.cast(pa.int64(), safe=False)
+    return array.to_pylist()
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SqliteSink:
+    """
+    One SQLite database `{output_dir}/{prefix}.sqlite` with a table per event, named after the event.
+    Column types come from the event ABI (and `output_schema`): integers up to 64 bits as INTEGER, wider ones
+    as decimal TEXT (or BLOB with uint_format='fixed', whose big-endian words compare in numeric order),
+    bytes, hashes and addresses as text or BLOB depending on their output format.
+    Batches are inserted with `executemany` in one transaction each, with the journal in WAL mode and syncing
+    off while loading. Indexes on blockNumber, transactionHash and every indexed event argument are dropped
+    before an event's first batch and built by `close()`, after the load.
+    The first write of an event in this sink replaces its table unless `append` is set.
+    Args:
+        batch_rows (int): Rows converted and passed to `executemany` at a time.
+        cache_mb (int): SQLite page cache size while loading and indexing.
+    """
+
+    def __init__(self, output_dir, prefix, abi, append=False, output_schema=None, batch_rows=50000, cache_mb=256):
+        self.db_path = f"{output_dir}/{prefix}.sqlite"
+        self.append = append
+        self.batch_rows = batch_rows
+        self.schemas = event_schemas(abi, output_schema)
+        self.indexed = {}
+        for obj in abi or []:
+            if obj['type'] == 'event':
+                self.indexed.setdefault(obj['name'], []).extend(inp['name'] for inp in obj['inputs'] if inp.get('indexed'))
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.execute(f'PRAGMA cache_size=-{cache_mb * 1024}')
+        self._tables = {}
+
+    def path(self, event):
+        return self.db_path
+
+    def _index_columns(self, event, columns):
+        wanted = ['blockNumber', 'transactionHash'] + self.indexed.get(event, [])
+        return [col for col in dict.fromkeys(wanted) if col in columns]
+
+    def _index_name(self, event, col):
+        return _quote(f"{event}_{col}_idx")
+
+    def _create_table(self, event, df):
+        """
+        Creates (or, appending, reuses) the event's table from its first batch; returns its Arrow fields
+        """
+        fields = _arrow_fields(df, batch_column_types(self.schemas, event, df.columns))
+        table = _quote(event)
+        with self.connection:
+            if not self.append:
+                self.connection.execute(f'DROP TABLE IF EXISTS {table}')
+            columns = ', '.join(f'{_quote(f.name)} {arrow_to_sqlite(f.type)}' for f in fields)
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+            existing = [row[1] for row in self.connection.execute(f'PRAGMA table_info({table})')]
+            # Appending to an indexed table: drop the indexes so rows load without index updates, close() rebuilds them
+            for col in self._index_columns(event, existing):
+                self.connection.execute(f'DROP INDEX IF EXISTS {self._index_name(event, col)}')
+        return [f for f in fields if f.name in existing]
+
+    def write(self, event, df):
+        if len(df) == 0:
+            return
+        fields = self._tables.get(event)
+        if fields is None:
+            fields = self._tables[event] = self._create_table(event, df)
+        names = ', '.join(_quote(f.name) for f in fields)
+        insert = f'INSERT INTO {_quote(event)} ({names}) VALUES ({", ".join("?" * len(fields))})'
+        with self.connection:
+            for start in range(0, len(df), self.batch_rows):
+                batch = df.iloc[start:start + self.batch_rows]
+                columns = [_to_sqlite_column(batch[f.name], f.type) if f.name in batch.columns else [None] * len(batch)
+                           for f in fields]
+                self.connection.executemany(insert, zip(*columns))
+
+    def close(self):
+        """
+        Builds the indexes of the tables loaded through this sink and closes the database
+        """
+        if self.connection is None:
+            return
+        with self.connection:
+            for event, fields in self._tables.items():
+                for col in self._index_columns(event, [f.name for f in fields]):
+                    self.connection.execute(f'CREATE INDEX IF NOT EXISTS {self._index_name(event, col)} '
+                                            f'ON {_quote(event)} ({_quote(col)})')
+        self.connection.execute('PRAGMA optimize')
+        # Fold the WAL back into the database file, leaving a single file to copy or share
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.connection.close()
+        self.connection = None
+        self._tables = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PartitionedSink:
+    """
+    One sink per contract, in `{output_dir}/{label}` where label is `labels[address]` or the address itself.
+    Batches are split on their 'address' column, so logs of many contracts can be written through one sink.
+    """
+
+    def __init__(self, output_format, output_dir, prefix, abi_for=None, labels=None, **kwargs):
+        self.output_format = output_format
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.abi_for = abi_for
+        self.labels = {a.lower(): label for a, label in (labels or {}).items()}
+        self.kwargs = kwargs
+        self._sinks = {}
+
+    def sink_for(self, address):
+        address = address.lower()
+        sink = self._sinks.get(address)
+        if sink is None:
+            contract_dir = f"{self.output_dir}/{self.labels.get(address, address)}"
+            os.makedirs(contract_dir, exist_ok=True)
+            abi = self.abi_for(address) if self.abi_for is not None else None
+            sink = make_sink(self.output_format, contract_dir, self.prefix, abi or [], **self.kwargs)
+            self._sinks[address] = sink
+        return sink
+
+    def path(self, event, address):
+        return self.sink_for(address).path(event)
+
+    def write(self, event, df):
+        for address, part in df.groupby(df['address'].str.lower(), sort=False):
+            self.sink_for(address).write(event, part)
+
+    def close(self):
+        for sink in self._sinks.values():
+            sink.close()
+        self._sinks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def make_sink(output_format, output_dir, prefix, abi=None, append=False, **kwargs):
+    """
+    Returns the sink for `output_format` ('csv', 'parquet' or 'sqlite').
+    `append` applies to CSV files and SQLite tables; a Parquet file is always written from scratch.
+    `output_schema` applies to every format, other keyword arguments (row group or batch settings) to Parquet and SQLite.
+    """
+    if output_format == 'csv':
+        return CsvSink(output_dir, prefix, abi, append=append, output_schema=kwargs.get('output_schema'))
+    if output_format == 'parquet':
+        return ParquetSink(output_dir, prefix, abi, **kwargs)
+    if output_format == 'sqlite':
+        return SqliteSink(output_dir, prefix, abi, append=append, **kwargs)
+    raise ValueError(f"Unknown output format {output_format}")
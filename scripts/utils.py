@@ -5,75 +5,278 @@ Utilities for getting contract ABIs from Etherscan and caching them locally
 import ast 
 import requests
 import json
+import re
 import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from web3 import Web3
 from web3.datastructures import AttributeDict
 from hexbytes import HexBytes
+from eth_utils import event_abi_to_log_topic
 import os
+try:
+	import fcntl
+except ImportError: #Windows: no advisory locks, atomic renames only
+	fcntl = None
 
 ABI_ENDPOINT = 'https://api.etherscan.io/api?module=contract&action=getabi&address='
 
 if not os.path.exists('abis'):
     os.makedirs('abis')
 
-_cache_file = "abis/cached_abis.json"
+_abi_dir = "abis" #One <address>.json file per contract: {"abi": [...], "events": {topic0: event abi}}
+_cache_file = "abis/cached_abis.json" #Single-file cache of earlier versions, still read and migrated on a miss
 
-_cache = dict() #Dictionary of address: abi pairs
+_cache = OrderedDict() #In-process cache of address: {"abi", "events"} entries, most recently used last
+_cache_maxsize = None #Optional LRU bound on _cache, see set_abi_cache_size
+_legacy_cache = None
 
-def fetch_abi(contract_address,retry=0):
+_unverified_file = "abis/unverified.json" #Negative cache: address: time Etherscan last reported it unverified
+_unverified_ttl = 7 * 24 * 3600 #Seconds before an unverified address is queried again
+_api_key = os.environ.get('ETHERSCAN_API_KEY', '') #Appended to ABI_ENDPOINT requests when set
+_rate_limit = 5 if _api_key else 0.2 #Requests per second to ABI_ENDPOINT, see set_rate_limit
+_max_retries = 4 #Retries of a request that timed out, failed or hit the rate limit
+_backoff = 1 #Seconds before the first retry, doubled on each further one
+_pool_size = 16 #Pooled connections kept by the shared session
+_session = None
+_session_pid = None
+
+def set_abi_cache_size(maxsize):
 	"""
-	get abi for contract address from etherscan
-	This does *not* follow proxies
+	Bound the in-memory ABI cache to the `maxsize` most recently used contracts (None for no bound)
+	"""
+	global _cache_maxsize
+	_cache_maxsize = maxsize
+	_evict()
+
+def _evict():
+	while _cache_maxsize is not None and len(_cache) > _cache_maxsize:
+		_cache.popitem(last=False)
+
+def _remember(key,entry):
+	_cache[key] = entry
+	_cache.move_to_end(key)
+	_evict()
+
+def _abi_path(key):
+	"""
+	File holding the abi of `key`; addresses are lower-cased so checksummed and plain lookups share a file
+	"""
+	if re.fullmatch(r'0x[0-9a-fA-F]{40}', key):
+		name = key.lower()
+	else:
+		name = re.sub(r'[^0-9A-Za-z_.-]', '_', key)
+	return os.path.join(_abi_dir, f"{name}.json")
+
+@contextmanager
+def _locked():
+	"""
+	Exclusive lock on the abi folder across processes (decode workers, parallel runs); no-op where fcntl is unavailable
+	"""
+	with open(os.path.join(_abi_dir, ".lock"), 'w') as lock:
+		if fcntl is not None:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			if fcntl is not None:
+				fcntl.flock(lock, fcntl.LOCK_UN)
+
+def build_event_index(abi):
+	"""
+	topic0: event abi for every event of an abi
+	"""
+	return { '0x' + event_abi_to_log_topic(evt).hex(): evt for evt in abi if evt['type'] == 'event' }
+
+def _store(key,abi):
+	"""
+	Write the abi and its event index to the key's file (atomically, under the file lock) and cache it
 	"""
+	entry = {'abi': abi, 'events': build_event_index(abi)}
+	path = _abi_path(key)
+	with _locked():
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		with open(tmp_path, 'w') as outfile:
+			json.dump(entry, outfile)
+		os.replace(tmp_path, path)
+	_remember(key, entry)
+	return entry
+
+def _legacy_abis():
+	global _legacy_cache
+	if _legacy_cache is None:
+		try:
+			with open(_cache_file) as f:
+				_legacy_cache = json.load(f)
+		except Exception as e:
+			_legacy_cache = dict()
+	return _legacy_cache
+
+def _load_entry(key):
+	"""
+	Cached entry for key from memory, then its file, then the legacy cache file; None if unknown
+	"""
+	entry = _cache.get(key)
+	if entry is not None:
+		_cache.move_to_end(key)
+		return entry
 
-	max_retries = 1
 	try:
-		response = requests.get( f"{ABI_ENDPOINT}{contract_address}", timeout = 20 )	
-	except requests.exceptions.ReadTimeout as e:
-		if retry < max_retries:
-			print( f"Timeout, trying again" )
-			return fetch_abi(contract_address,retry+1)
-		else:
-			print( f"Retried {retry} times" )
-			print( f"Failed to get abi" )
-			return None
+		with open(_abi_path(key)) as f:
+			entry = json.load(f)
 	except Exception as e:
-		print( f"Failed to get {contract_address} from {ABI_ENDPOINT}" )
-		print( e )
-		return None
+		entry = None
+	if entry is not None:
+		_remember(key, entry)
+		return entry
+
+	abi = _legacy_abis().get(key)
+	if abi:
+		return _store(key, abi)
+	return None
+
+class _TokenBucket:
+	"""
+	Token bucket shared by the fetching threads: `rate` requests per second, bursts of up to `capacity`
+	(1 by default, so requests are evenly spaced and no one-second window goes over the limit)
+	"""
+	def __init__(self,rate,capacity=1):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = self.capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			#Tokens may go negative: each caller reserves its slot and sleeps until it comes up
+			self.tokens -= 1
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0
+		if wait > 0:
+			time.sleep(wait)
 
+_rate_limiter = _TokenBucket(_rate_limit)
+
+def set_rate_limit(per_second):
+	"""
+	Requests per second allowed to ABI_ENDPOINT across threads (Etherscan: 5 with an API key, 1 per 5 seconds without)
+	"""
+	global _rate_limiter
+	_rate_limiter = _TokenBucket(per_second)
+
+def _get_session():
+	"""
+	Pooled session reused by every request of this process (forked workers open their own)
+	"""
+	global _session, _session_pid
+	if _session is None or _session_pid != os.getpid():
+		_session = requests.Session()
+		_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=_pool_size))
+		_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=_pool_size))
+		_session_pid = os.getpid()
+	return _session
+
+def _request_abi(contract_address,endpoint=None):
+	"""
+	Query one address with exponential backoff on timeouts, server errors and rate limiting
+	Returns (abi or None, 'ok' | 'unverified' | 'error')
+	"""
+	url = f"{endpoint or ABI_ENDPOINT}{contract_address}"
+	if _api_key:
+		url += f"&apikey={_api_key}"
+	error = None
+	for attempt in range(_max_retries + 1):
+		if attempt:
+			time.sleep(_backoff * 2 ** (attempt - 1))
+		_rate_limiter.acquire()
+		try:
+			response = _get_session().get(url, timeout = 20)
+			if response.status_code == 429 or response.status_code >= 500:
+				error = f"HTTP {response.status_code}"
+				continue
+			response_json = response.json()
+			result = response_json['result']
+			if str(response_json.get('status')) == '1':
+				return json.loads(result), 'ok'
+		except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+			error = e
+			continue
+		if 'not verified' in str(result).lower():
+			return None, 'unverified'
+		if 'rate limit' in str(result).lower():
+			error = result
+			continue
+		print( f"Failed to get abi for {contract_address}: {result}" )
+		return None, 'error'
+	print( f"Failed to get abi for {contract_address} from {endpoint or ABI_ENDPOINT} after {_max_retries} retries" )
+	print( error )
+	return None, 'error'
+
+def _unverified():
+	"""
+	address: time it was last found unverified, from the negative cache
+	"""
 	try:
-		response_json = response.json()
-		abi_json = json.loads(response_json['result'])
+		with open(_unverified_file) as f:
+			return json.load(f)
 	except Exception as e:
-		print( f"Error in fetch_abi ({contract_address})" )
-		print( f"Failed to load json" )
-		print( e )
-		if retry < max_retries:
-			print( f"JSON error, trying again" )
-			return fetch_abi(contract_address,retry+1)
+		return dict()
+
+def _record_unverified(addresses):
+	with _locked():
+		entries = _unverified()
+		now = time.time()
+		entries.update({ address.lower(): now for address in addresses })
+		tmp_path = f"{_unverified_file}.{os.getpid()}.tmp"
+		with open(tmp_path, 'w') as outfile:
+			json.dump(entries, outfile)
+		os.replace(tmp_path, _unverified_file)
+
+def fetch_abi(contract_address):
+	"""
+	get abi for contract address from etherscan
+	This does *not* follow proxies
+	"""
+	return fetch_abis([contract_address], workers=1)[contract_address]
+
+def fetch_abis(addresses,workers=4,refresh=False,endpoint=None):
+	"""
+	get abis for many addresses from etherscan, `workers` requests at a time within the rate limit (see set_rate_limit)
+	Addresses found unverified less than _unverified_ttl seconds ago are not queried again unless `refresh` is set
+	endpoint overrides ABI_ENDPOINT (e.g. a local stand-in)
+	Returns {address: abi or None}
+	"""
+	unverified = {} if refresh else _unverified()
+	now = time.time()
+	abis = {}
+	pending = []
+	for address in dict.fromkeys(addresses):
+		checked = unverified.get(address.lower())
+		if checked is not None and now - checked < _unverified_ttl:
+			abis[address] = None
 		else:
-			print( f"Retried {retry} times" )
-			print( f"Failed to get abi for {contract_address}" )
-			return None
-	#print( type( abi_json ) ) #list
-	#print( type( abi_json[0] ) ) #dict
-	return abi_json
+			pending.append(address)
+
+	with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as pool:
+		replies = list(pool.map(lambda address: _request_abi(address, endpoint), pending))
+
+	found_unverified = [address for address, (abi, status) in zip(pending, replies) if status == 'unverified']
+	if found_unverified:
+		_record_unverified(found_unverified)
+	abis.update({ address: abi for address, (abi, status) in zip(pending, replies) })
+	return abis
 
 def set_abi(contract_address,abi,overwrite=True):
 	"""
 	Explicitly add a contract's abi to the cache
 	"""
-	try:
-		with open(_cache_file) as f:
-			_cache = json.load(f)
-	except Exception as e:
-		_cache = dict()
-	
-	if contract_address not in _cache.keys() or overwrite:
-		_cache[contract_address] = abi	
-		with open(_cache_file, 'w') as outfile:
-			json.dump(_cache, outfile,indent=2)
+	if overwrite or _load_entry(contract_address) is None:
+		_store(contract_address, abi)
 	else:
 		print( f"abi already exists" )
 		
@@ -86,27 +289,59 @@ def get_cached_abi(contract_address,abikw=""):
 	If not, fetch it from Etherscan
 	"""
 
-	try:
-		with open(_cache_file) as f:
-			_cache = json.load(f)
-	except Exception as e:
-		_cache = dict()
-	
 	if abikw:
 		search_for = abikw
 	else:
 		search_for = contract_address
 	
-	abi = _cache.get(search_for)
+	entry = _load_entry(search_for)
 
-	if not abi:
+	if entry is None:
 		abi = fetch_abi(search_for)
 		if abi is not None:
-			_cache[search_for] = abi
-			with open(_cache_file, 'w') as outfile:
-				json.dump(_cache, outfile,indent=2)
+			_store(search_for, abi)
+		return abi
 		
-	return abi
+	return entry['abi']
+
+def get_cached_abis(addresses,workers=4,endpoint=None):
+	"""
+	get_cached_abi for many addresses: cached abis are read, the others fetched concurrently (see fetch_abis) and cached
+	endpoint overrides ABI_ENDPOINT as in fetch_abis
+	Returns {address: abi or None}
+	"""
+	abis = {}
+	missing = []
+	for address in addresses:
+		entry = _load_entry(address)
+		if entry is None:
+			missing.append(address)
+		else:
+			abis[address] = entry['abi']
+
+	for address, abi in fetch_abis(missing, workers, endpoint=endpoint).items():
+		if abi is not None:
+			_store(address, abi)
+		abis[address] = abi
+	return abis
+
+def get_event_index(contract_address,abikw=""):
+	"""
+	topic0: event abi for the contract, from the index stored with the cached abi (no keccak hashing)
+	"""
+	get_cached_abi(contract_address,abikw)
+	entry = _load_entry(abikw if abikw else contract_address)
+	if entry is None:
+		return {}
+	if 'events' not in entry:
+		entry = _store(abikw if abikw else contract_address, entry['abi'])
+	return entry['events']
+
+def get_event_signatures(contract_address,abikw=""):
+	"""
+	topic0: event name for the contract
+	"""
+	return { topic0: evt['name'] for topic0, evt in get_event_index(contract_address,abikw).items() }
 
 def create_contract(web3,address):
 	"""
@@ -120,7 +355,7 @@ def get_event_args(contract_address,target_events='all',abikw=''):
 	"""
 	Get a list of events and their arguments from the ABI	
 	"""
-	abi = get_cached_abi(contract_address,abikw)
+	events = list(get_event_index(contract_address,abikw).values())
 
 #	full_event_signatures = {}
 #	for evt in [obj for obj in abi if obj['type'] == 'event']:
@@ -138,7 +373,6 @@ def get_event_args(contract_address,target_events='all',abikw=''):
 #		#event_signatures[full] = Web3.keccak(text=full).hex()
 #		event_signatures[Web3.keccak(text=full).hex()] = name
 
-	events = [obj for obj in abi if obj['type'] == 'event' ]
 	if target_events != 'all':
 		events = [e for e in events if e['name'] in target_events]
 
@@ -0,0 +1,60 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+
+import pytest
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+
+class RpcStub:
+    """
+    JSON-RPC endpoint served by aiohttp on a background thread.
+    `handler(body)` gets the decoded request (a dict, or a list for a batch) and returns the JSON reply,
+    or a web.Response for HTTP-level answers (429, 502...). GET requests (Etherscan-style APIs) hand it
+    their query parameters instead.
+    """
+
+    def __init__(self):
+        self.handler = None
+        self.posts = 0
+        self.gets = 0
+        self.loop = asyncio.new_event_loop()
+        self.runner = web.AppRunner(self._app())
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.url = f"http://127.0.0.1:{self.runner.addresses[0][1]}"
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def _app(self):
+        async def post(request):
+            self.posts += 1
+            reply = self.handler(json.loads(await request.read()))
+            return reply if isinstance(reply, web.StreamResponse) else web.json_response(reply)
+
+        async def get(request):
+            self.gets += 1
+            reply = self.handler(dict(request.query))
+            return reply if isinstance(reply, web.StreamResponse) else web.json_response(reply)
+        app = web.Application()
+        app.router.add_post('/', post)
+        app.router.add_get('/', get)
+        return app
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+
+@pytest.fixture
+def rpc_stub():
+    stub = RpcStub()
+    yield stub
+    stub.close()
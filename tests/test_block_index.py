@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from block_index import BlockIndex
+
+
+def logs(blocks, seed):
+    """
+    Raw logs of one transaction per block, the sender depending on `seed` so a later update overwrites it
+    """
+    return pd.DataFrame({'block_number': [str(n) for n in blocks],
+                         'block_timestamp': [f'2023-01-01 00:00:{n % 60:02d} UTC' for n in blocks],
+                         'transaction_hash': [f'0x{n:064x}' for n in blocks],
+                         'msg_sender': [f'0x{n * 7 + seed:040x}' for n in blocks]})
+
+
+def decoded(blocks):
+    return pd.DataFrame({'blockNumber': list(blocks), 'transactionHash': [f'0x{n:064x}' for n in blocks]})
+
+
+def test_partitions_are_appended_merged_and_reloaded(tmp_path):
+    path = str(tmp_path / 'pool_block_index.npz')
+    index = BlockIndex(path, block_bucket=100, max_segments=3)
+    expected = {}
+    rng = np.random.default_rng(0)
+    for seed in range(6):
+        blocks = rng.choice(1000, 150, replace=False)
+        index.update(logs(blocks, seed))
+        expected.update({n: f'0x{n * 7 + seed:040x}' for n in blocks})
+        index.save()
+        index = BlockIndex(path, block_bucket=100, max_segments=3)
+    files = os.listdir(str(tmp_path / 'pool_block_index_senders'))
+    # Segments are merged once a partition holds more than max_segments of them
+    assert max(sum(name.startswith(f'{b}_') for name in files) for b in range(10)) <= 3
+    blocks = sorted(expected)
+    enriched = index.enrich(decoded(blocks))
+    assert enriched['msg_sender'].tolist() == [expected[n] for n in blocks]
+    # A lookup only opens the partitions of its blocks
+    index = BlockIndex(path, block_bucket=100, max_segments=3)
+    index.enrich(decoded([n for n in blocks if n < 100]))
+    assert list(index._buckets) == [0]
+
+
+def test_unknown_transactions_and_blocks(tmp_path):
+    index = BlockIndex(block_bucket=100).update(logs([5, 150], 0))
+    enriched = index.enrich(decoded([5, 150, 151]).assign(transactionHash=[f'0x{5:064x}', f'0x{9:064x}', f'0x{151:064x}']))
+    # Block 151 is not in the index: dropped like the former inner merge
+    assert enriched['blockNumber'].tolist() == [5, 150]
+    assert enriched['msg_sender'].tolist() == [f'0x{35:040x}', None]
+    index.save(str(tmp_path / 'copy.npz'))
+    assert BlockIndex(str(tmp_path / 'copy.npz'), block_bucket=100).senders_for([f'0x{150:064x}'], [150]).tolist() == [f'0x{1050:040x}']
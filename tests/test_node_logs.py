@@ -0,0 +1,171 @@
+import json
+import os
+
+import pytest
+from aiohttp import web
+
+from node_logs import NodeLogSource, is_range_error, is_rate_limited, next_block
+
+FIRST, HEAD = 100, 299
+TOPIC = '0x' + 'dd' * 32
+
+
+def block_hash(n):
+    return f'0x{n:064x}'
+
+
+class Node:
+    """
+    Chain of blocks FIRST..HEAD holding n % 7 logs each (block 104 holds 6), behind a stub answering
+    eth_getLogs with at most `limit` results. Counters inject failures ahead of the next replies.
+    """
+
+    def __init__(self, limit=40):
+        self.limit = limit
+        self.logs = {n: [self._log(n, i) for i in range(n % 7)] for n in range(FIRST, HEAD + 1)}
+        self.spans = []
+        self.throttle = 0  # eth_getLogs replies answered with a rate-limit error
+        self.too_many = 0  # HTTP 429 replies
+        self.fail = 0  # HTTP 502 replies
+        self.shuffle = False  # Reverse the replies of batch requests
+        self.reorged = set()  # Blocks whose hash changed after their logs were read
+
+    @staticmethod
+    def _log(n, i):
+        return {'address': '0x' + '11' * 20, 'topics': [TOPIC], 'data': '0x', 'blockNumber': hex(n),
+                'transactionHash': f'0x{n:060x}{i:04x}', 'transactionIndex': hex(i), 'blockHash': block_hash(n),
+                'logIndex': hex(i), 'removed': False}
+
+    def expected(self, first=FIRST, last=HEAD):
+        return [(n, i) for n in range(first, last + 1) for i in range(len(self.logs[n]))]
+
+    def answer(self, request):
+        method, params = request['method'], request['params']
+        if method == 'eth_blockNumber':
+            return {'jsonrpc': '2.0', 'id': request['id'], 'result': hex(HEAD)}
+        if method == 'eth_getLogs':
+            first, last = int(params[0]['fromBlock'], 16), int(params[0]['toBlock'], 16)
+            if self.throttle:
+                self.throttle -= 1
+                return {'jsonrpc': '2.0', 'id': request['id'],
+                        'error': {'code': -32005, 'message': 'daily request count exceeded, request rate limited'}}
+            self.spans.append(last - first + 1)
+            logs = [log for n in range(first, min(last, HEAD) + 1) for log in self.logs[n]]
+            if len(logs) > self.limit:
+                return {'jsonrpc': '2.0', 'id': request['id'],
+                        'error': {'code': -32005, 'message': f'query returned more than {self.limit} results'}}
+            return {'jsonrpc': '2.0', 'id': request['id'], 'result': logs}
+        if method == 'eth_getBlockByNumber':
+            n = int(params[0], 16)
+            transactions = [{'hash': log['transactionHash'], 'from': '0x' + f'{n:040x}'} for log in self.logs[n]]
+            return {'jsonrpc': '2.0', 'id': request['id'],
+                    'result': {'number': params[0], 'hash': block_hash(n + 1 if n in self.reorged else n),
+                               'timestamp': hex(1600000000 + 12 * n), 'transactions': transactions}}
+        return {'jsonrpc': '2.0', 'id': request['id'], 'error': {'code': -32601, 'message': 'method not found'}}
+
+    def __call__(self, body):
+        if self.fail:
+            self.fail -= 1
+            return web.Response(status=502)
+        if self.too_many:
+            self.too_many -= 1
+            return web.Response(status=429, headers={'Retry-After': '0'})
+        if isinstance(body, list):
+            replies = [self.answer(request) for request in body]
+            return replies[::-1] if self.shuffle else replies
+        return self.answer(body)
+
+
+@pytest.fixture
+def node(rpc_stub):
+    rpc_stub.handler = Node()
+    return rpc_stub.handler
+
+
+def keys(records):
+    return [(r['block_number'], r['log_index']) for r in records]
+
+
+def test_refused_ranges_are_bisected_and_grow_back(rpc_stub, node):
+    source = NodeLogSource(rpc_stub.url, span=64, target_logs=100, concurrency=1)
+    records = source.fetch(FIRST, HEAD)
+    assert keys(records) == node.expected()
+    assert source.bisections > 0
+    # After a refused range the span is halved, then doubles again on sparse ranges
+    smallest = node.spans.index(min(node.spans))
+    assert max(node.spans[smallest:]) > min(node.spans)
+
+
+def test_single_block_over_the_limit_fails(rpc_stub, node):
+    node.limit = 3
+    with pytest.raises(ValueError, match='alone holds more logs'):
+        NodeLogSource(rpc_stub.url, span=8).fetch(FIRST + 4, FIRST + 4)
+
+
+def test_rate_limit_error_is_retried_without_shrinking_the_range(rpc_stub, node):
+    node.limit = 10000
+    node.throttle = 2
+    source = NodeLogSource(rpc_stub.url, span=200, concurrency=1)
+    records = source.fetch(FIRST, HEAD)
+    assert keys(records) == node.expected()
+    assert source.bisections == 0
+    assert source.throttled == 2
+    assert node.spans == [200]
+
+
+def test_http_429_is_retried(rpc_stub, node):
+    node.limit = 10000
+    node.too_many = 2
+    source = NodeLogSource(rpc_stub.url, span=16, concurrency=1)
+    assert keys(source.fetch(FIRST, FIRST + 40)) == node.expected(FIRST, FIRST + 40)
+    assert source.throttled == 2 and source.bisections == 0
+
+
+def test_error_classification():
+    assert is_range_error({'code': -32005, 'message': 'query returned more than 10000 results'})
+    assert is_range_error({'code': -32602, 'message': 'eth_getLogs is limited to a 10,000 range'})
+    assert not is_range_error({'code': -32005, 'message': 'daily request count exceeded, request rate limited'})
+    assert is_rate_limited({'code': -32005, 'message': 'daily request count exceeded, request rate limited'})
+    assert is_rate_limited({'code': 429, 'message': 'Too Many Requests'})
+    assert not is_rate_limited({'code': -32005, 'message': 'query returned more than 10000 results'})
+    assert not is_rate_limited({'code': -32000, 'message': 'header not found'})
+
+
+def test_out_of_order_batch_replies(rpc_stub, node):
+    node.shuffle = True
+    records = NodeLogSource(rpc_stub.url, span=32, batch_size=7).fetch(FIRST, HEAD)
+    assert keys(records) == node.expected()
+    for record in records:
+        assert record['msg_sender'] == '0x' + f"{record['block_number']:040x}"
+        assert record['block_hash'] == block_hash(record['block_number'])
+
+
+def test_transport_failures_are_retried(rpc_stub, node):
+    node.fail = 2
+    source = NodeLogSource(rpc_stub.url, span=64)
+    assert keys(source.fetch(FIRST, HEAD)) == node.expected()
+
+
+def test_transport_failure_raises_after_retries(rpc_stub, node):
+    node.fail = 10
+    with pytest.raises(ConnectionError):
+        NodeLogSource(rpc_stub.url, retries=1).fetch(FIRST, HEAD)
+
+
+def test_reorg_is_detected(rpc_stub, node):
+    node.reorged = {FIRST + 20}
+    with pytest.raises(ValueError, match='reorg'):
+        NodeLogSource(rpc_stub.url, span=64).fetch(FIRST, HEAD)
+
+
+def test_write_shards_resumes_after_the_last_shard(rpc_stub, node, tmp_path):
+    folder = str(tmp_path)
+    source = NodeLogSource(rpc_stub.url, span=64)
+    first_paths = source.write_shards(folder, FIRST, 179, blocks_per_shard=50, confirmations=0)
+    assert next_block(folder) == 180
+    # The next run starts after the last shard and stops `confirmations` blocks below the head
+    more_paths = source.write_shards(folder, blocks_per_shard=50, confirmations=10)
+    assert os.path.basename(more_paths[0]) == 'node_logs_0000000180_0000000229.json'
+    assert next_block(folder) == HEAD - 10 + 1
+    records = [json.loads(line) for path in first_paths + more_paths for line in open(path)]
+    assert keys(records) == node.expected(FIRST, HEAD - 10)
@@ -0,0 +1,118 @@
+import json
+
+import pytest
+from aiohttp import web
+from web3 import Web3
+
+from proxies import BEACON_SLOT, IMPLEMENTATION_SELECTOR, PROXY_SLOTS, ProxyResolver
+
+ZERO_WORD = '0x' + '00' * 32
+
+
+def address(n):
+    return Web3.to_checksum_address(f'0x{n:040x}')
+
+
+def word(value):
+    return '0x' + '00' * 12 + value[2:].lower()
+
+
+class Chain:
+    """
+    Storage of a few proxies (every slot kind, a beacon, a beacon without implementation()) behind a
+    JSON-RPC stub that answers batches in reverse order. Counters inject failures ahead of the next replies.
+    """
+
+    def __init__(self):
+        self.storage = {}
+        self.beacons = {}
+        self.expected = {address(0x100): address(0x100)}  # Not a proxy
+        for i, slot in enumerate(PROXY_SLOTS):
+            proxy = address(0x200 + i)
+            if slot == BEACON_SLOT:
+                beacon = address(0x300)
+                self.beacons[beacon.lower()] = address(0x900 + i)
+                self.storage[(proxy.lower(), slot)] = word(beacon)
+                self.expected[proxy] = address(0x900 + i)
+            else:
+                self.storage[(proxy.lower(), slot)] = word(address(0x900 + i))
+                self.expected[proxy] = address(0x900 + i)
+        # Lower-priority slots lose to the EIP-1967 implementation slot
+        self.storage[(address(0x200).lower(), PROXY_SLOTS[3])] = word(address(0x999))
+        # A beacon without implementation(): the beacon itself is taken
+        self.storage[(address(0x400).lower(), BEACON_SLOT)] = word(address(0x401))
+        self.expected[address(0x400)] = address(0x401)
+        self.fail = 0  # HTTP 503 replies
+        self.throttle = 0  # Batches answered with a rate-limit error in one of their calls
+
+    def answer(self, request):
+        method, params = request['method'], request['params']
+        if method == 'eth_getStorageAt':
+            return {'jsonrpc': '2.0', 'id': request['id'], 'result': self.storage.get((params[0].lower(), params[1]), ZERO_WORD)}
+        if method == 'eth_call' and params[0]['data'] == IMPLEMENTATION_SELECTOR and params[0]['to'].lower() in self.beacons:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'result': word(self.beacons[params[0]['to'].lower()])}
+        return {'jsonrpc': '2.0', 'id': request['id'], 'error': {'code': -32000, 'message': 'execution reverted'}}
+
+    def __call__(self, body):
+        if self.fail:
+            self.fail -= 1
+            return web.Response(status=503)
+        replies = [self.answer(request) for request in body]
+        if self.throttle:
+            self.throttle -= 1
+            replies[0] = {'jsonrpc': '2.0', 'id': replies[0]['id'], 'error': {'code': -32005, 'message': 'rate limit exceeded'}}
+        return replies[::-1]
+
+
+@pytest.fixture
+def chain(rpc_stub):
+    rpc_stub.handler = Chain()
+    return rpc_stub.handler
+
+
+def test_resolve_with_out_of_order_batch_replies(rpc_stub, chain, tmp_path):
+    resolver = ProxyResolver(rpc_stub.url, cache_path=str(tmp_path / 'proxies.json'), batch_size=4)
+    assert resolver.resolve(list(chain.expected)) == chain.expected
+    assert resolver.failed == set()
+    assert resolver.proxies(list(chain.expected)) == {a: i for a, i in chain.expected.items() if a != i}
+
+
+def test_cached_addresses_make_no_requests(rpc_stub, chain, tmp_path):
+    cache_path = str(tmp_path / 'proxies.json')
+    ProxyResolver(rpc_stub.url, cache_path=cache_path).resolve(list(chain.expected))
+    resolver = ProxyResolver(rpc_stub.url, cache_path=cache_path)
+    # Any case of the address hits the cache
+    assert resolver.resolve([a.lower() for a in chain.expected]) == {a.lower(): i for a, i in chain.expected.items()}
+    assert resolver.requests == 0
+    with open(cache_path) as f:
+        assert json.load(f)[address(0x100).lower()] is None
+
+
+def test_transport_failure_is_retried(rpc_stub, chain, tmp_path):
+    chain.fail = 2
+    resolver = ProxyResolver(rpc_stub.url, cache_path=str(tmp_path / 'proxies.json'), batch_size=100, retries=2)
+    assert resolver.resolve(list(chain.expected)) == chain.expected
+    assert resolver.failed == set()
+
+
+def test_failed_reads_are_not_cached(rpc_stub, chain, tmp_path):
+    cache_path = str(tmp_path / 'proxies.json')
+    chain.fail = 100
+    resolver = ProxyResolver(rpc_stub.url, cache_path=cache_path, batch_size=100, retries=1)
+    # Unreadable addresses resolve to themselves for this run only
+    assert resolver.resolve(list(chain.expected)) == {a: a for a in chain.expected}
+    assert resolver.failed == {a.lower() for a in chain.expected}
+    assert resolver.cache == {}
+    chain.fail = 0
+    resolver = ProxyResolver(rpc_stub.url, cache_path=cache_path)
+    assert resolver.resolve(list(chain.expected)) == chain.expected
+
+
+def test_throttled_batches_are_retried_then_failed(rpc_stub, chain, tmp_path):
+    chain.throttle = 1
+    resolver = ProxyResolver(rpc_stub.url, cache_path=str(tmp_path / 'proxies.json'), batch_size=100, retries=1)
+    assert resolver.resolve(list(chain.expected)) == chain.expected
+    chain.throttle = 100
+    resolver = ProxyResolver(rpc_stub.url, cache_path=None, batch_size=100, retries=1)
+    assert resolver.resolve([address(0x201)]) == {address(0x201): address(0x201)}
+    assert resolver.failed == {address(0x201).lower()}
@@ -0,0 +1,69 @@
+import pandas as pd
+import pytest
+
+from manifest import _append_csv
+from sinks import CsvSink
+
+ADDRESS = {'name': 'who', 'type': 'address', 'indexed': True}
+# Two overloads of one event name: decode_batch yields both under 'Deposit'
+ABI = [
+    {'type': 'event', 'name': 'Deposit', 'anonymous': False,
+     'inputs': [ADDRESS, {'name': 'amount', 'type': 'uint256', 'indexed': False}]},
+    {'type': 'event', 'name': 'Deposit', 'anonymous': False,
+     'inputs': [ADDRESS, {'name': 'id', 'type': 'uint256', 'indexed': False},
+                {'name': 'memo', 'type': 'string', 'indexed': False}]},
+]
+
+
+def batch(block, **arguments):
+    return pd.DataFrame({'who': ['0x' + '11' * 20], **{k: [v] for k, v in arguments.items()},
+                         'event': ['Deposit'], 'blockNumber': [block]})
+
+
+def read(path):
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def test_overloads_share_one_header(tmp_path):
+    sink = CsvSink(str(tmp_path), 'pool', ABI)
+    sink.write('Deposit', batch(1, amount=5))
+    sink.write('Deposit', batch(2, id=7, memo='a,b'))
+    sink.write('Deposit', batch(3, amount=6))
+    df = read(sink.path('Deposit'))
+    assert list(df.columns) == ['who', 'amount', 'event', 'blockNumber', 'id', 'memo']
+    assert df[['blockNumber', 'amount', 'id', 'memo']].values.tolist() == [['1', '5', '', ''], ['2', '', '7', 'a,b'],
+                                                                           ['3', '6', '', '']]
+
+
+def test_append_keeps_the_existing_header(tmp_path):
+    CsvSink(str(tmp_path), 'pool', ABI).write('Deposit', batch(1, id=7, memo='x'))
+    sink = CsvSink(str(tmp_path), 'pool', ABI, append=True)
+    sink.write('Deposit', batch(2, amount=5))
+    df = read(sink.path('Deposit'))
+    assert list(df.columns) == ['who', 'id', 'memo', 'event', 'blockNumber', 'amount']
+    assert df['amount'].tolist() == ['', '5']
+
+
+def test_unknown_column_is_rejected(tmp_path):
+    sink = CsvSink(str(tmp_path), 'pool', ABI)
+    sink.write('Deposit', batch(1, amount=5))
+    with pytest.raises(ValueError, match='extra'):
+        sink.write('Deposit', batch(2, amount=6, extra=1))
+
+
+def test_staged_csv_in_another_column_order_is_remapped(tmp_path):
+    final = str(tmp_path / 'pool_Deposit.csv')
+    (tmp_path / 'a').mkdir()
+    first = CsvSink(str(tmp_path / 'a'), 'pool', ABI)
+    first.write('Deposit', batch(1, amount=5))
+    size = _append_csv(first.path('Deposit'), final, 0)
+    # The next shard starts with the other overload, so its staged header is ordered differently
+    (tmp_path / 'b').mkdir()
+    second = CsvSink(str(tmp_path / 'b'), 'pool', ABI)
+    second.write('Deposit', batch(2, id=7, memo='m'))
+    second.write('Deposit', batch(3, amount=6))
+    _append_csv(second.path('Deposit'), final, size)
+    df = read(final)
+    assert list(df.columns) == ['who', 'amount', 'event', 'blockNumber', 'id', 'memo']
+    assert df[['blockNumber', 'amount', 'id', 'memo']].values.tolist() == [['1', '5', '', ''], ['2', '', '7', 'm'],
+                                                                           ['3', '6', '', '']]
@@ -0,0 +1,104 @@
+import json
+import time
+from collections import OrderedDict
+
+import pytest
+from aiohttp import web
+
+import utils
+
+ABI = [{'type': 'event', 'name': 'Ping', 'anonymous': False, 'inputs': [{'name': 'n', 'type': 'uint256', 'indexed': False}]}]
+VERIFIED = [f'0x{n:040x}' for n in range(1, 7)]
+UNVERIFIED = '0x' + 'ee' * 20
+
+
+class Etherscan:
+    """
+    getabi answers for VERIFIED (the ABI) and UNVERIFIED (not verified), with the arrival time of every request.
+    Counters inject failures ahead of the next replies.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.fail = 0  # HTTP 503 replies
+        self.too_many = 0  # HTTP 429 replies
+        self.throttle = 0  # Rate-limit messages in a 200 reply
+
+    def __call__(self, query):
+        self.requests.append((time.monotonic(), query['address']))
+        if self.fail:
+            self.fail -= 1
+            return web.Response(status=503)
+        if self.too_many:
+            self.too_many -= 1
+            return web.Response(status=429)
+        if self.throttle:
+            self.throttle -= 1
+            return {'status': '0', 'message': 'NOTOK', 'result': 'Max rate limit reached'}
+        if query['address'] in VERIFIED:
+            return {'status': '1', 'message': 'OK', 'result': json.dumps(ABI)}
+        return {'status': '0', 'message': 'NOTOK', 'result': 'Contract source code not verified'}
+
+
+@pytest.fixture
+def etherscan(rpc_stub, tmp_path, monkeypatch):
+    rpc_stub.handler = Etherscan()
+    rpc_stub.handler.endpoint = f'{rpc_stub.url}/?module=contract&action=getabi&address='
+    monkeypatch.setattr(utils, '_abi_dir', str(tmp_path))
+    monkeypatch.setattr(utils, '_cache_file', str(tmp_path / 'cached_abis.json'))
+    monkeypatch.setattr(utils, '_unverified_file', str(tmp_path / 'unverified.json'))
+    monkeypatch.setattr(utils, '_cache', OrderedDict())
+    monkeypatch.setattr(utils, '_legacy_cache', None)
+    monkeypatch.setattr(utils, '_api_key', '')
+    monkeypatch.setattr(utils, '_backoff', 0.01)
+    monkeypatch.setattr(utils, '_rate_limiter', utils._TokenBucket(1000))
+    return rpc_stub.handler
+
+
+def test_requests_are_paced_by_the_token_bucket(etherscan):
+    utils.set_rate_limit(20)
+    abis = utils.fetch_abis(VERIFIED, workers=4, endpoint=etherscan.endpoint)
+    assert abis == {address: ABI for address in VERIFIED}
+    # Four threads, but one request every 1/20 s: no burst above the rate
+    times = sorted(t for t, _ in etherscan.requests)
+    assert times[-1] - times[0] >= (len(times) - 1) / 20 * 0.8
+
+
+def test_server_errors_and_rate_limits_are_retried(etherscan):
+    etherscan.fail = 1
+    etherscan.too_many = 1
+    etherscan.throttle = 1
+    assert utils.fetch_abis(VERIFIED[:1], endpoint=etherscan.endpoint) == {VERIFIED[0]: ABI}
+    assert len(etherscan.requests) == 4
+
+
+def test_failures_after_the_retries_are_not_cached_as_unverified(etherscan, monkeypatch):
+    monkeypatch.setattr(utils, '_max_retries', 1)
+    etherscan.fail = 2
+    assert utils.fetch_abis(VERIFIED[:1], endpoint=etherscan.endpoint) == {VERIFIED[0]: None}
+    assert len(etherscan.requests) == 2
+    assert utils._unverified() == {}
+    assert utils.fetch_abis(VERIFIED[:1], endpoint=etherscan.endpoint) == {VERIFIED[0]: ABI}
+
+
+def test_unverified_addresses_are_not_queried_again_until_the_ttl(etherscan):
+    assert utils.fetch_abis([UNVERIFIED], endpoint=etherscan.endpoint) == {UNVERIFIED: None}
+    assert utils.fetch_abis([UNVERIFIED], endpoint=etherscan.endpoint) == {UNVERIFIED: None}
+    assert len(etherscan.requests) == 1
+    # refresh=True ignores the negative cache
+    utils.fetch_abis([UNVERIFIED], refresh=True, endpoint=etherscan.endpoint)
+    assert len(etherscan.requests) == 2
+    # Entries older than 7 days are queried again
+    with open(utils._unverified_file, 'w') as f:
+        json.dump({UNVERIFIED: time.time() - 7 * 24 * 3600 - 60}, f)
+    utils.fetch_abis([UNVERIFIED], endpoint=etherscan.endpoint)
+    assert len(etherscan.requests) == 3
+
+
+def test_get_cached_abis_fetches_from_the_endpoint_once(etherscan):
+    addresses = VERIFIED[:2] + [UNVERIFIED]
+    expected = {VERIFIED[0]: ABI, VERIFIED[1]: ABI, UNVERIFIED: None}
+    assert utils.get_cached_abis(addresses, endpoint=etherscan.endpoint) == expected
+    assert utils.get_cached_abis(addresses, endpoint=etherscan.endpoint) == expected
+    assert len(etherscan.requests) == 3
+    assert utils.get_event_index(VERIFIED[0]) == utils.build_event_index(ABI)